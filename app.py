@@ -4,14 +4,25 @@ import json
 import os
 import sys
 import math
-
-from flask import Flask, render_template, request, redirect, url_for, flash
+import hashlib
+import heapq
+import itertools
+import base64
+import csv
+import io
+import uuid
+import signal
+import gzip
+import functools
+
+from flask import (Flask, render_template, request, redirect, url_for, flash, Response, jsonify,
+                   stream_with_context, send_file, session)
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from datetime import datetime, timedelta, date
-from collections import defaultdict
+from collections import defaultdict, namedtuple
 
-from smartcard.System import readers
-from smartcard.util import toHexString
 import threading
 import calendar
 
@@ -20,13 +31,50 @@ from openpyxl import Workbook
 from openpyxl.utils import get_column_letter
 
 import zipfile # `BadZipFile`をキャッチするためにimportを追加
+import click
+
+from card_reader import CardReaderService, ReaderConfig
+from user_cache import UserPresenceCache
+from notifier import DiscordNotifier
+from tap_journal import TapJournal
+from result_cache import ResultCache
+from log_archive import LogArchive
+from export_jobs import ExportJobManager
+from scheduler import Scheduler
+from live_feed import LiveFeed
+from worker_sync import SharedCounters, LeaderLock, ProcessLock
+from report_pool import ReportPool
+from excel_export import ExcelExportTracker, block_has_stays, month_marker, save_workbook_atomically
+import migrations
+from metrics import (REGISTRY, TAP_STAGE_SECONDS, TAPS_TOTAL, UNKNOWN_CARDS_TOTAL,
+                     DB_LOCK_WAITS_TOTAL, TAP_BATCH_SIZE, JOB_DURATION_SECONDS, JOB_RUNS_TOTAL,
+                     EXCEL_EXPORTS_TOTAL, EXCEL_ROWS_WRITTEN_TOTAL, EXPORT_REQUESTS_TOTAL,
+                     REPORT_JOBS_TOTAL, REPORT_JOB_SECONDS, CONDITIONAL_GETS_TOTAL,
+                     COMPRESSED_RESPONSES_TOTAL)
+from sqlalchemy.exc import OperationalError
+
+try:
+    import brotli
+except ImportError:  # brotli がなければ gzip だけで圧縮する
+    brotli = None
 
 # --- Flaskアプリケーションの設定 ---
-app = Flask(__name__)
+# データベース・タップジャーナル・通知スプールの置き場所。
+# 環境変数 ACCESS_CONTROL_INSTANCE_PATH で変更できる（負荷試験や検証用の環境など）
+app = Flask(__name__, instance_path=os.environ.get('ACCESS_CONTROL_INSTANCE_PATH'))
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///access_log.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SECRET_KEY'] = 'your_super_secret_key_here' # 本番環境ではより複雑なキーにすること
 
+# --- 複数のワーカープロセスで動かす場合の共有状態 ---
+# gunicorn.conf.py で起動すると、マスタープロセスが作った共有カウンタのファイルが
+# 環境変数 ACCESS_CONTROL_WORKER_STATE で渡される（python app.py の1プロセスで動かす場合は None）。
+# データバージョンやユーザーの変更などをこのカウンタでプロセス間に知らせる。
+WORKER_STATE_PATH = os.environ.get('ACCESS_CONTROL_WORKER_STATE')
+WORKER_STATE_COUNTERS = ('data_version', 'pin_epoch', 'users', 'flush_requested', 'flush_done',
+                         'live_events', 'notifications')
+worker_state = SharedCounters(WORKER_STATE_PATH, WORKER_STATE_COUNTERS) if WORKER_STATE_PATH else None
+
 # --- 削除と修正操作用のパスワード設定 ---
 DELETE_PASSWORD = "DELETE"
 EDIT_PASSWORD = "EDIT"
@@ -48,43 +96,147 @@ class AccessLog(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     timestamp = db.Column(db.DateTime, default=datetime.now)
     status = db.Column(db.String(20), nullable=False)
+    reader = db.Column(db.String(80), nullable=True) # 記録したリーダー（ドア名）
     
+    # インデックスは migrations.py で作成する（ここの定義はそれに合わせたもの）
+    __table_args__ = (
+        db.Index('ix_access_log_user_id_timestamp', 'user_id', 'timestamp'),
+        db.Index('ix_access_log_timestamp', 'timestamp'),
+    )
+
     user = db.relationship('User', backref=db.backref('access_logs', lazy=True))
 
     def __repr__(self):
         return f'<AccessLog {self.user.name} {self.status} at {self.timestamp}>'
 
-def read_felica_card_idm():
-    try:
-        available_readers = readers()
-        if not available_readers:
-            print("NFC Error: No smart card readers found. Is PaSoRi connected and pcscd running?")
-            return None
+class StaySession(db.Model):
+    """
+    入室から退室までの1回の滞在。タップや自動退室のたびに差分で更新されます。
+    exit_ts が None のものは滞在中（未退室）のセッションです。
+    """
+    __tablename__ = 'sessions'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    entry_ts = db.Column(db.DateTime, nullable=False, index=True)
+    exit_ts = db.Column(db.DateTime, nullable=True)
+    duration_seconds = db.Column(db.Float, nullable=True)
+    auto_closed = db.Column(db.Boolean, nullable=False, default=False) # 自動退室で閉じられた
 
-        pasori_reader = next((r for r in available_readers if 'PaSoRi' in str(r) or 'FeliCa' in str(r)), None)
+    # 未退室のセッションだけの部分インデックス（migrations.py で作成する）
+    __table_args__ = (
+        db.Index('ix_sessions_open', 'entry_ts', sqlite_where=db.text('exit_ts IS NULL')),
+    )
 
-        if not pasori_reader:
-            print("NFC Error: PaSoRi reader not found. Please check its name or connection.")
-            return None
+    def __repr__(self):
+        return f'<StaySession user={self.user_id} {self.entry_ts} - {self.exit_ts}>'
 
-        connection = pasori_reader.createConnection()
-        connection.connect()
-        
-        idm_apdu = [0xFF, 0xCA, 0x00, 0x00, 0x00]
-        response, sw1, sw2 = connection.transmit(idm_apdu)
-        
-        if sw1 == 0x90 and sw2 == 0x00:
-            idm = toHexString(response).replace(" ", "")
-            return idm
-        else:
-            print(f"NFC Error: Failed to get IDm. SW: {hex(sw1)} {hex(sw2)}")
-            return None
+class DailyStay(db.Model):
+    """
+    ユーザーごと・日ごとの滞在時間の集計（ロールアップ）。
+    セッションが閉じるたびに加算され、日付をまたいだセッションは日ごとに分割されます。
+    """
+    __tablename__ = 'daily_stay'
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    date = db.Column(db.Date, primary_key=True, index=True)
+    seconds = db.Column(db.Float, nullable=False, default=0)
+    session_count = db.Column(db.Integer, nullable=False, default=0)
 
-    except Exception as e:
-        return None
+    def __repr__(self):
+        return f'<DailyStay user={self.user_id} {self.date} {self.seconds}s>'
+
+class DailyPresence(db.Model):
+    """
+    日ごとの在室者の索引。その日に在室していたユーザーの ID をビットで表します
+    （ID が n のユーザーがいれば下位から n ビット目が立つ、リトルエンディアンのバイト列）。
+    """
+    __tablename__ = 'daily_presence'
+    date = db.Column(db.Date, primary_key=True)
+    user_bitmap = db.Column(db.LargeBinary, nullable=False, default=b'')
+
+    def __repr__(self):
+        return f'<DailyPresence {self.date}>'
+
+class Presence(db.Model):
+    """
+    ユーザーごとの現在の在室状態（最後のログのステータスと、その時刻）。
+    タップや自動退室と同じトランザクションで更新されるため、ログの量によらず
+    「今だれがいるか」を返せます。行がないユーザーはログがない（在室していない）ユーザーです。
+    """
+    __tablename__ = 'presence'
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    status = db.Column(db.String(20), nullable=False)
+    since = db.Column(db.DateTime, nullable=False)
+
+    # インデックスは migrations.py で作成する
+    __table_args__ = (
+        db.Index('ix_presence_status', 'status'),
+    )
+
+    def __repr__(self):
+        return f'<Presence user={self.user_id} {self.status} since {self.since}>'
+
+class ArchivedMonth(db.Model):
+    """アーカイブファイルに移した月（log_archive.py を参照）"""
+    __tablename__ = 'archived_month'
+    month = db.Column(db.Date, primary_key=True) # 月の初日
+    file_name = db.Column(db.String(120), nullable=False)
+    log_count = db.Column(db.Integer, nullable=False)
+    session_count = db.Column(db.Integer, nullable=False)
+    archived_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+
+    def __repr__(self):
+        return f'<ArchivedMonth {self.month:%Y-%m}>'
+
+class ArchivedMonthlyStay(db.Model):
+    """アーカイブした月の、ユーザーごとの滞在時間の合計"""
+    __tablename__ = 'archived_monthly_stay'
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    month = db.Column(db.Date, primary_key=True) # 月の初日
+    seconds = db.Column(db.Float, nullable=False, default=0)
+    session_count = db.Column(db.Integer, nullable=False, default=0)
+
+class LiveEventRecord(db.Model):
+    """
+    複数のワーカープロセスで動かすときに、カードリーダーを担当するプロセスが流した
+    ライブフィードのイベント（id がイベントの連番）。ほかのプロセスはこれを読んで
+    自分の購読者へ流す。新しいものから LIVE_FEED_MAX_EVENTS 件だけ残す。
+    """
+    __tablename__ = 'live_events'
+    id = db.Column(db.Integer, primary_key=True)
+    type = db.Column(db.String(20), nullable=False)
+    data = db.Column(db.Text, nullable=False)
+
+class TapJournalCheckpoint(db.Model):
+    """タップジャーナルのうちデータベースに反映済みの最大 seq（1行だけのテーブル）"""
+    __tablename__ = 'tap_journal_checkpoint'
+    id = db.Column(db.Integer, primary_key=True)
+    last_seq = db.Column(db.Integer, nullable=False, default=0)
+
+def migrate_schema():
+    """
+    データベースのスキーマを最新のバージョンにします（migrations.py を参照）。
+    既存の instance/access_log.db もその場で更新されるため、起動時に呼び出すこと。
+    """
+    migrations.migrate(db.engine)
+
+@app.cli.command('migrate-db')
+def migrate_db_command():
+    """データベースのスキーマを最新にする（flask --app app migrate-db）"""
+    with db.engine.connect() as conn:
+        version = migrations.current_version(conn)
+    applied = migrations.migrate(db.engine)
+    print(f"スキーマのバージョン: {version} → {version + applied}")
 
 # --- Discord ウェブフックURLを設定 ---
 DISCORD_WEBHOOK_URL = "https://discordapp.com/api/webhooks/1393286247258128404/XjqQlaaFHl3Xfa3zLSuMpk97UR_zlX1uYRzBu3XBiyQPbpOH-exNAY98IN44CCd9oFew"
+# システム監視用（自動退室など）の通知先。別チャンネルにしたい場合は変更する
+DISCORD_SYSTEM_MONITOR_WEBHOOK_URL = DISCORD_WEBHOOK_URL
+
+# 未送信の通知を保存するディレクトリ（オフライン中や再起動をまたいでも通知を失わない）
+NOTIFICATION_SPOOL_DIR = os.path.join(app.instance_path, 'notification_spool')
+
+# 通知はバックグラウンドのディスパッチャから送信する（タップ処理やWebのレスポンスを止めない）
+notifier = DiscordNotifier(DISCORD_WEBHOOK_URL, spool_dir=NOTIFICATION_SPOOL_DIR)
 
 def send_discord_notification(username, event_type, success=True, details=None):
     if not DISCORD_WEBHOOK_URL:
@@ -134,17 +286,21 @@ def send_discord_notification(username, event_type, success=True, details=None):
         description = f"{current_time}: 不明なイベントが発生しました。"
         color = 7829367
 
+    fields = [
+        {"name": "ユーザー名", "value": username, "inline": True},
+        {"name": "時刻", "value": current_time, "inline": True},
+        {"name": "結果", "value": "成功" if success else "失敗", "inline": True}
+    ]
+    if details and details.get('door'):
+        fields.append({"name": "場所", "value": details['door'], "inline": True})
+
     payload = {
         "embeds": [
             {
                 "title": title,
                 "description": description,
                 "color": color,
-                "fields": [
-                    {"name": "ユーザー名", "value": username, "inline": True},
-                    {"name": "時刻", "value": current_time, "inline": True},
-                    {"name": "結果", "value": "成功" if success else "失敗", "inline": True}
-                ],
+                "fields": fields,
                 "footer": {
                     "text": "Raspberry Pi アクセス制御システム"
                 },
@@ -153,90 +309,1358 @@ def send_discord_notification(username, event_type, success=True, details=None):
         ]
     }
 
-    headers = {"Content-Type": "application/json"}
-    try:
-        response = requests.post(DISCORD_WEBHOOK_URL, data=json.dumps(payload), headers=headers)
-        response.raise_for_status()
-        print(f"Discord 通知を送信しました: {title} - {username}")
-    except requests.exceptions.RequestException as e:
-        print(f"Discord 通知の送信中にエラーが発生しました: {e}")
-        print(f"レスポンス内容: {response.text if 'response' in locals() else 'N/A'}")
+    notifier.notify(payload)
 
+def send_discord_message(webhook_url, message, username=None, coalesce_key=None):
+    """
+    システムからのメッセージを通知します。
+    coalesce_key が同じメッセージは短時間にまとめて1件の通知になります。
+    """
+    payload = {
+        "embeds": [
+            {
+                "title": "システム通知",
+                "description": message,
+                "color": 7829367,
+                "footer": {
+                    "text": "Raspberry Pi アクセス制御システム"
+                },
+                "timestamp": datetime.utcnow().isoformat() + "Z"
+            }
+        ]
+    }
+    if username:
+        payload["username"] = username
+    notifier.notify(payload, coalesce_key=coalesce_key, webhook_url=webhook_url)
+
+
+# --- カード読み取りと処理 ---
+# 同じカードの連続読み取りを無視する秒数（他のカードは待たされない）
+CARD_DEBOUNCE_SECONDS = 5
+
+# --- カードリーダーの設定 ---
+# リーダー名に match の文字列を含むリーダーごとにワーカーが起動します。
+# 先に書いた設定が優先されます。mode は 'toggle'（入室/退室を切り替え）、
+# '入室' または '退室'（そのリーダーでは常にその状態を記録）。
+# 例: 入口と出口で別のリーダーを使う場合
+#   ReaderConfig(match='PaSoRi 3.0 00', door='正面入口', mode='入室'),
+#   ReaderConfig(match='PaSoRi 3.0 01', door='正面出口', mode='退室'),
+CARD_READERS = [
+    ReaderConfig(match=('PaSoRi', 'FeliCa'), door=None, mode='toggle'),
+]
+
+# --- IDm → ユーザー・入退室状態のキャッシュ ---
+user_cache = UserPresenceCache()
+
+# --- 集計結果（ランキング・カレンダー）のキャッシュ ---
+# タップの書き込み・ユーザーの編集・ログの削除・自動退室のたびにデータバージョンが上がり、
+# それまでの結果は捨てられる。タップがない間のダッシュボードの表示はキャッシュから返す。
+result_cache = ResultCache(shared=worker_state)
+
+def load_user_cache(verbose=True):
+    """
+    全ユーザーと各ユーザーの最新ステータスをキャッシュに読み込みます。
+    app_context 内で呼び出すこと。
+    """
+    last_statuses = dict(db.session.query(Presence.user_id, Presence.status))
+    users = db.session.query(User.id, User.idm, User.name).all()
+    user_cache.load(users, last_statuses)
+    if verbose:
+        print(f"ユーザーキャッシュを読み込みました: {len(users)}人")
+
+# --- 滞在セッションの更新 ---
+def apply_logs_to_sessions(entries):
+    """
+    (user_id, status, timestamp, auto_closed) のリストを時刻順に sessions テーブルへ反映します。
+    ランキングの従来の集計と同じく、入室が続いた場合は後の入室を開始時刻とし、
+    対応する入室がない退室は無視します。コミットは呼び出し元で行うこと。
+    閉じたセッションの (user_id, 入室時刻, 退室時刻) のリストを返します。
+    """
+    user_ids = {user_id for user_id, _, _, _ in entries}
+    open_sessions = {
+        session.user_id: session
+        for session in StaySession.query.filter(
+            StaySession.user_id.in_(user_ids),
+            StaySession.exit_ts.is_(None)
+        )
+    }
+    presence = defaultdict(set)  # {日付: その日に在室したユーザーID}
+    closed = []
+    for user_id, status, timestamp, auto_closed in entries:
+        session = open_sessions.get(user_id)
+        if status == '入室':
+            presence[timestamp.date()].add(user_id)
+            if session:
+                session.entry_ts = timestamp
+            else:
+                session = StaySession(user_id=user_id, entry_ts=timestamp, auto_closed=False)
+                db.session.add(session)
+                open_sessions[user_id] = session
+        elif status == '退室' and session:
+            session.exit_ts = timestamp
+            session.duration_seconds = (timestamp - session.entry_ts).total_seconds()
+            session.auto_closed = bool(auto_closed)
+            del open_sessions[user_id]
+            add_to_daily_stay(user_id, session.entry_ts, timestamp)
+            closed.append((user_id, session.entry_ts, timestamp))
+            for day, _ in split_stay_by_day(session.entry_ts, timestamp):
+                presence[day].add(user_id)
+    mark_presence(presence)
+    return closed
+
+def apply_logs_to_presence(entries):
+    """
+    (user_id, status, timestamp, auto_closed) のリストを presence テーブルへ反映します。
+    ユーザーごとに最後のログだけを書き込みます（既にそれより新しい状態があれば変更しない）。
+    コミットは呼び出し元で行うこと。
+    """
+    latest = {}
+    for user_id, status, timestamp, _ in entries:
+        latest[user_id] = {'user_id': user_id, 'status': status, 'since': timestamp}
+    if not latest:
+        return
+    statement = sqlite_insert(Presence)
+    db.session.execute(statement.on_conflict_do_update(
+        index_elements=['user_id'],
+        set_={'status': statement.excluded.status, 'since': statement.excluded.since},
+        where=statement.excluded.since >= Presence.since
+    ), list(latest.values()))
+
+def split_stay_by_day(entry_ts, exit_ts):
+    """滞在を日付ごとに分割し、(日付, 秒数) を順に返します。"""
+    day_start = datetime.combine(entry_ts.date(), datetime.min.time())
+    while True:
+        next_day = day_start + timedelta(days=1)
+        start = max(entry_ts, day_start)
+        end = min(exit_ts, next_day)
+        if end > start or (start == end == entry_ts):
+            yield day_start.date(), (end - start).total_seconds()
+        if exit_ts <= next_day:
+            break
+        day_start = next_day
+
+def add_to_daily_stay(user_id, entry_ts, exit_ts):
+    """閉じたセッションを daily_stay に加算します。コミットは呼び出し元で行うこと。"""
+    for day, seconds in split_stay_by_day(entry_ts, exit_ts):
+        statement = sqlite_insert(DailyStay).values(
+            user_id=user_id, date=day, seconds=seconds, session_count=1)
+        db.session.execute(statement.on_conflict_do_update(
+            index_elements=['user_id', 'date'],
+            set_={'seconds': DailyStay.seconds + seconds,
+                  'session_count': DailyStay.session_count + 1}))
+
+def daily_stay_from_sessions(archived_ranges):
+    """
+    閉じた滞在セッションから {(user_id, 日付): [秒数, セッション数]} を計算します。
+    アーカイブ済みの月の日は（合計をアーカイブ側で持っているため）含めません。
+    """
+    totals = defaultdict(lambda: [0.0, 0])
+    closed_sessions = db.session.query(
+        StaySession.user_id, StaySession.entry_ts, StaySession.exit_ts
+    ).filter(StaySession.exit_ts.isnot(None)).execution_options(yield_per=1000)
+    for user_id, entry_ts, exit_ts in closed_sessions:
+        for day, seconds in split_stay_by_day(entry_ts, exit_ts):
+            if _in_ranges(day, archived_ranges):
+                continue
+            total = totals[(user_id, day)]
+            total[0] += seconds
+            total[1] += 1
+    return totals
+
+def rebuild_daily_stay():
+    """
+    閉じた滞在セッションから daily_stay を作り直します（アーカイブ済みの月は除く）。
+    app_context 内で呼び出すこと。作成した行数を返します。
+    """
+    archived_ranges = archived_month_ranges()
+    DailyStay.query.filter(
+        _outside_ranges(DailyStay.date, archived_ranges)).delete(synchronize_session=False)
+    totals = daily_stay_from_sessions(archived_ranges)
+    db.session.bulk_insert_mappings(DailyStay, [
+        {'user_id': user_id, 'date': day, 'seconds': seconds, 'session_count': count}
+        for (user_id, day), (seconds, count) in totals.items()
+    ])
+    db.session.commit()
+    result_cache.invalidate_all()
+    print(f"日ごとの滞在時間を集計しました: {len(totals)}行")
+    return len(totals)
+
+# --- 日ごとの在室者の索引 ---
+def _user_ids_to_bitmap(user_ids):
+    bits = 0
+    for user_id in user_ids:
+        bits |= 1 << user_id
+    return bits
+
+def _bitmap_to_bytes(bits):
+    return bits.to_bytes((bits.bit_length() + 7) // 8, 'little')
+
+def bitmap_user_ids(data):
+    """在室者のビットマップからユーザー ID を昇順に返します。"""
+    bits = int.from_bytes(data or b'', 'little')
+    user_ids = []
+    while bits:
+        lowest = bits & -bits
+        user_ids.append(lowest.bit_length() - 1)
+        bits ^= lowest
+    return user_ids
+
+def mark_presence(presence):
+    """
+    {日付: ユーザーIDの集合} を daily_presence に追加します。
+    入室した日と、閉じたセッションがかかるすべての日が在室日になります。
+    コミットは呼び出し元で行うこと。
+    """
+    if not presence:
+        return
+    rows = {row.date: row for row in DailyPresence.query.filter(DailyPresence.date.in_(list(presence)))}
+    for day, user_ids in presence.items():
+        bits = _user_ids_to_bitmap(user_ids)
+        row = rows.get(day)
+        if row is None:
+            db.session.add(DailyPresence(date=day, user_bitmap=_bitmap_to_bytes(bits)))
+        else:
+            row.user_bitmap = _bitmap_to_bytes(int.from_bytes(row.user_bitmap, 'little') | bits)
+
+def _presence_rows_with_user(user_id):
+    """
+    user_id のビットが立っている daily_presence の行を選ぶクエリ。
+    ビットを含む1バイトを SQL で取り出し、そのビットが立つ 128 通りの値と比べるので、
+    該当しない日の行は読み込みもデコードもしません。
+    """
+    bit = 1 << (user_id % 8)
+    values = [bytes([value]) for value in range(256) if value & bit]
+    return DailyPresence.query.filter(
+        db.func.substr(DailyPresence.user_bitmap, user_id // 8 + 1, 1).in_(values))
+
+def remove_user_from_presence(user_id):
+    """ユーザーを全日の在室者から外します。コミットは呼び出し元で行うこと。"""
+    mask = ~(1 << user_id)
+    for row in _presence_rows_with_user(user_id):
+        bits = int.from_bytes(row.user_bitmap, 'little')
+        row.user_bitmap = _bitmap_to_bytes(bits & mask)
+
+def rebuild_daily_presence():
+    """
+    入室ログと閉じた滞在セッションから daily_presence を作り直します。
+    アーカイブ済みの月の日は元のデータが DB にないため、そのまま残します。
+    app_context 内で呼び出すこと。作成した日数を返します。
+    """
+    archived_ranges = archived_month_ranges()
+    DailyPresence.query.filter(
+        _outside_ranges(DailyPresence.date, archived_ranges)).delete(synchronize_session=False)
+    presence = defaultdict(int)
+    entry_days = db.session.query(
+        AccessLog.user_id, db.func.date(AccessLog.timestamp)
+    ).filter(AccessLog.status == '入室').distinct().execution_options(yield_per=1000)
+    for user_id, day in entry_days:
+        day = date.fromisoformat(day)
+        if not _in_ranges(day, archived_ranges):
+            presence[day] |= 1 << user_id
+    closed_sessions = db.session.query(
+        StaySession.user_id, StaySession.entry_ts, StaySession.exit_ts
+    ).filter(StaySession.exit_ts.isnot(None)).execution_options(yield_per=1000)
+    for user_id, entry_ts, exit_ts in closed_sessions:
+        for day, _ in split_stay_by_day(entry_ts, exit_ts):
+            if not _in_ranges(day, archived_ranges):
+                presence[day] |= 1 << user_id
+    db.session.bulk_insert_mappings(DailyPresence, [
+        {'date': day, 'user_bitmap': _bitmap_to_bytes(bits)} for day, bits in presence.items()
+    ])
+    db.session.commit()
+    result_cache.invalidate_all()
+    print(f"日ごとの在室者を集計しました: {len(presence)}日")
+    return len(presence)
+
+# SQLite に文字列で保存された日時を UNIX 秒（小数部あり）に変換する SQL 式
+def _epoch_seconds_sql(column):
+    return f"(CAST(strftime('%s', {column}) AS INTEGER) + COALESCE(CAST(substr({column}, 20) AS REAL), 0))"
+
+def _sql_datetime(value):
+    """SQLAlchemy が SQLite に保存するのと同じ形式の日時文字列"""
+    return value.strftime('%Y-%m-%d %H:%M:%S.%f')
+
+# ユーザーごとに時刻順に並べたログに、直前・直後のログの情報を付けた CTE。
+# 「直前が入室の退室」が閉じたセッション、「最後のログが入室」が未退室のセッションになる
+# （入室が続いた場合は後の入室が使われ、対応する入室がない退室は無視される）。
+_PAIRED_LOGS_CTE = """
+    paired AS (
+        SELECT user_id, status, timestamp,
+               LAG(status) OVER w AS prev_status,
+               LAG(timestamp) OVER w AS prev_timestamp,
+               LEAD(id) OVER w AS next_id
+        FROM access_log
+        {where}
+        WINDOW w AS (PARTITION BY user_id ORDER BY timestamp, id)
+    )
+"""
+
+def backfill_sessions():
+    """
+    既存の AccessLog から sessions テーブルを作り直します。
+    ペアの組み立ては SQL のウィンドウ関数で行い、ログを Python に読み込みません。
+    app_context 内で呼び出すこと。作成したセッション数を返します。
+    """
+    StaySession.query.delete()
+    db.session.execute(db.text(
+        "WITH " + _PAIRED_LOGS_CTE.format(where='') + f"""
+        INSERT INTO sessions (user_id, entry_ts, exit_ts, duration_seconds, auto_closed)
+        SELECT user_id, prev_timestamp, timestamp,
+               {_epoch_seconds_sql('timestamp')} - {_epoch_seconds_sql('prev_timestamp')}, 0
+        FROM paired WHERE status = '退室' AND prev_status = '入室'
+        UNION ALL
+        SELECT user_id, timestamp, NULL, NULL, 0
+        FROM paired WHERE status = '入室' AND next_id IS NULL
+        """))
+    db.session.commit()
+    rebuild_daily_stay()
+    rebuild_daily_presence()
+    count = StaySession.query.count()
+    print(f"滞在セッションを作成しました: {count}件")
+    return count
+
+def ensure_sessions_backfilled():
+    """sessions / daily_stay / daily_presence テーブルが空でデータがある場合だけ一度作成します。"""
+    if StaySession.query.first() is None and AccessLog.query.filter_by(status='入室').first():
+        backfill_sessions()
+        return
+    if DailyStay.query.first() is None and StaySession.query.filter(StaySession.exit_ts.isnot(None)).first():
+        rebuild_daily_stay()
+    if DailyPresence.query.first() is None and StaySession.query.first():
+        rebuild_daily_presence()
+
+@app.cli.command('backfill-sessions')
+def backfill_sessions_command():
+    """AccessLog から滞在セッションを作り直す（flask --app app backfill-sessions）"""
+    backfill_sessions()
+
+@app.cli.command('rebuild-daily-stay')
+def rebuild_daily_stay_command():
+    """滞在セッションから日ごとの滞在時間を作り直す（flask --app app rebuild-daily-stay）"""
+    rebuild_daily_stay()
+
+@app.cli.command('rebuild-presence')
+def rebuild_presence_command():
+    """入室ログと滞在セッションから日ごとの在室者を作り直す（flask --app app rebuild-presence）"""
+    rebuild_daily_presence()
+
+# 実行計画で全件スキャンになっていないことを確認するテーブル
+_INDEXED_TABLES = ('access_log', 'sessions', 'daily_stay')
+
+@app.cli.command('check-query-plans')
+def check_query_plans_command():
+    """
+    よく実行されるクエリが、インデックスを使っているか EXPLAIN QUERY PLAN で確認する
+    （flask --app app check-query-plans）。全件スキャンがあれば終了コード 1 で終わる。
+    """
+    today = datetime.now()
+    month_start = datetime(today.year, today.month, 1)
+    month_end = datetime(today.year + (today.month == 12), today.month % 12 + 1, 1)
+    week_start = datetime.combine(today.date() - timedelta(days=today.weekday()), datetime.min.time())
+    hot_queries = [
+        ('最新ステータスの読み込み (load_user_cache)', load_user_cache),
+        ('現在の在室者 (/api/presence)', load_current_presence),
+        ('未退室のセッション (auto_sign_out)', lambda: find_open_sessions(today)),
+        ('最新の入退室履歴', lambda: _load_latest_logs(20)),
+        ('期間内のログ (iter_access_log_tuples)', lambda: list(iter_access_log_tuples(month_start, month_end))),
+        ('期間内の滞在時間 (stay_totals_from_logs)', lambda: stay_totals_from_logs(week_start, today)),
+        ('今月のランキング (daily_stay)', lambda: _stay_time_ranking(month_start.date(), month_end.date())),
+        ('未退室のセッション', lambda: apply_logs_to_sessions([])),
+        ('入退室履歴の深いページ', lambda: query_access_history(after=(month_start, 1 << 62))),
+        ('ユーザーごとの入退室履歴の深いページ',
+         lambda: query_access_history(user_id=1, status='入室', start=datetime.min, after=(month_start, 1 << 62))),
+    ]
+
+    problems = 0
+    for label, run in hot_queries:
+        statements = []
+
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            if not statement.startswith('EXPLAIN'):
+                statements.append((statement, parameters))
+
+        event.listen(db.engine, 'before_cursor_execute', capture)
+        try:
+            run()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', capture)
+        db.session.rollback()
+
+        print(f"--- {label} ---")
+        for statement, parameters in statements:
+            plan = db.session.connection().exec_driver_sql(
+                'EXPLAIN QUERY PLAN ' + statement, parameters).all()
+            for row in plan:
+                detail = row[-1]
+                words = detail.split()
+                full_scan = (len(words) >= 2 and words[0] == 'SCAN'
+                             and words[1] in _INDEXED_TABLES and 'INDEX' not in detail)
+                problems += full_scan
+                print(f"  {'NG' if full_scan else 'OK'}  {detail}")
+    if problems:
+        print(f"インデックスを使っていないスキャンが {problems} 件あります。")
+        sys.exit(1)
+    print("すべてのクエリがインデックスを使っています。")
+
+@app.cli.command('verify-stay-times')
+def verify_stay_times_command():
+    """
+    sessions テーブルの集計とログからの SQL 集計、および daily_stay と
+    sessions から計算し直した日ごとの滞在時間が一致するか確認する
+    """
+    now = datetime.now()
+    periods = [('全期間', None, None)]
+    for offset in range(3):
+        year, month = now.year, now.month - offset
+        while month < 1:
+            year, month = year - 1, month + 12
+        start = datetime(year, month, 1)
+        end = datetime(year + 1, 1, 1) if month == 12 else datetime(year, month + 1, 1)
+        periods.append((f"{year}年{month}月", start, end))
+
+    mismatches = 0
+    for label, start, end in periods:
+        expected = {r['user_id']: r['total_seconds'] for r in stay_totals_from_logs(start, end)}
+        actual = {r['user_id']: r['total_seconds'] for r in _session_ranking(start, end)}
+        for user_id in set(expected) | set(actual):
+            if abs(expected.get(user_id, 0) - actual.get(user_id, 0)) > 0.001:
+                mismatches += 1
+                print(f"{label}: ユーザー {user_id} の滞在時間が一致しません "
+                      f"(ログ: {expected.get(user_id)}, セッション: {actual.get(user_id)})")
+
+    expected = {key: seconds for key, (seconds, _) in daily_stay_from_sessions(archived_month_ranges()).items()}
+    actual = {(user_id, day): seconds for user_id, day, seconds in
+              db.session.query(DailyStay.user_id, DailyStay.date, DailyStay.seconds)}
+    for key in set(expected) | set(actual):
+        if abs(expected.get(key, 0) - actual.get(key, 0)) > 0.001:
+            mismatches += 1
+            print(f"{key[1]}: ユーザー {key[0]} の daily_stay が一致しません "
+                  f"(セッション: {expected.get(key)}, daily_stay: {actual.get(key)})")
+    print("一致しました。" if mismatches == 0 else f"{mismatches}件の不一致があります。")
+
+# --- タップジャーナル ---
+# タップはまずジャーナルファイルに追記し、フラッシャーがまとめて AccessLog に書き込む
+TAP_JOURNAL_PATH = os.path.join(app.instance_path, 'tap_journal.jsonl')
+TAP_JOURNAL_FLUSH_INTERVAL = 0.5 # 秒
+
+def write_tap_batch(entries):
+    """ジャーナルのエントリをまとめて1つのトランザクションで AccessLog に書き込みます。"""
+    with app.app_context(), TAP_STAGE_SECONDS.time(stage='db_commit'):
+        try:
+            logs = [
+                AccessLog(user_id=entry['user_id'],
+                          status=entry['status'],
+                          reader=entry.get('reader'),
+                          timestamp=datetime.fromisoformat(entry['timestamp']))
+                for entry in entries
+            ]
+            db.session.add_all(logs)
+            # 同じトランザクションで滞在セッションと現在の在室状態も更新する
+            applied = [
+                (log.user_id, log.status, log.timestamp, entry.get('auto_closed', False))
+                for log, entry in zip(logs, entries)
+            ]
+            closed = apply_logs_to_sessions(applied)
+            apply_logs_to_presence(applied)
+            checkpoint = db.session.get(TapJournalCheckpoint, 1)
+            if checkpoint is None:
+                checkpoint = TapJournalCheckpoint(id=1, last_seq=0)
+                db.session.add(checkpoint)
+            checkpoint.last_seq = entries[-1]['seq']
+            db.session.commit()
+            result_cache.bump()
+        except OperationalError as e:
+            db.session.rollback()
+            if 'locked' in str(e):
+                DB_LOCK_WAITS_TOTAL.inc()
+            raise
+        except Exception:
+            db.session.rollback()
+            raise
+    TAP_BATCH_SIZE.observe(len(entries))
+    publish_live_events(applied, closed, readers=[entry.get('reader') for entry in entries])
+
+tap_journal = TapJournal(TAP_JOURNAL_PATH, write_tap_batch, flush_interval=TAP_JOURNAL_FLUSH_INTERVAL)
+
+REGISTRY.gauge('tap_journal_pending', 'Taps in the journal not yet written to the database.',
+               callback=tap_journal.pending_count)
+def count_present_users():
+    """presence テーブルの在室中の人数（どのワーカーでも同じ値になるよう、キャッシュではなく DB から数える）"""
+    with app.app_context():
+        return db.session.query(db.func.count(Presence.user_id)).filter(Presence.status == '入室').scalar()
+
+REGISTRY.gauge('occupancy_current', 'Users currently inside (from the presence table).',
+               callback=count_present_users)
+REGISTRY.gauge('notification_spool_pending', 'Discord notifications waiting in the spool.',
+               callback=notifier.pending_count)
+
+def replay_tap_journal():
+    """
+    ジャーナルを開き、前回終了時にデータベースへ反映されていなかったタップを書き込みます。
+    app_context 内で呼び出すこと。
+    """
+    if tap_journal.is_open:
+        return
+    checkpoint = db.session.get(TapJournalCheckpoint, 1)
+    tap_journal.open(checkpoint.last_seq if checkpoint else 0)
+    replayed = tap_journal.flush()
+    if replayed:
+        print(f"タップジャーナルから {replayed} 件のタップを復元しました。")
+
+def init_tap_pipeline():
+    """タップ処理に必要なジャーナルの復元・キャッシュの読み込み・フラッシャーの起動を行います。"""
+    with app.app_context():
+        ensure_sessions_backfilled()
+        replay_tap_journal()
+        # 複数ワーカーでは、リーダーになる前に読み込んだキャッシュが古いことがあるため読み込み直す
+        if not user_cache.loaded or worker_state is not None:
+            load_user_cache()
+    tap_journal.start()
+
+# 複数のリーダーのワーカーからジャーナルへ書き込む際の排他ロック。
+# キャッシュでの判定とジャーナルへの追記の順序を一致させるために使う。
+# 複数ワーカーの場合は、ほかのプロセスでのユーザーの削除やログの削除とも排他するため、
+# ファイルロックも使う（リーダーのタップは、削除が終わるまで待つ）
+TAP_WRITE_LOCK_PATH = os.path.join(app.instance_path, 'tap_write.lock')
+tap_write_lock = ProcessLock(TAP_WRITE_LOCK_PATH) if worker_state is not None else threading.Lock()
+
+def handle_card_tap(idm, reader=None):
+    """
+    カードがかざされた時に各リーダーのワーカーから呼ばれ、入室/退室を記録します。
+    reader は card_reader.ReaderInfo（どのリーダーでかざされたか）。
+    記録した場合は (ユーザー名, 新しい状態) を、未登録のカードの場合は None を返します。
+    リーダーやループに依存しないので、tap_bench.py などから直接呼び出せます。
+    """
+    door = reader.door if reader else None
+    forced_status = reader.mode if reader and reader.mode != 'toggle' else None
+
+    with TAP_STAGE_SECONDS.time(stage='total'):
+        with tap_write_lock:
+            sync_user_cache()
+            with TAP_STAGE_SECONDS.time(stage='decide'):
+                decision = user_cache.decide(idm, forced_status=forced_status)
+            if decision is not None:
+                user, new_status, previous_status = decision
+                try:
+                    # ジャーナルに追記できた時点でタップは確定（DBへはフラッシャーが書き込む）
+                    with TAP_STAGE_SECONDS.time(stage='journal_append'):
+                        tap_journal.append({
+                            'user_id': user.user_id,
+                            'status': new_status,
+                            'reader': door,
+                            'timestamp': datetime.now().isoformat(),
+                        })
+                except Exception:
+                    # 書き込みに失敗した場合はキャッシュの状態を元に戻す
+                    user_cache.set_status(user.user_id, previous_status)
+                    raise
+
+        with TAP_STAGE_SECONDS.time(stage='notify'):
+            if decision is None:
+                print(f"Unknown card detected! IDm: {idm} ({door})")
+                UNKNOWN_CARDS_TOTAL.inc()
+                send_discord_notification("不明なユーザー", "アクセス試行", success=False, details={'door': door})
+                return None
+
+            print(f"Access recorded: {user.name} - {new_status} ({door})")
+            TAPS_TOTAL.inc(status=new_status, door=door or '')
+            send_discord_notification(user.name, new_status, success=True, details={'door': door})
+            return user.name, new_status
+
+# カード読み取りスレッドを止めるためのイベント
+card_reader_stop_event = threading.Event()
 
-# --- カード読み取りと処理のメインループ（別スレッドで実行） ---
 def card_reading_loop():
-    while True:
-        idm = read_felica_card_idm()
-        if idm:
-            with app.app_context():
-                user = User.query.filter_by(idm=idm).first()
-                if user:
-                    last_log = AccessLog.query.filter_by(user_id=user.id)\
-                                 .order_by(AccessLog.timestamp.desc()).first()
-                    
-                    if last_log and last_log.status == '入室':
-                        new_status = '退室'
-                    else:
-                        new_status = '入室'
-                    
-                    log_entry = AccessLog(user_id=user.id, status=new_status)
-                    db.session.add(log_entry)
-                    db.session.commit()
+    """
+    カードリーダーを一度だけ開き、カードのかざしイベントを待ち受けるスレッド。
+    ポーリングや固定のスリープは行わず、同一IDmの連続読み取りだけを抑制します。
+    実際の読み取りと記録はリーダーごとのワーカースレッドで並行して行われます。
+    """
+    init_tap_pipeline()
 
-                    print(f"Access recorded: {user.name} - {new_status}")
-                    send_discord_notification(user.name, new_status, success=True)
-                else:
-                    print(f"Unknown card detected! IDm: {idm}")
-                    send_discord_notification("不明なユーザー", "アクセス試行", success=False)
-            
-            time.sleep(5)
-        time.sleep(0.5)
+    service = CardReaderService(on_tap=handle_card_tap, reader_configs=CARD_READERS,
+                                debounce_seconds=CARD_DEBOUNCE_SECONDS)
+    service.start()
+    try:
+        card_reader_stop_event.wait()
+    finally:
+        service.stop()
+
+# --- 複数ワーカーでのプロセス間の連携 ---
+# カードリーダー・タップジャーナル・定期実行タスク・通知の送信は、リーダーのロックを持つ
+# 1つのプロセス（リーダー）だけが受け持つ。ほかのプロセスでのユーザーの変更やジャーナルの
+# 書き込み依頼は共有カウンタで知らせ、リーダーの worker_sync_loop() が反映する。
+LEADER_LOCK_PATH = os.path.join(app.instance_path, 'leader.lock')
+leader_lock = LeaderLock(LEADER_LOCK_PATH)
+TAP_JOURNAL_FLUSH_WAIT = 5 # 秒。リーダーにジャーナルの書き込みを頼んだときに待つ時間
+_user_cache_version = 0 # リーダーのユーザーキャッシュに反映済みの 'users' カウンタ
+
+def notify_users_changed():
+    """ユーザーの追加・変更・削除やログの削除を、カードリーダーを担当するプロセスに知らせます。"""
+    if worker_state is not None:
+        worker_state.increment('users')
+
+def sync_user_cache():
+    """
+    ほかのプロセスでユーザーが変更されていれば、未反映のタップを書き込んでから
+    ユーザーキャッシュを読み込み直します。リーダーでタップを判定する直前に、
+    tap_write_lock を持ったまま呼ぶこと（削除を待っていた間の変更も反映するため）。
+    """
+    global _user_cache_version
+    if worker_state is None:
+        return
+    version = worker_state.get('users')
+    if version == _user_cache_version:
+        return
+    tap_journal.flush()
+    with app.app_context():
+        load_user_cache()
+    _user_cache_version = version
 
-# --- 滞在時間計算ヘルパー関数 ---
-def _calculate_stay_time_for_logs(logs):
+def flush_tap_journal():
+    """
+    未反映のタップをデータベースへ書き込みます。書き込めた場合は True を返します。
+    カードリーダーを担当していないプロセスでは、リーダーに書き込みを頼み、終わるまで
+    最大 TAP_JOURNAL_FLUSH_WAIT 秒待ちます（リーダーが応答しなければ False）。
+    タップと削除の間に新しいタップが割り込まないよう、tap_write_lock を持って呼ぶこと。
+    """
+    if worker_state is None or leader_lock.held:
+        try:
+            tap_journal.flush()
+        except Exception as e:
+            print(f"タップジャーナルの書き込みに失敗しました: {e}")
+            return False
+        return True
+    requested = worker_state.increment('flush_requested')
+    deadline = time.monotonic() + TAP_JOURNAL_FLUSH_WAIT
+    while worker_state.get('flush_done') < requested:
+        if time.monotonic() >= deadline:
+            print("タップジャーナルの書き込みを待つ時間が過ぎました（リーダーが応答していません）。")
+            return False
+        time.sleep(0.05)
+    return True
+
+# --- ライブフィード（Server-Sent Events） ---
+# タップの書き込み（と自動退室）のコミット後に、新しい入退室・在室状態の変化・
+# ランキングが変わったユーザーの合計を /api/live の購読者へ流す。
+# ダッシュボードはこれを受け取ってページを再読み込みせずに書き換える。
+LIVE_FEED_KEEPALIVE = 15 # 秒。プロキシなどに切断されないよう、この間隔でコメント行を送る
+LIVE_FEED_RETRY_MS = 5000 # 切断されたときにブラウザが再接続するまでの時間
+LIVE_FEED_MAX_EVENTS = 500
+# 複数ワーカーの場合は接続1本がワーカーのスレッドを1本使うため、gunicorn.conf.py がスレッド数に合わせて減らす
+LIVE_FEED_MAX_SUBSCRIBERS = int(os.environ.get('ACCESS_CONTROL_LIVE_FEED_SUBSCRIBERS', '50'))
+# 複数ワーカーの場合は全プロセスで同じ stream_id を使い、どのプロセスに再接続しても続きから受け取れるようにする
+live_feed = LiveFeed(max_events=LIVE_FEED_MAX_EVENTS, max_subscribers=LIVE_FEED_MAX_SUBSCRIBERS,
+                     stream_id=worker_state.token[:8] if worker_state else None)
+
+REGISTRY.gauge('live_feed_subscribers', 'Browsers connected to the /api/live event stream.',
+               callback=live_feed.subscriber_count)
+
+def current_ranking_periods(today=None):
+    """ダッシュボードの今週・今月のランキングの期間 ((週の開始日, 終了日), (月の開始日, 終了日))"""
+    today = today or date.today()
+    week_start = today - timedelta(days=today.weekday())
+    month_start = today.replace(day=1)
+    month_end = date(today.year + 1, 1, 1) if today.month == 12 else date(today.year, today.month + 1, 1)
+    return (week_start, week_start + timedelta(days=7)), (month_start, month_end)
+
+def ranking_totals_for_users(user_ids):
+    """
+    指定したユーザーの今週・今月・全期間の滞在時間の合計を {user_id: {...}} で返します。
+    差分ではなく合計を送るので、ブラウザが同じイベントを2回受け取っても結果は変わりません。
+    """
+    user_ids = list(user_ids)
+    (week_start, week_end), (month_start, month_end) = current_ranking_periods()
+    totals = {user_id: {'weekly': 0.0, 'monthly': 0.0, 'total': 0.0} for user_id in user_ids}
+    base = db.session.query(DailyStay.user_id, db.func.sum(DailyStay.seconds)).filter(
+        DailyStay.user_id.in_(user_ids)).group_by(DailyStay.user_id)
+    for key, query in (
+        ('weekly', base.filter(DailyStay.date >= week_start, DailyStay.date < week_end)),
+        ('monthly', base.filter(DailyStay.date >= month_start, DailyStay.date < month_end)),
+        ('total', base),
+    ):
+        for user_id, seconds in query:
+            totals[user_id][key] = seconds
+    # アーカイブした月の合計は全期間のランキングにだけ入る（今月がアーカイブされることはない）
+    for user_id, seconds in db.session.query(
+            ArchivedMonthlyStay.user_id, db.func.sum(ArchivedMonthlyStay.seconds)
+    ).filter(ArchivedMonthlyStay.user_id.in_(user_ids)).group_by(ArchivedMonthlyStay.user_id):
+        totals[user_id]['total'] += seconds
+    return totals
+
+def _cached_user_name(user_id):
+    user = user_cache.get_by_id(user_id)
+    return display_user_name(user_id, user.name if user else None)
+
+def publish_live_events(applied, closed, readers=None):
+    """
+    コミットした (user_id, status, timestamp, auto_closed) のリストと、閉じたセッションの
+    (user_id, 入室時刻, 退室時刻) のリストを、ライブフィードのイベントにして流します。
+    readers は applied と同じ順の記録したリーダー（ドア名）のリスト。
+    書き込みはコミット済みなので、ここでの失敗は表示が遅れるだけにとどめる
+    （例外を返すとジャーナルが同じタップを書き込み直してしまう）。
+    """
+    if not applied:
+        return
+    try:
+        _publish_live_events(applied, closed, readers or [None] * len(applied))
+    except Exception as e:
+        print(f"ライブフィードへのイベントの送信に失敗しました: {e}")
+
+def _publish_live_events(applied, closed, readers):
+    names = {user_id: _cached_user_name(user_id) for user_id, _, _, _ in applied}
+    events = []
+    events.append(('access', {'items': [
+        {'user_id': user_id, 'name': names[user_id], 'status': status, 'timestamp': timestamp.isoformat(),
+         'reader': reader, 'auto_closed': bool(auto_closed)}
+        for (user_id, status, timestamp, auto_closed), reader in zip(applied, readers)
+    ]}))
+    latest = {user_id: (status, timestamp) for user_id, status, timestamp, _ in applied}
+    events.append(('presence', {'changes': [
+        {'user_id': user_id, 'name': names[user_id], 'status': status, 'since': timestamp.isoformat()}
+        for user_id, (status, timestamp) in latest.items()
+    ]}))
+    if closed:
+        (week_start, _), (month_start, _) = current_ranking_periods()
+        with app.app_context():
+            totals = ranking_totals_for_users({user_id for user_id, _, _ in closed})
+        events.append(('ranking', {
+            'week_start': week_start.isoformat(),
+            'month': month_start.strftime('%Y-%m'),
+            'users': [dict(user_id=user_id, name=names.get(user_id) or _cached_user_name(user_id), **values)
+                      for user_id, values in totals.items()],
+        }))
+    emit_live_events(events)
+
+def emit_live_events(events):
     """
-    与えられたログリストからユーザーごとの滞在時間を計算します。
-    入室と退室がペアになっているセッションのみをカウントします。
+    (種類, 内容) のリストをライブフィードに流します。複数ワーカーの場合は live_events テーブルに
+    書いて連番を決め、ほかのプロセスにも知らせる（各プロセスの relay_live_events() が読む）。
     """
-    user_sessions_data = defaultdict(lambda: {'name': 'Unknown', 'total_seconds': 0})
-    current_entry_times = {} # {user_id: entry_datetime}
+    if worker_state is None:
+        for event_type, payload in events:
+            live_feed.publish(event_type, payload)
+        return
+    records = [LiveEventRecord(type=event_type, data=LiveFeed.serialize(payload)) for event_type, payload in events]
+    with app.app_context():
+        db.session.add_all(records)
+        db.session.flush()
+        added = [(record.id, record.type, record.data) for record in records]
+        db.session.query(LiveEventRecord).filter(
+            LiveEventRecord.id <= added[-1][0] - LIVE_FEED_MAX_EVENTS).delete(synchronize_session=False)
+        db.session.commit()
+    for event in added:
+        live_feed.add(*event)
+    worker_state.increment('live_events')
+
+def relay_live_events():
+    """ほかのプロセスが live_events テーブルに書いたイベントを、このプロセスの購読者へ流します。"""
+    with app.app_context():
+        rows = db.session.query(LiveEventRecord.id, LiveEventRecord.type, LiveEventRecord.data).filter(
+            LiveEventRecord.id > live_feed.last_id).order_by(LiveEventRecord.id).all()
+    for row in rows:
+        live_feed.add(*row)
 
-    for log in logs:
-        user_id = log.user_id
-        timestamp = log.timestamp
-        status = log.status
+@app.route('/api/live')
+def live_feed_api():
+    """
+    入退室・在室状態・ランキングの変化を Server-Sent Events で流す。
+    接続中のブラウザはリングバッファの新しいイベントを待つだけで、データベースは読まない。
+    """
+    after = live_feed.parse_event_id(request.headers.get('Last-Event-ID') or request.args.get('after'))
+    if not live_feed.subscribe():
+        return jsonify({'error': '接続数が上限に達しています。'}), 503
+
+    def stream():
+        nonlocal after
+        yield f"retry: {LIVE_FEED_RETRY_MS}\n\n"
+        while True:
+            events = live_feed.wait(after, LIVE_FEED_KEEPALIVE)
+            if events is None:
+                # 取りこぼしたイベントがあるので、ページごと読み込み直してもらう
+                yield "event: reset\ndata: {}\n\n"
+                return
+            if not events:
+                if live_feed.closed:
+                    # サーバーの停止中。ブラウザは retry の後に別のワーカーへ再接続する
+                    return
+                yield ": keep-alive\n\n"
+                continue
+            for event in events:
+                yield f"id: {live_feed.event_id(event)}\nevent: {event.type}\ndata: {event.data}\n\n"
+            after = events[-1].id
+
+    response = Response(stream(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    response.call_on_close(live_feed.unsubscribe)
+    return response
+
+# --- 古い月のアーカイブ ---
+# 締まった古い月の入退室ログ・滞在セッション・日ごとの滞在時間は、月ごとの圧縮ファイルに移す。
+# ユーザーごとの月間合計は archived_monthly_stay に残し、ランキング・履歴・Excel は
+# アーカイブも合わせて読む。日ごとの在室者（カレンダー）は小さいので DB に残す。
+# 月をまたいで翌月に退室したセッション（とその入室ログ）は、退室した月と一緒に移す。
+ARCHIVE_DIR = os.path.join(app.instance_path, 'archive')
+ARCHIVE_AFTER_MONTHS = 12 # これより前の月をアーカイブする
+ARCHIVE_DELETE_CHUNK_SIZE = 500 # SQLite のパラメータ数の上限に収めるため
+
+log_archive = LogArchive(ARCHIVE_DIR)
+
+def _next_month(month_start):
+    if month_start.month == 12:
+        return date(month_start.year + 1, 1, 1)
+    return date(month_start.year, month_start.month + 1, 1)
+
+def archived_month_ranges():
+    """アーカイブ済みの月の [初日, 翌月の初日) のリストを古い順に返します。"""
+    return [(month, _next_month(month))
+            for (month,) in db.session.query(ArchivedMonth.month).order_by(ArchivedMonth.month)]
+
+def _in_ranges(day, ranges):
+    return any(start <= day < end for start, end in ranges)
+
+def _outside_ranges(column, ranges):
+    """column がどの範囲にも入らない、という条件式"""
+    return db.and_(db.true(), *[db.or_(column < start, column >= end) for start, end in ranges])
+
+def _delete_by_ids(model, ids):
+    for i in range(0, len(ids), ARCHIVE_DELETE_CHUNK_SIZE):
+        model.query.filter(model.id.in_(ids[i:i + ARCHIVE_DELETE_CHUNK_SIZE])).delete(synchronize_session=False)
+
+def archive_month(month_start):
+    """
+    1か月分のデータをアーカイブファイルに移します。
+    - その月に退室した閉じた滞在セッション（前の月に入室したものを含む）
+    - その月のログと、上のセッションの入室ログ（翌月に退室したセッションの入室ログは除く）
+    - その月の daily_stay の行（ユーザーごとの合計は archived_monthly_stay に残す）
+    app_context 内で呼び出すこと。移したログの件数を返します。
+    """
+    month_end = _next_month(month_start)
+    start_dt = datetime.combine(month_start, datetime.min.time())
+    end_dt = datetime.combine(month_end, datetime.min.time())
+    if db.session.get(ArchivedMonth, month_start) is not None:
+        raise ValueError(f"{month_start:%Y年%m月} は既にアーカイブされています。")
+    if not is_closed_period(month_end):
+        raise ValueError(f"{month_start:%Y年%m月} はまだ締まっていないためアーカイブできません。")
+
+    sessions = db.session.query(
+        StaySession.id, StaySession.user_id, StaySession.entry_ts, StaySession.exit_ts,
+        StaySession.duration_seconds, StaySession.auto_closed
+    ).filter(StaySession.exit_ts >= start_dt, StaySession.exit_ts < end_dt).order_by(
+        StaySession.user_id, StaySession.entry_ts, StaySession.id).all()
+    # 翌月に退室したセッションの入室ログは、そのセッションと一緒に翌月のアーカイブへ移す
+    carried_over = {(user_id, entry_ts) for user_id, entry_ts in db.session.query(
+        StaySession.user_id, StaySession.entry_ts
+    ).filter(StaySession.entry_ts >= start_dt, StaySession.entry_ts < end_dt,
+             db.or_(StaySession.exit_ts >= end_dt, StaySession.exit_ts.is_(None)))}
+    # 前の月に入室したセッションの入室ログ
+    earlier_entries = [(s.user_id, s.entry_ts) for s in sessions if s.entry_ts < start_dt]
+
+    log_columns = (AccessLog.id, AccessLog.user_id, AccessLog.timestamp, AccessLog.status, AccessLog.reader)
+    logs = [log for log in db.session.query(*log_columns).filter(
+                AccessLog.timestamp >= start_dt, AccessLog.timestamp < end_dt)
+            if not (log.status == '入室' and (log.user_id, log.timestamp) in carried_over)]
+    if earlier_entries:
+        logs += db.session.query(*log_columns).filter(
+            AccessLog.status == '入室',
+            db.or_(*[db.and_(AccessLog.user_id == user_id, AccessLog.timestamp == entry_ts)
+                     for user_id, entry_ts in earlier_entries])).all()
+    logs.sort(key=lambda log: (log.timestamp, log.id))
+
+    daily_stays = db.session.query(
+        DailyStay.user_id, DailyStay.date, DailyStay.seconds, DailyStay.session_count
+    ).filter(DailyStay.date >= month_start, DailyStay.date < month_end).order_by(
+        DailyStay.date, DailyStay.user_id).all()
+    if not logs and not sessions and not daily_stays:
+        return 0
+
+    # ファイルを書き終えてから DB を更新する（途中で止まってもファイルを書き直すだけで済む）
+    path = log_archive.write_month(month_start.year, month_start.month, logs, sessions, daily_stays)
+    monthly_totals = defaultdict(lambda: [0.0, 0])
+    for user_id, _, seconds, session_count in daily_stays:
+        monthly_totals[user_id][0] += seconds
+        monthly_totals[user_id][1] += session_count
+    db.session.add(ArchivedMonth(month=month_start, file_name=os.path.basename(path),
+                                 log_count=len(logs), session_count=len(sessions)))
+    db.session.bulk_insert_mappings(ArchivedMonthlyStay, [
+        {'user_id': user_id, 'month': month_start, 'seconds': seconds, 'session_count': count}
+        for user_id, (seconds, count) in monthly_totals.items()
+    ])
+    _delete_by_ids(AccessLog, [log.id for log in logs])
+    _delete_by_ids(StaySession, [s.id for s in sessions])
+    DailyStay.query.filter(
+        DailyStay.date >= month_start, DailyStay.date < month_end).delete(synchronize_session=False)
+    db.session.commit()
+    result_cache.invalidate_all()
+    print(f"{month_start:%Y年%m月} をアーカイブしました: ログ {len(logs)}件, セッション {len(sessions)}件")
+    return len(logs)
+
+def archive_old_months(horizon_months=ARCHIVE_AFTER_MONTHS):
+    """
+    horizon_months か月より前の締まった月を、古い順にアーカイブします。
+    app_context 内で呼び出すこと。アーカイブした月（初日）のリストを返します。
+    """
+    if not flush_tap_journal():
+        raise RuntimeError("未反映のタップを書き込めなかったため、アーカイブを中止しました。")
+    today = date.today()
+    cutoff_index = today.year * 12 + today.month - 1 - horizon_months
+    cutoff = date(cutoff_index // 12, cutoff_index % 12 + 1, 1)
+
+    oldest = db.session.query(db.func.min(AccessLog.timestamp)).scalar()
+    if oldest is None:
+        return []
+    archived = {month for month, _ in archived_month_ranges()}
+    month = oldest.date().replace(day=1)
+    done = []
+    while month < cutoff:
+        if month not in archived:
+            if not is_closed_period(_next_month(month)):
+                break
+            if archive_month(month):
+                done.append(month)
+        month = _next_month(month)
+    return done
+
+def restore_archived_month(month_start):
+    """
+    アーカイブした月のデータを DB に戻し、アーカイブファイルを削除します。
+    app_context 内で呼び出すこと。戻したログの件数を返します。
+    """
+    if db.session.get(ArchivedMonth, month_start) is None:
+        raise ValueError(f"{month_start:%Y年%m月} はアーカイブされていません。")
+    if not flush_tap_journal():
+        raise RuntimeError("未反映のタップを書き込めなかったため、アーカイブの復元を中止しました。")
+    year, month = month_start.year, month_start.month
+
+    def without_taken_ids(model, rows):
+        # アーカイブ後に同じ ID が使われていた場合は新しい ID を振る
+        ids = [row['id'] for row in rows]
+        taken = set()
+        for i in range(0, len(ids), ARCHIVE_DELETE_CHUNK_SIZE):
+            taken.update(row_id for (row_id,) in db.session.query(model.id).filter(
+                model.id.in_(ids[i:i + ARCHIVE_DELETE_CHUNK_SIZE])))
+        for row in rows:
+            if row['id'] in taken:
+                del row['id']
+        return rows
+
+    logs = [log._asdict() for log in log_archive.iter_logs(year, month)]
+    sessions = [s._asdict() for s in log_archive.iter_sessions(year, month)]
+    db.session.bulk_insert_mappings(AccessLog, without_taken_ids(AccessLog, logs))
+    db.session.bulk_insert_mappings(StaySession, without_taken_ids(StaySession, sessions))
+    db.session.bulk_insert_mappings(DailyStay, [
+        d._asdict() for d in log_archive.iter_daily_stays(year, month)])
+    ArchivedMonthlyStay.query.filter_by(month=month_start).delete()
+    ArchivedMonth.query.filter_by(month=month_start).delete()
+    db.session.commit()
+    log_archive.remove(year, month)
+    result_cache.invalidate_all()
+    print(f"{month_start:%Y年%m月} をアーカイブから戻しました: ログ {len(logs)}件, セッション {len(sessions)}件")
+    return len(logs)
+
+def stage_user_removal_from_archives(user_id):
+    """
+    アーカイブした月から、ユーザーのログ・セッション・日ごとの滞在時間を取り除きます。
+    そのユーザーの行を含む月だけを一時ファイルに書き直し、archived_month の件数と
+    archived_monthly_stay を更新します（コミットは呼び出し元で行うこと）。
+    (書き直した月のリスト, 取り除いたログの件数) を返すので、コミットした後に log_archive.replace_staged()、
+    やめる場合は log_archive.discard_staged() を月ごとに呼ぶこと。
+    ファイルを読み書きできなかった場合は、書きかけの一時ファイルを消してから例外を送出します。
+    """
+    staged = []
+    removed_logs = 0
+    try:
+        for (month_start, _) in archived_month_ranges():
+            year, month = month_start.year, month_start.month
+            logs = list(log_archive.iter_logs(year, month))
+            sessions = list(log_archive.iter_sessions(year, month))
+            daily_stays = list(log_archive.iter_daily_stays(year, month))
+            if not any(row.user_id == user_id for row in itertools.chain(logs, sessions, daily_stays)):
+                continue
+            removed_logs += sum(1 for log in logs if log.user_id == user_id)
+            logs = [log for log in logs if log.user_id != user_id]
+            sessions = [s for s in sessions if s.user_id != user_id]
+            staged.append(month_start)
+            log_archive.write_month(year, month, logs, sessions,
+                                    [d for d in daily_stays if d.user_id != user_id], replace=False)
+            archived = db.session.get(ArchivedMonth, month_start)
+            archived.log_count = len(logs)
+            archived.session_count = len(sessions)
+    except Exception:
+        for month_start in staged:
+            log_archive.discard_staged(month_start.year, month_start.month)
+        raise
+    ArchivedMonthlyStay.query.filter_by(user_id=user_id).delete()
+    return staged, removed_logs
+
+def delete_user_records(user_id, user=None):
+    """
+    ユーザーの入退室ログ・滞在セッション・日ごとの集計・在室状態を、アーカイブした月の分も
+    含めて削除してコミットします。user を渡すとユーザー自体も同じトランザクションで削除します。
+    未反映のタップを書き込み、tap_write_lock を持ったまま呼ぶこと。
+    アーカイブのファイルを書き直せなかった場合は、何も変更せずに RuntimeError を送出します。
+    削除したログの件数（アーカイブした分を含む）を返します。
+    """
+    try:
+        staged, archived_logs = stage_user_removal_from_archives(user_id)
+    except (OSError, ValueError) as e:
+        db.session.rollback()
+        raise RuntimeError(f"アーカイブを書き直せませんでした: {e}")
+    try:
+        num_deleted = AccessLog.query.filter_by(user_id=user_id).delete()
+        StaySession.query.filter_by(user_id=user_id).delete()
+        DailyStay.query.filter_by(user_id=user_id).delete()
+        Presence.query.filter_by(user_id=user_id).delete()
+        # アーカイブした月の日も含めて、すべての日の在室者から外す
+        remove_user_from_presence(user_id)
+        if user is not None:
+            db.session.delete(user)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        for month_start in staged:
+            log_archive.discard_staged(month_start.year, month_start.month)
+        raise
+    for month_start in staged:
+        log_archive.replace_staged(month_start.year, month_start.month)
+    result_cache.invalidate_all()
+    return num_deleted + archived_logs
+
+def _parse_month_argument(value):
+    try:
+        return datetime.strptime(value, '%Y-%m').date()
+    except ValueError:
+        raise click.BadParameter(f"YYYY-MM の形式で指定してください: {value}")
 
-        if status == '入室':
-            current_entry_times[user_id] = timestamp
-        elif status == '退室':
-            if user_id in current_entry_times:
-                entry_time = current_entry_times.pop(user_id)
-                duration = timestamp - entry_time
-                user_sessions_data[user_id]['total_seconds'] += duration.total_seconds()
-            # else: 対応する入室がない退室ログは無視
-
-    # ユーザー名を取得してデータに追加
-    with app.app_context(): # データベース操作のためにコンテキストが必要
-        for user_id in user_sessions_data.keys():
-            user_obj = User.query.get(user_id)
-            if user_obj:
-                user_sessions_data[user_id]['name'] = user_obj.name
-            else:
-                user_sessions_data[user_id]['name'] = f"不明なユーザー (ID:{user_id})"
+def requires_stopped_server(command):
+    """
+    アーカイブの CLI コマンド用のデコレーター。サーバーが持っているタップジャーナルは
+    別のプロセスからは書き込めないため、リーダーのロックを取れない（サーバーが動いている）場合は
+    中止します。取れた場合は、ジャーナルに残っているタップを DB に書き込んでから実行します。
+    """
+    @functools.wraps(command)
+    def wrapper(*args, **kwargs):
+        if not leader_lock.try_acquire():
+            raise click.ClickException(
+                f"サーバー (PID {leader_lock.owner_pid()}) の動作中は実行できません。サーバーを止めてから実行してください。")
+        try:
+            replay_tap_journal()
+            return command(*args, **kwargs)
+        finally:
+            leader_lock.release()
+    return wrapper
+
+@app.cli.command('archive-logs')
+@click.option('--months', type=int, default=ARCHIVE_AFTER_MONTHS, show_default=True,
+              help='これより前の締まった月をアーカイブする')
+@requires_stopped_server
+def archive_logs_command(months):
+    """古い月のログをアーカイブファイルに移す（flask --app app archive-logs）"""
+    done = archive_old_months(months)
+    print(f"{len(done)}か月分をアーカイブしました。")
+
+@app.cli.command('restore-archive')
+@click.argument('month')
+@requires_stopped_server
+def restore_archive_command(month):
+    """アーカイブした月を DB に戻す（flask --app app restore-archive 2024-04）"""
+    try:
+        restore_archived_month(_parse_month_argument(month))
+    except ValueError as e:
+        raise click.ClickException(str(e))
 
+@app.cli.command('list-archives')
+def list_archives_command():
+    """アーカイブ済みの月を一覧表示する（flask --app app list-archives）"""
+    for archived in ArchivedMonth.query.order_by(ArchivedMonth.month):
+        print(f"{archived.month:%Y-%m}  ログ {archived.log_count}件  セッション {archived.session_count}件  "
+              f"{archived.file_name}")
+
+SessionRow = namedtuple('SessionRow', ['user_id', 'entry_ts', 'exit_ts', 'duration_seconds'])
+
+def iter_archived_session_tuples(month_start):
+    """
+    アーカイブした月の滞在セッションを (user_id, entry_ts, exit_ts, duration_seconds) で
+    ユーザー・入室時刻順に返します。
+    """
+    for s in log_archive.iter_sessions(month_start.year, month_start.month):
+        yield SessionRow(s.user_id, s.entry_ts, s.exit_ts, s.duration_seconds)
+
+# --- 集計用のデータアクセス層 ---
+# 集計処理は ORM オブジェクトを作らず、必要な列だけをタプルで読み込む。
+# 件数が多くなり得るものは REPORT_CHUNK_SIZE 件ずつ読み込みながら処理し、
+# ユーザー名は1回のクエリでまとめて引く。いずれも app_context 内で呼び出すこと。
+REPORT_CHUNK_SIZE = 1000
+
+def iter_access_log_tuples(start=None, end=None, user_ids=None, chunk_size=REPORT_CHUNK_SIZE):
+    """期間 [start, end) の (user_id, timestamp, status) をユーザー・時刻順に返します。"""
+    query = db.session.query(AccessLog.user_id, AccessLog.timestamp, AccessLog.status)
+    if start is not None:
+        query = query.filter(AccessLog.timestamp >= start)
+    if end is not None:
+        query = query.filter(AccessLog.timestamp < end)
+    if user_ids is not None:
+        query = query.filter(AccessLog.user_id.in_(user_ids))
+    return query.order_by(
+        AccessLog.user_id, AccessLog.timestamp, AccessLog.id
+    ).execution_options(yield_per=chunk_size)
+
+def iter_stay_session_tuples(start=None, end=None, user_ids=None, chunk_size=REPORT_CHUNK_SIZE):
+    """
+    期間 [start, end) にかかる滞在セッションの
+    (user_id, entry_ts, exit_ts, duration_seconds) をユーザー・入室時刻順に返します。
+    未退室のセッションは入室時刻が期間内にあるものだけを返します。
+    """
+    query = db.session.query(
+        StaySession.user_id, StaySession.entry_ts, StaySession.exit_ts, StaySession.duration_seconds)
+    if end is not None:
+        query = query.filter(StaySession.entry_ts < end)
+    if start is not None:
+        query = query.filter(db.or_(
+            StaySession.exit_ts >= start,
+            db.and_(StaySession.exit_ts.is_(None), StaySession.entry_ts >= start)))
+    if user_ids is not None:
+        query = query.filter(StaySession.user_id.in_(user_ids))
+    return query.order_by(
+        StaySession.user_id, StaySession.entry_ts, StaySession.id
+    ).execution_options(yield_per=chunk_size)
+
+def load_user_names(user_ids=None):
+    """{user_id: 名前} を1回のクエリで読み込みます。"""
+    query = db.session.query(User.id, User.name)
+    if user_ids is not None:
+        query = query.filter(User.id.in_(user_ids))
+    return dict(query.all())
+
+def display_user_name(user_id, name):
+    """削除済みなどで名前がないユーザーの表示名を補います。"""
+    return name if name is not None else f"不明なユーザー (ID:{user_id})"
+
+# --- 入退室履歴の検索（キーセットページネーション） ---
+# 履歴は新しい順に (timestamp, id) をカーソルにしてページを区切る。
+# OFFSET を使わないため、何ページ目でもインデックスを範囲検索するだけで済む。
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 500
+
+HistoryEntry = namedtuple('HistoryEntry', ['id', 'user_id', 'name', 'timestamp', 'status', 'reader'])
+
+def encode_history_cursor(entry):
+    """ページの最後の行から次のページのカーソル文字列を作ります。"""
+    raw = f"{entry.timestamp.isoformat()}|{entry.id}".encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def decode_history_cursor(cursor):
+    """カーソル文字列を (timestamp, id) に戻します。不正な場合は ValueError。"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8')
+        timestamp, log_id = raw.split('|')
+        return datetime.fromisoformat(timestamp), int(log_id)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise ValueError(f"不正なカーソルです: {cursor}") from e
+
+def parse_history_filters(args):
+    """
+    クエリパラメータ（user_id, status, from, to）から検索条件を作ります。
+    from / to は日付（YYYY-MM-DD）で、to の日も含みます。不正な値は ValueError。
+    """
+    filters = {}
+    if args.get('user_id'):
+        try:
+            filters['user_id'] = int(args['user_id'])
+        except ValueError:
+            raise ValueError(f"不正なユーザーIDです: {args['user_id']}")
+    if args.get('status'):
+        if args['status'] not in ('入室', '退室'):
+            raise ValueError(f"不正なステータスです: {args['status']}")
+        filters['status'] = args['status']
+    for key, name in (('from', 'start'), ('to', 'end')):
+        if args.get(key):
+            try:
+                day = date.fromisoformat(args[key])
+            except ValueError:
+                raise ValueError(f"不正な日付です: {args[key]}")
+            if key == 'to':
+                day += timedelta(days=1)
+            filters[name] = datetime.combine(day, datetime.min.time())
+    return filters
+
+def query_access_history(user_id=None, status=None, start=None, end=None, after=None,
+                         limit=HISTORY_PAGE_SIZE):
+    """
+    条件に合う入退室履歴を新しい順に最大 limit 件返します。
+    after に前のページの最後の行の (timestamp, id) を渡すと、その続きを返します。
+    """
+    query = db.session.query(
+        AccessLog.id, AccessLog.user_id, User.name, AccessLog.timestamp, AccessLog.status, AccessLog.reader
+    ).outerjoin(User, User.id == AccessLog.user_id)
+    if user_id is not None:
+        query = query.filter(AccessLog.user_id == user_id)
+    if status is not None:
+        query = query.filter(AccessLog.status == status)
+    if start is not None:
+        query = query.filter(AccessLog.timestamp >= start)
+    if end is not None:
+        query = query.filter(AccessLog.timestamp < end)
+    if after is not None:
+        after_timestamp, after_id = after
+        # timestamp <= ? をインデックスの範囲検索に使い、同じ時刻の行は id で区切る
+        query = query.filter(
+            AccessLog.timestamp <= after_timestamp,
+            db.or_(AccessLog.timestamp < after_timestamp, AccessLog.id < after_id))
+    rows = query.order_by(AccessLog.timestamp.desc(), AccessLog.id.desc()).limit(limit).all()
+    entries = [HistoryEntry(log_id, uid, display_user_name(uid, name), timestamp, log_status, reader)
+               for log_id, uid, name, timestamp, log_status, reader in rows]
+
+    # アーカイブした月のログは、このページに入る可能性があるときだけ読む
+    ranges = archived_month_ranges()
+    if not ranges:
+        return entries
+    newest_archived_end = datetime.combine(ranges[-1][1], datetime.min.time())
+    if len(entries) == limit and entries[-1].timestamp >= newest_archived_end:
+        return entries
+    archived = _archived_history(ranges, user_id, status, start, end, after, limit)
+    if not archived:
+        return entries
+    names = load_user_names({log.user_id for log in archived})
+    entries += [HistoryEntry(log.id, log.user_id, display_user_name(log.user_id, names.get(log.user_id)),
+                             log.timestamp, log.status, log.reader) for log in archived]
+    entries.sort(key=lambda e: (e.timestamp, e.id), reverse=True)
+    return entries[:limit]
+
+def _archived_history(ranges, user_id, status, start, end, after, limit):
+    """
+    アーカイブから条件に合うログを新しい順に最大 limit 件返します。
+    ある月のファイルのログはすべてその月の末より前なので、新しい月から順に読み、
+    limit 件がそろってそれより古い月に入り得なくなったら読むのをやめます。
+    """
+    found = []
+    for month_start, month_end in reversed(ranges):
+        month_end_dt = datetime.combine(month_end, datetime.min.time())
+        if len(found) >= limit and found[limit - 1][0][0] >= month_end_dt:
+            break
+        if start is not None and month_end_dt <= start:
+            break
+        for log in log_archive.iter_logs(month_start.year, month_start.month):
+            if user_id is not None and log.user_id != user_id:
+                continue
+            if status is not None and log.status != status:
+                continue
+            if (start is not None and log.timestamp < start) or (end is not None and log.timestamp >= end):
+                continue
+            if after is not None and (log.timestamp, log.id) >= after:
+                continue
+            found.append(((log.timestamp, log.id), log))
+        found.sort(key=lambda item: item[0], reverse=True)
+        del found[limit:]
+    return [log for _, log in found]
+
+def iter_access_history(chunk_size=REPORT_CHUNK_SIZE, **filters):
+    """条件に合う入退室履歴をすべて、新しい順に chunk_size 件ずつ読み込みながら返します。"""
+    after = None
+    while True:
+        page = query_access_history(after=after, limit=chunk_size, **filters)
+        yield from page
+        if len(page) < chunk_size:
+            return
+        after = (page[-1].timestamp, page[-1].id)
+
+def history_entry_to_dict(entry):
+    return {
+        'id': entry.id,
+        'user_id': entry.user_id,
+        'name': entry.name,
+        'timestamp': entry.timestamp.isoformat(),
+        'status': entry.status,
+        'reader': entry.reader,
+    }
+
+# --- 滞在時間計算ヘルパー関数 ---
+def _format_duration(total_seconds):
+    """秒数を時間:分:秒形式の文字列に変換します。"""
+    hours = int(total_seconds // 3600)
+    minutes = int((total_seconds % 3600) // 60)
+    seconds = int(total_seconds % 60)
+    return f"{hours:02}:{minutes:02}:{seconds:02}"
+
+def _stay_time_ranking(start_date=None, end_date=None):
+    """
+    daily_stay からユーザーごとの滞在時間ランキングを作成します。
+    期間は日付で指定し [start_date, end_date) の各日の滞在時間を合計します
+    （日付や月をまたいだ滞在はそれぞれの日に分けて数えられます）。
+    読み込む行数は最大でも ユーザー数 × 日数 で、生ログの件数には依存しません。
+    """
+    query = db.session.query(
+        DailyStay.user_id,
+        User.name,
+        db.func.sum(DailyStay.seconds)
+    ).outerjoin(User, User.id == DailyStay.user_id)
+    if start_date is not None:
+        query = query.filter(DailyStay.date >= start_date, DailyStay.date < end_date)
+    rows = query.group_by(DailyStay.user_id, User.name).all()
+
+    # アーカイブした月は月間合計を足す（期間に月全体が入る月のみ。週間ランキングなどには入らない）
+    archived = db.session.query(ArchivedMonthlyStay.user_id, db.func.sum(ArchivedMonthlyStay.seconds))
+    if start_date is not None:
+        # 月の初日 >= start_date かつ 翌月の初日 <= end_date
+        archived = archived.filter(ArchivedMonthlyStay.month >= start_date,
+                                   ArchivedMonthlyStay.month < end_date.replace(day=1))
+    archived_totals = dict(archived.group_by(ArchivedMonthlyStay.user_id).all())
+    if archived_totals:
+        totals = {user_id: [name, seconds] for user_id, name, seconds in rows}
+        names = load_user_names(set(archived_totals) - set(totals))
+        for user_id, seconds in archived_totals.items():
+            totals.setdefault(user_id, [names.get(user_id), 0.0])[1] += seconds
+        rows = [(user_id, name, seconds) for user_id, (name, seconds) in totals.items()]
+    return _build_ranking(rows)
+
+def _session_ranking(start=None, end=None):
+    """
+    閉じた滞在セッションからユーザーごとの滞在時間ランキングを作成します（検証用）。
+    期間を指定した場合は、入室と退室の両方が期間内にあるセッションのみをカウントします。
+    """
+    query = db.session.query(
+        StaySession.user_id,
+        User.name,
+        db.func.sum(StaySession.duration_seconds)
+    ).outerjoin(User, User.id == StaySession.user_id)\
+     .filter(StaySession.exit_ts.isnot(None))
+    if start is not None:
+        query = query.filter(StaySession.entry_ts >= start, StaySession.exit_ts < end)
+    rows = query.group_by(StaySession.user_id, User.name).all()
+    return _build_ranking(rows)
+
+def stay_totals_from_logs(start=None, end=None):
+    """
+    AccessLog から直接、SQL のウィンドウ関数で入室と退室を組にしてユーザーごとの
+    合計滞在時間を求めます（従来の Python での組み立てと同じ規則）。
+    sessions テーブルを使わない検証用の経路で、ユーザーごとの合計だけが返されます。
+    """
+    where = ''
+    params = {}
+    if start is not None:
+        where = 'WHERE timestamp >= :start AND timestamp < :end'
+        params = {'start': _sql_datetime(start), 'end': _sql_datetime(end)}
+    rows = db.session.execute(db.text(
+        "WITH " + _PAIRED_LOGS_CTE.format(where=where) + f"""
+        SELECT paired.user_id, user.name,
+               SUM({_epoch_seconds_sql('paired.timestamp')} - {_epoch_seconds_sql('paired.prev_timestamp')})
+        FROM paired LEFT JOIN user ON user.id = paired.user_id
+        WHERE paired.status = '退室' AND paired.prev_status = '入室'
+        GROUP BY paired.user_id, user.name
+        """), params).all()
+    return _build_ranking(rows)
+
+def _build_ranking(rows):
+    """(user_id, 名前, 合計秒数) の行をランキング形式に整形します。"""
     # ランキング形式に整形し、秒数を時間:分:秒形式に変換
     ranking_data = []
-    for user_id, data in user_sessions_data.items():
-        total_seconds = data['total_seconds']
-        hours = int(total_seconds // 3600)
-        minutes = int((total_seconds % 3600) // 60)
-        seconds = int(total_seconds % 60)
-        formatted_time = f"{hours:02}:{minutes:02}:{seconds:02}"
+    for user_id, name, total_seconds in rows:
         ranking_data.append({
             'user_id': user_id,
-            'name': data['name'],
+            'name': display_user_name(user_id, name),
             'total_seconds': total_seconds,
-            'formatted_time': formatted_time
+            'formatted_time': _format_duration(total_seconds)
         })
 
     # 合計滞在時間で降順にソート
@@ -244,82 +1668,216 @@ def _calculate_stay_time_for_logs(logs):
     
     return ranking_data
 
+def is_closed_period(end_date):
+    """
+    end_date より前の期間の集計がもう変わらないかどうかを返します。
+    期間が終わっていて、期間中に入室したまま閉じていないセッションがなければ確定です。
+    """
+    if end_date > date.today():
+        return False
+    end_dt = datetime.combine(end_date, datetime.min.time())
+    return db.session.query(StaySession.id).filter(
+        StaySession.exit_ts.is_(None), StaySession.entry_ts < end_dt
+    ).first() is None
+
+def first_data_month():
+    """記録が残っている最初の月の初日（アーカイブした月を含む）。記録がなければ None"""
+    candidates = [
+        db.session.query(db.func.min(AccessLog.timestamp)).scalar(),
+        db.session.query(db.func.min(ArchivedMonth.month)).scalar(),
+    ]
+    candidates = [value.date() if isinstance(value, datetime) else value for value in candidates if value]
+    return min(candidates).replace(day=1) if candidates else None
+
+def is_pinnable_month(start_date, end_date):
+    """
+    月の集計をキャッシュに固定してよいかどうかを返します。
+    /ranking?year=1900 のような任意の月で固定した結果が増え続けないよう、
+    記録のある最初の月から締まった最後の月までに限ります。
+    """
+    first_month = first_data_month()
+    return first_month is not None and start_date >= first_month and is_closed_period(end_date)
+
 # --- 月間滞在時間計算関数 ---
 def calculate_monthly_stay_time(year, month):
-    start_date = datetime(year, month, 1)
+    start_date = date(year, month, 1)
     if month == 12:
-        end_date = datetime(year + 1, 1, 1)
+        end_date = date(year + 1, 1, 1)
     else:
-        end_date = datetime(year, month + 1, 1)
+        end_date = date(year, month + 1, 1)
 
-    logs = AccessLog.query.filter(
-        AccessLog.timestamp >= start_date,
-        AccessLog.timestamp < end_date
-    ).order_by(AccessLog.user_id, AccessLog.timestamp).all()
-    
-    return _calculate_stay_time_for_logs(logs)
+    # 締まった過去の月の結果は固定し、以後は再計算しない
+    return result_cache.get_or_compute(
+        ('monthly_ranking', year, month),
+        lambda: _stay_time_ranking(start_date, end_date),
+        pin=lambda _: is_pinnable_month(start_date, end_date))
 
 # --- 今週の滞在時間計算関数 ---
 def calculate_weekly_stay_time():
     today = datetime.now()
     # 週の始まり（月曜日）を計算
     start_of_week = today - timedelta(days=today.weekday())
-    start_of_week = start_of_week.replace(hour=0, minute=0, second=0, microsecond=0)
+    start_of_week = start_of_week.date()
     end_of_week = start_of_week + timedelta(days=7)
 
-    logs = AccessLog.query.filter(
-        AccessLog.timestamp >= start_of_week,
-        AccessLog.timestamp < end_of_week
-    ).order_by(AccessLog.user_id, AccessLog.timestamp).all()
-
-    return _calculate_stay_time_for_logs(logs)
+    return result_cache.get_or_compute(
+        ('weekly_ranking', start_of_week),
+        lambda: _stay_time_ranking(start_of_week, end_of_week))
 
 # --- 今までの合計滞在時間計算関数 ---
 def calculate_total_stay_time():
-    logs = AccessLog.query.order_by(AccessLog.user_id, AccessLog.timestamp).all()
-    return _calculate_stay_time_for_logs(logs)
+    return result_cache.get_or_compute(('total_ranking',), _stay_time_ranking)
 
 # --- カレンダー表示用のアクセスサマリー取得関数 ---
 def get_monthly_access_summary(year, month):
+    end_date = date(year + 1, 1, 1) if month == 12 else date(year, month + 1, 1)
+    return result_cache.get_or_compute(
+        ('access_summary', year, month),
+        lambda: _build_monthly_access_summary(year, month),
+        pin=lambda _: is_pinnable_month(date(year, month, 1), end_date))
+
+def _build_monthly_access_summary(year, month):
     start_date = datetime(year, month, 1).date()
     if month == 12:
         end_date = datetime(year + 1, 1, 1).date()
     else:
         end_date = datetime(year, month + 1, 1).date()
 
-    # 該当月の全てのログを取得
-    logs = AccessLog.query.filter(
-        AccessLog.timestamp >= start_date,
-        AccessLog.timestamp < end_date
-    ).order_by(AccessLog.timestamp).all()
-
-    access_summary = defaultdict(set) # 日付ごとにアクセスしたユーザー名を格納
-    user_names_cache = {} # ユーザー名をキャッシュ
+    # 日ごとの在室者の索引から、該当月の日付ごとのユーザーIDを取得
+    days = db.session.query(DailyPresence.date, DailyPresence.user_bitmap).filter(
+        DailyPresence.date >= start_date, DailyPresence.date < end_date
+    ).all()
+    user_names = load_user_names()
 
-    with app.app_context():
-        for log in logs:
-            log_date = log.timestamp.date()
-            if log_date >= start_date and log_date < end_date:
-                if log.user_id not in user_names_cache:
-                    user_obj = User.query.get(log.user_id)
-                    if user_obj:
-                        user_names_cache[log.user_id] = user_obj.name
-                    else:
-                        user_names_cache[log.user_id] = f"不明なユーザー (ID:{log.user_id})"
-                access_summary[log_date].add(user_names_cache[log.user_id])
-    
-    # setをlistに変換してソート
-    for date_key in access_summary:
-        access_summary[date_key] = sorted(list(access_summary[date_key]))
+    access_summary = {} # 日付ごとにアクセスしたユーザー名を格納
+    for day, user_bitmap in days:
+        names = {display_user_name(user_id, user_names.get(user_id)) for user_id in bitmap_user_ids(user_bitmap)}
+        if names:
+            access_summary[day] = sorted(names)
 
     return access_summary
 
+def get_calendar_month_json(year, month):
+    """/api/calendar 用の JSON（バイト列）を返します。過去の月はキャッシュに固定されます。"""
+    end_date = date(year + 1, 1, 1) if month == 12 else date(year, month + 1, 1)
+
+    def build():
+        access_summary = get_monthly_access_summary(year, month)
+        cal = calendar.Calendar(firstweekday=calendar.SUNDAY) # 日曜日始まり
+        payload = {
+            'year': year,
+            'month': month,
+            'weeks': [[day.isoformat() for day in week] for week in cal.monthdatescalendar(year, month)],
+            'days': {day.isoformat(): names for day, names in sorted(access_summary.items())},
+        }
+        return json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+    return result_cache.get_or_compute(
+        ('calendar_json', year, month), build,
+        pin=lambda _: is_pinnable_month(date(year, month, 1), end_date))
+
+
+# --- 条件付き GET とレスポンスの圧縮 ---
+# ダッシュボードやランキングを定期的に読み込み直すキオスク端末向け。データバージョンが
+# 変わっていなければ、クエリもテンプレートの描画もせずに 304 を返す。
+COMPRESSIBLE_MIMETYPES = {'text/html', 'application/json', 'text/plain', 'text/css', 'application/javascript'}
+COMPRESS_MIN_BYTES = 512
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+def current_data_version():
+    """タップ・ユーザーの編集・ログの削除・自動退室のたびに上がるデータバージョン"""
+    return result_cache.data_version
+
+def data_version_etag(*parts):
+    """
+    データバージョンとページの表示に影響する値から ETag を作ります（データベースは読まない）。
+    再起動すると前の ETag は使えなくなるように、ライブフィードの起動ごとの ID も含める。
+    日付も含めて、日・週・月が変わったらランキングの期間に合わせて作り直させる。
+    """
+    key = '|'.join(str(part) for part in (live_feed.stream_id, current_data_version(), date.today()) + parts)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:20]
+
+def conditional_page(view):
+    """
+    ページのビューを、データバージョンの ETag による条件付き GET に対応させます。
+    If-None-Match が今の ETag と一致すれば、ビューを呼ばずに 304 を返す。
+    ETag はビューを呼ぶ前に作るので、描画中にデータが変わっても次の読み込みで新しいページになる。
+    フラッシュメッセージはユーザーごとに1回だけ表示するものなので、残っている間は 304 にしない。
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if session.get('_flashes'):
+            return view(*args, **kwargs)
+        etag = data_version_etag(request.full_path)
+        if request.if_none_match.contains_weak(etag):
+            CONDITIONAL_GETS_TOTAL.inc(view=view.__name__, result='not_modified')
+            response = Response(status=304)
+        else:
+            CONDITIONAL_GETS_TOTAL.inc(view=view.__name__, result='full')
+            response = app.make_response(view(*args, **kwargs))
+        # 圧縮してもしなくても同じ内容なので弱い ETag にする
+        response.set_etag(etag, weak=True)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+    return wrapper
+
+def choose_content_encoding():
+    """Accept-Encoding から使う圧縮方式を選びます（brotli が使えれば優先する）。"""
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        return 'br'
+    if accepted['gzip']:
+        return 'gzip'
+    return None
+
+@app.after_request
+def compress_response(response):
+    """HTML・JSON などのレスポンスを gzip / brotli で圧縮します。"""
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES
+            or 'Content-Encoding' in response.headers):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = choose_content_encoding()
+    body = response.get_data()
+    if encoding is None or len(body) < COMPRESS_MIN_BYTES:
+        return response
+    if encoding == 'br':
+        compressed = brotli.compress(body, quality=BROTLI_QUALITY)
+    else:
+        compressed = gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    # 内容から作った強い ETag は、圧縮後のバイト列とは一致しなくなるので弱い ETag にする
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    COMPRESSED_RESPONSES_TOTAL.inc(encoding=encoding)
+    return response
 
 # --- Webアプリケーションのルート定義 ---
 
+LatestLog = namedtuple('LatestLog', ['user_name', 'timestamp', 'status', 'reader'])
+
+def get_latest_logs(limit=20):
+    """最新の入退室履歴を (ユーザー名, 時刻, ステータス, 場所) の形で返します。"""
+    return result_cache.get_or_compute(('latest_logs', limit), lambda: _load_latest_logs(limit))
+
+def _load_latest_logs(limit):
+    rows = db.session.query(
+        AccessLog.user_id, User.name, AccessLog.timestamp, AccessLog.status, AccessLog.reader
+    ).outerjoin(User, User.id == AccessLog.user_id).order_by(
+        AccessLog.timestamp.desc()).limit(limit).all()
+    return [LatestLog(display_user_name(user_id, name), timestamp, status, reader)
+            for user_id, name, timestamp, status, reader in rows]
+
 @app.route('/')
+@conditional_page
 def index():
-    access_logs = AccessLog.query.order_by(AccessLog.timestamp.desc()).limit(20).all() # 最新20件
+    # このページの内容より後のイベントだけをライブフィードから受け取るため、先に読んでおく
+    live_event_id = live_feed.event_id(live_feed.last_id)
+    access_logs = get_latest_logs(20) # 最新20件
 
     # カレンダー表示用の年と月を取得
     current_year = datetime.now().year
@@ -330,7 +1888,7 @@ def index():
     calendar_month = request.args.get('calendar_month', type=int, default=current_month)
 
     # デバッグ用: テンプレートに渡す値を確認
-    print(f"DEBUG: Rendering index.html with calendar_year={calendar_year}, calendar_month={calendar_month}")
+    app.logger.debug("Rendering index.html with calendar_year=%s, calendar_month=%s", calendar_year, calendar_month)
 
     # カレンダーデータ
     cal = calendar.Calendar(firstweekday=calendar.SUNDAY) # 日曜日始まり
@@ -346,11 +1904,17 @@ def index():
     # 今までの合計ランキング
     total_ranking = calculate_total_stay_time()
 
+    # 現在の在室者
+    presence = get_current_presence()
+
     return render_template('index.html', 
                            logs=access_logs,
                            monthly_ranking=monthly_ranking,
                            weekly_ranking=weekly_ranking,
                            total_ranking=total_ranking,
+                           presence=presence, # 現在の在室者
+                           live_event_id=live_event_id, # ライブフィードの接続開始位置
+                           ranking_week_start=current_ranking_periods()[0][0].isoformat(),
                            current_year=current_year, # 今月のランキング表示用
                            current_month=current_month, # 今月のランキング表示用
                            calendar_year=calendar_year, # カレンダー表示用
@@ -371,31 +1935,42 @@ def manage_users():
             idm = request.form['idm'].strip()
             name = request.form['name'].strip()
             if idm and name:
-                with app.app_context():
-                    existing_user = User.query.filter_by(idm=idm).first()
-                    if not existing_user:
-                        new_user = User(idm=idm, name=name)
-                        db.session.add(new_user)
-                        db.session.commit()
-                        flash(f'ユーザー "{name}" を追加しました。', 'success')
-                        send_discord_notification(name, 'ユーザー追加', success=True, details={'idm': idm})
-                    else:
-                        flash(f'エラー: IDm "{idm}" は既にユーザー "{existing_user.name}" に登録されています。', 'danger')
+                existing_user = User.query.filter_by(idm=idm).first()
+                if not existing_user:
+                    new_user = User(idm=idm, name=name)
+                    db.session.add(new_user)
+                    db.session.commit()
+                    user_cache.put_user(new_user.id, new_user.idm, new_user.name)
+                    notify_users_changed()
+                    flash(f'ユーザー "{name}" を追加しました。', 'success')
+                    send_discord_notification(name, 'ユーザー追加', success=True, details={'idm': idm})
+                else:
+                    flash(f'エラー: IDm "{idm}" は既にユーザー "{existing_user.name}" に登録されています。', 'danger')
             else:
                 flash('エラー: IDm と名前は必須です。', 'danger')
         elif action == 'delete' and user_id:
             if password == DELETE_PASSWORD: # パスワードチェック
-                with app.app_context():
-                    user_to_delete = User.query.get(user_id)
-                    if user_to_delete:
-                        deleted_name = user_to_delete.name
-                        AccessLog.query.filter_by(user_id=user_id).delete()
-                        db.session.delete(user_to_delete)
-                        db.session.commit()
-                        flash(f'ユーザー "{deleted_name}" を削除しました。', 'success')
-                        send_discord_notification(deleted_name, 'ユーザー削除', success=True)
-                    else:
-                        flash('エラー: ユーザーが見つかりませんでした。', 'danger')
+                user_to_delete = User.query.get(user_id)
+                if user_to_delete:
+                    deleted_name = user_to_delete.name
+                    deleted_id = user_to_delete.id
+                    # 未反映のタップを先に反映し、削除を終えるまで新しいタップを書き込ませない
+                    with tap_write_lock:
+                        if not flush_tap_journal():
+                            flash('エラー: 未反映のタップを書き込めなかったため、削除を中止しました。'
+                                  'しばらくしてからやり直してください。', 'danger')
+                            return redirect(url_for('manage_users'))
+                        try:
+                            delete_user_records(deleted_id, user=user_to_delete)
+                        except RuntimeError as e:
+                            flash(f'エラー: {e} 削除を中止しました。', 'danger')
+                            return redirect(url_for('manage_users'))
+                        user_cache.remove_user(deleted_id)
+                        notify_users_changed()
+                    flash(f'ユーザー "{deleted_name}" を削除しました。', 'success')
+                    send_discord_notification(deleted_name, 'ユーザー削除', success=True)
+                else:
+                    flash('エラー: ユーザーが見つかりませんでした。', 'danger')
             else:
                 flash('エラー: パスワードが間違っています。', 'danger')
         # POSTリクエストのどのパスでも最終的にリダイレクトするように変更
@@ -407,48 +1982,63 @@ def manage_users():
 
 @app.route('/users/edit/<int:user_id>', methods=['GET', 'POST'])
 def edit_user(user_id):
-    with app.app_context():
-        user = User.query.get_or_404(user_id)
+    user = User.query.get_or_404(user_id)
 
-        if request.method == 'POST':
-            old_name = user.name
-            old_idm = user.idm
-            new_name = request.form['name'].strip()
-            password = request.form.get('password') # パスワードを取得
+    if request.method == 'POST':
+        old_name = user.name
+        old_idm = user.idm
+        new_name = request.form['name'].strip()
+        password = request.form.get('password') # パスワードを取得
 
-            if password == DELETE_PASSWORD: # パスワードチェック
-                if new_name:
-                    user.name = new_name
-                    db.session.commit()
-                    flash(f'ユーザー "{old_name}" の情報を更新しました。', 'success')
-                    send_discord_notification(new_name, 'ユーザー更新', success=True, 
-                                            details={'old_name': old_name, 'new_name': new_name, 'old_idm': old_idm, 'new_idm': user.idm})
-                    return redirect(url_for('manage_users'))
-                else:
-                    flash('エラー: 名前は必須です。', 'danger')
+        if password == DELETE_PASSWORD: # パスワードチェック
+            if new_name:
+                user.name = new_name
+                db.session.commit()
+                # 過去の月のランキングにも名前が出るので、固定した結果も捨てる
+                result_cache.invalidate_all()
+                user_cache.put_user(user.id, user.idm, user.name)
+                notify_users_changed()
+                flash(f'ユーザー "{old_name}" の情報を更新しました。', 'success')
+                send_discord_notification(new_name, 'ユーザー更新', success=True, 
+                                        details={'old_name': old_name, 'new_name': new_name, 'old_idm': old_idm, 'new_idm': user.idm})
+                return redirect(url_for('manage_users'))
             else:
-                flash('エラー: パスワードが間違っています。', 'danger')
+                flash('エラー: 名前は必須です。', 'danger')
+        else:
+            flash('エラー: パスワードが間違っています。', 'danger')
         
-        return render_template('edit_user.html', user=user)
+    return render_template('edit_user.html', user=user)
 
 @app.route('/users/clear_logs/<int:user_id>', methods=['POST'])
 def clear_user_logs(user_id):
     password = request.form.get('password') # パスワードを取得
     if password == DELETE_PASSWORD: # パスワードチェック
-        with app.app_context():
-            user = User.query.get(user_id)
-            if user:
-                num_deleted = AccessLog.query.filter_by(user_id=user.id).delete()
-                db.session.commit()
-                flash(f'ユーザー "{user.name}" の入退室ログ {num_deleted} 件を削除しました。', 'success')
-                send_discord_notification(user.name, 'ログ削除', success=True, details={'deleted_count': num_deleted})
-            else:
-                flash('エラー: ログを削除するユーザーが見つかりませんでした。', 'danger')
+        user = User.query.get(user_id)
+        if user:
+            # 未反映のタップを先に反映し、削除を終えるまで新しいタップを書き込ませない
+            with tap_write_lock:
+                if not flush_tap_journal():
+                    flash('エラー: 未反映のタップを書き込めなかったため、ログの削除を中止しました。'
+                          'しばらくしてからやり直してください。', 'danger')
+                    return redirect(url_for('manage_users'))
+                try:
+                    num_deleted = delete_user_records(user.id)
+                except RuntimeError as e:
+                    flash(f'エラー: {e} ログの削除を中止しました。', 'danger')
+                    return redirect(url_for('manage_users'))
+                # ログがなくなったので次のタップは入室になる
+                user_cache.set_status(user.id, None)
+                notify_users_changed()
+            flash(f'ユーザー "{user.name}" の入退室ログ {num_deleted} 件を削除しました。', 'success')
+            send_discord_notification(user.name, 'ログ削除', success=True, details={'deleted_count': num_deleted})
+        else:
+            flash('エラー: ログを削除するユーザーが見つかりませんでした。', 'danger')
     else:
         flash('エラー: パスワードが間違っています。', 'danger')
     return redirect(url_for('manage_users'))
 
 @app.route('/ranking')
+@conditional_page
 def show_ranking():
     current_year = datetime.now().year
     current_month = datetime.now().month
@@ -459,220 +2049,801 @@ def show_ranking():
     if not (1 <= month <= 12):
         month = current_month
     
-    with app.app_context():
-        ranking = calculate_monthly_stay_time(year, month)
+    ranking = calculate_monthly_stay_time(year, month)
     
     return render_template('ranking.html', ranking=ranking, selected_year=year, selected_month=month, datetime=datetime)
 
+@app.route('/api/calendar/<int:year>/<int:month>')
+def calendar_api(year, month):
+    """指定した月の日ごとの在室者を JSON で返す（ETag で更新がなければ 304）"""
+    if not (1 <= month <= 12 and 1 <= year <= 9998):
+        return jsonify({'error': 'invalid month'}), 404
+    body = get_calendar_month_json(year, month)
+    response = Response(body, mimetype='application/json')
+    response.set_etag(hashlib.sha1(body).hexdigest())
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
+def load_current_presence():
+    """presence テーブルから、いま在室しているユーザーを入室の早い順に返します。"""
+    rows = db.session.query(Presence.user_id, User.name, Presence.since).join(
+        User, User.id == Presence.user_id
+    ).filter(Presence.status == '入室').order_by(Presence.since).all()
+    return {
+        'count': len(rows),
+        'users': [{'user_id': user_id, 'name': name, 'since': since.isoformat()}
+                  for user_id, name, since in rows],
+    }
 
-# --- Excelファイルにログを記録する関数 ---
-def update_excel_log():
-    excel_file_path = "access_logs.xlsx"
+def get_current_presence():
+    """現在の在室者（タップや自動退室があるまでキャッシュから返す）"""
+    return result_cache.get_or_compute(('current_presence',), load_current_presence)
+
+@app.route('/api/presence')
+def presence_api():
+    """いま在室しているユーザーと人数を JSON で返す（ETag で更新がなければ 304）"""
+    body = json.dumps(get_current_presence(), ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    response = Response(body, mimetype='application/json')
+    response.set_etag(hashlib.sha1(body).hexdigest())
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
+def _history_page_args():
+    """履歴の画面・API 共通のクエリパラメータを (検索条件, カーソル, 件数) にします。"""
+    filters = parse_history_filters(request.args)
+    cursor = request.args.get('cursor')
+    after = decode_history_cursor(cursor) if cursor else None
+    limit = request.args.get('limit', type=int, default=HISTORY_PAGE_SIZE)
+    return filters, after, max(1, min(limit, HISTORY_MAX_PAGE_SIZE))
+
+@app.route('/history')
+def show_history():
+    try:
+        filters, after, limit = _history_page_args()
+    except ValueError as e:
+        flash(f'エラー: {e}', 'danger')
+        return redirect(url_for('show_history'))
+
+    entries = query_access_history(after=after, limit=limit + 1, **filters)
+    next_cursor = encode_history_cursor(entries[limit - 1]) if len(entries) > limit else None
+    page_args = {key: value for key, value in request.args.items() if key != 'cursor'}
+    return render_template('history.html',
+                           entries=entries[:limit],
+                           users=sorted(load_user_names().items(), key=lambda item: item[1]),
+                           filters=request.args,
+                           next_url=url_for('show_history', cursor=next_cursor, **page_args) if next_cursor else None,
+                           first_url=url_for('show_history', **page_args) if after else None)
+
+@app.route('/api/history')
+def history_api():
+    """入退室履歴を JSON で1ページずつ返す（next_cursor を cursor に渡すと続きを取得）"""
+    try:
+        filters, after, limit = _history_page_args()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    entries = query_access_history(after=after, limit=limit + 1, **filters)
+    return jsonify({
+        'items': [history_entry_to_dict(entry) for entry in entries[:limit]],
+        'next_cursor': encode_history_cursor(entries[limit - 1]) if len(entries) > limit else None,
+    })
+
+@app.route('/api/history/stream')
+def history_stream_api():
+    """
+    条件に合う入退室履歴をすべて NDJSON（1行に1件の JSON）でストリーミングして返す。
+    大きな期間でも一度にメモリに載せず、少しずつ読み込みながら送る。
+    """
+    try:
+        filters = parse_history_filters(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
 
-    # データベースから全期間のログを取得
-    with app.app_context():
-        all_logs = AccessLog.query.order_by(AccessLog.timestamp).all()
-        all_users = User.query.all()
-    
-    # ユーザー名とIDの紐づけ
-    user_names = {user.id: user.name for user in all_users}
+    def generate():
+        for entry in iter_access_history(**filters):
+            yield json.dumps(history_entry_to_dict(entry), ensure_ascii=False) + '\n'
 
-    # ユーザーごと、日ごとのセッションデータを集計
-    user_daily_sessions = defaultdict(lambda: defaultdict(list))
-    for log in all_logs:
-        log_date = log.timestamp.date()
-        user_daily_sessions[log.user_id][log_date].append(log)
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
 
-    # Excelブックを新規作成
-    workbook = Workbook()
-    
-    # ユーザーごとにシートを作成
-    for user_id, daily_data in user_daily_sessions.items():
-        user_name = user_names.get(user_id, f"不明なユーザー({user_id})")
-        
-        # シート名に使用できない文字を置き換える
-        safe_sheet_name = user_name.replace('[', '').replace(']', '').replace(':', '').replace('/', '').replace('\\', '').replace('?', '').replace('*', '')
-        
-        # 既に存在しているデフォルトのシートを削除
-        if "Sheet" in workbook.sheetnames:
-            workbook.remove(workbook["Sheet"])
+@app.route('/stats/cache')
+def cache_stats():
+    """集計結果キャッシュのヒット/ミス数を JSON で返す"""
+    return jsonify(result_cache.stats())
 
-        # 新しいシートを作成
-        sheet = workbook.create_sheet(title=safe_sheet_name)
-        
-        # ヘッダー行を書き込む
-        sheet.append(["日付", "入室/退室記録", "合計滞在時間"])
+@app.route('/metrics')
+def metrics():
+    """タップ処理・通知・定期実行タスクのメトリクスを Prometheus のテキスト形式で返す"""
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
 
-        # 全期間のログから最初と最後の月を取得
-        if all_logs:
-            start_month = all_logs[0].timestamp.replace(day=1)
-            end_month = all_logs[-1].timestamp.replace(day=1)
-        else:
-            # ログがない場合は今月を使用
-            today = datetime.now()
-            start_month = today.replace(day=1)
-            end_month = today.replace(day=1)
-        
-        current_month = start_month
-        while current_month <= end_month:
-            # 月の最初の日と最後の日を取得
-            first_day = current_month.date()
-            _, last_day_of_month = calendar.monthrange(current_month.year, current_month.month)
-            last_day = current_month.replace(day=last_day_of_month).date()
-
-            # 月ごとのデータを書き込む
-            sheet.append([f"--- {current_month.strftime('%Y年%m月')} ---", "", ""])
-            
-            # 1日から月末までループ
-            for single_day_num in range(1, last_day_of_month + 1):
-                current_day = current_month.replace(day=single_day_num).date()
-
-                if current_day in daily_data:
-                    # アクセスがあった日の処理
-                    logs_on_day = daily_data[current_day]
-                    in_out_times = []
-                    total_stay_duration = timedelta(0)
-                    entry_time = None
-                    
-                    for log in logs_on_day:
-                        if log.status == '入室':
-                            entry_time = log.timestamp
-                        elif log.status == '退室' and entry_time:
-                            duration = log.timestamp - entry_time
-                            total_stay_duration += duration
-                            in_out_times.append(f"{entry_time.strftime('%H:%M')}-{log.timestamp.strftime('%H:%M')}")
-                            entry_time = None
-                    
-                    if entry_time:
-                        in_out_times.append(f"{entry_time.strftime('%H:%M')}-未退室")
-                        total_stay_duration += datetime.now() - entry_time
-                    
-                    # Excelの行データを作成
-                    in_out_string = ", ".join(in_out_times)
-                    total_seconds = total_stay_duration.total_seconds()
-                    hours = int(total_seconds // 3600)
-                    minutes = int((total_seconds % 3600) // 60)
-                    seconds = int(total_seconds % 60)
-                    formatted_duration = f"{hours:02}:{minutes:02}:{seconds:02}"
-                    
-                    sheet.append([current_day.strftime('%Y-%m-%d'), in_out_string, formatted_duration])
-                else:
-                    # アクセスがなかった日の処理
-                    sheet.append([current_day.strftime('%Y-%m-%d'), "", ""])
 
-            # 次の月に進む
-            if current_month.month == 12:
-                current_month = current_month.replace(year=current_month.year + 1, month=1)
+# --- Excelファイルにログを記録する関数 ---
+# 毎分呼び出されるが、前回の書き出しからデータが変わっていなければ何もしない。
+# 変わっていればブック全体を書き直す（変わっていない月を前回のブックから読んで写すと、
+# 時間の大半が XML の読み書きのため、書き直すより遅くなる。excel_bench.py を参照）。
+# ブックは書き込み専用モードで、セッションをユーザー・入室時刻順にカーソルで読みながら
+# 1か月分ずつ書き出すため、履歴が長くなってもメモリ使用量は増えない。
+# 各シートはそのユーザーが最初に利用した月から最後に利用した月までを含む。
+EXCEL_LOG_PATH = "access_logs.xlsx"
+EXCEL_HEADER = ["日付", "入室/退室記録", "合計滞在時間"]
+EXCEL_OPEN_STAY_REFRESH = 5 * 60 # 未退室の滞在時間を更新する間隔（秒）
+
+excel_export = ExcelExportTracker(open_stay_refresh=EXCEL_OPEN_STAY_REFRESH)
+
+def _excel_sheet_title(user_id, user_names):
+    user_name = user_names.get(user_id, f"不明なユーザー({user_id})")
+    # シート名に使用できない文字を置き換える
+    return user_name.replace('[', '').replace(']', '').replace(':', '').replace('/', '').replace('\\', '').replace('?', '').replace('*', '')
+
+def _excel_month_rows(month_start, daily_data, now):
+    """
+    1か月分の行（見出し行と、1日から月末までの各日の行）を返します。
+    daily_data は {入室日: 滞在のリスト}。未退室の滞在は now までの時間を数えます。
+    """
+    rows = [[month_marker(month_start), "", ""]]
+    _, last_day_of_month = calendar.monthrange(month_start.year, month_start.month)
+    for single_day_num in range(1, last_day_of_month + 1):
+        current_day = month_start.replace(day=single_day_num)
+        stays = daily_data.get(current_day)
+        if not stays:
+            # アクセスがなかった日の処理
+            rows.append([current_day.strftime('%Y-%m-%d'), "", ""])
+            continue
+
+        in_out_times = []
+        total_seconds = 0
+        for stay in stays:
+            if stay.exit_ts:
+                total_seconds += stay.duration_seconds
+                in_out_times.append(f"{stay.entry_ts.strftime('%H:%M')}-{stay.exit_ts.strftime('%H:%M')}")
             else:
-                current_month = current_month.replace(month=current_month.month + 1)
+                in_out_times.append(f"{stay.entry_ts.strftime('%H:%M')}-未退室")
+                total_seconds += (now - stay.entry_ts).total_seconds()
+        rows.append([current_day.strftime('%Y-%m-%d'), ", ".join(in_out_times), _format_duration(total_seconds)])
+    return rows
 
-    # 最終的にExcelファイルを保存
-    workbook.save(excel_file_path)
+def _empty_month_rows(month_start, now):
+    return _excel_month_rows(month_start, {}, now)
+
+def _clip_month_blocks(blocks, now):
+    """
+    (月の初日, 行のリスト) を月の順に受け取り、そのユーザーが最初に利用した月から
+    最後に利用した月までの行を返します。間の月が抜けていれば空の月で埋めます。
+    """
+    waiting = []  # 利用のない月（このあと利用のある月が来たら書き出す）
+    started = False
+    last_month = None
+    for month_start, rows in blocks:
+        if last_month is not None:
+            gap = _next_month(last_month)
+            while gap < month_start:
+                waiting.append(gap)
+                gap = _next_month(gap)
+        last_month = month_start
+        if not block_has_stays(rows):
+            waiting.append(month_start)
+            continue
+        if started:
+            for empty_month in waiting:
+                yield from _empty_month_rows(empty_month, now)
+        waiting = []
+        started = True
+        yield from rows
+
+def _stay_month_blocks(stays, now, open_stays):
+    """
+    1人分の滞在（入室時刻順）を入室した月ごとにまとめて (月の初日, 行のリスト) を返します。
+    未退室の滞在がある月は open_stays に (user_id, 月の初日) を追加します。
+    """
+    for month_start, month_stays in itertools.groupby(stays, key=lambda stay: stay.entry_ts.date().replace(day=1)):
+        daily_data = defaultdict(list)
+        for stay in month_stays:
+            daily_data[stay.entry_ts.date()].append(stay)
+            if stay.exit_ts is None:
+                open_stays.add((stay.user_id, month_start))
+        yield month_start, _excel_month_rows(month_start, daily_data, now)
+
+def _write_sheet(sheet, header, rows):
+    """ヘッダー行と行を順に書き込み、書き込んだ行数を返します。"""
+    sheet.append(header)
+    count = 1
+    for row in rows:
+        sheet.append(row)
+        count += 1
+    return count
+
+def iter_all_session_tuples_by_user(start=None, end=None, user_ids=None):
+    """
+    アーカイブした月と DB の滞在セッションを、ユーザー・入室時刻順に1件ずつ返します。
+    start / end を指定した場合は、入室時刻が [start, end) にあるセッションだけを返します。
+    アーカイブは月ごとのファイルを並行して読み、DB はカーソルで読むため、
+    全期間のセッションを一度にメモリに載せません。
+    """
+    # 月のアーカイブにはその月に退室したセッションが入っているので、start より前に終わる月は読まない
+    sources = [iter_archived_session_tuples(month) for month, month_end in archived_month_ranges()
+               if start is None or month_end > start.date()]
+    sources.append(iter_stay_session_tuples(start, end, user_ids))
+    user_id_set = set(user_ids) if user_ids is not None else None
+    for stay in heapq.merge(*sources, key=lambda stay: (stay.user_id, stay.entry_ts)):
+        if start is not None and stay.entry_ts < start:
+            continue
+        if end is not None and stay.entry_ts >= end:
+            continue
+        if user_id_set is not None and stay.user_id not in user_id_set:
+            continue
+        yield stay
+
+def write_excel_log(now, path=EXCEL_LOG_PATH):
+    """
+    全期間のブックを書き込み専用モードで作り直します。
+    セッションをユーザー・入室時刻順に流しながら1か月ずつ書き出すため、メモリに載るのは
+    1人の1か月分の行だけです。各シートはそのユーザーが利用した月の範囲だけを含みます。
+    (書き込んだ行数, 未退室の滞在があったか) を返します。
+    """
+    # ユーザー名とIDの紐づけ（1回のクエリでまとめて取得）
+    user_names = load_user_names()
+
+    workbook = Workbook(write_only=True)
+    open_stays = set()
+    row_count = 0
+    for user_id, stays in itertools.groupby(iter_all_session_tuples_by_user(), key=lambda stay: stay.user_id):
+        sheet = workbook.create_sheet(title=_excel_sheet_title(user_id, user_names))
+        row_count += _write_sheet(sheet, EXCEL_HEADER,
+                                  _clip_month_blocks(_stay_month_blocks(stays, now, open_stays), now))
+    if row_count == 0:
+        # シートが1枚もないと保存できないため
+        workbook.create_sheet(title="Sheet")
+
+    save_workbook_atomically(workbook, path)
+    return row_count, bool(open_stays)
+
+def update_excel_log():
+    """
+    Excelログを更新します。前回からデータが変わっていなければ何もしません。
+    更新した場合は True を返します。
+    """
+    data_version = result_cache.data_version
+    if not excel_export.needs_export(data_version, os.path.exists(EXCEL_LOG_PATH)):
+        EXCEL_EXPORTS_TOTAL.inc(result='skipped')
+        return False
+    row_count, has_open_stays = report_pool.run('excel_log', datetime.now())
+    excel_export.done(data_version, has_open_stays)
+    EXCEL_EXPORTS_TOTAL.inc(result='written')
+    EXCEL_ROWS_WRITTEN_TOTAL.inc(row_count)
     print("Excelログを更新しました。")
+    return True
+
+
+# --- 期間を指定したエクスポート（CSV / XLSX） ---
+# 指定したユーザー・期間の滞在セッションを1行ずつ書き出す。行数が少なければその場で
+# ストリーミングして返し、多ければバックグラウンドのジョブで作成して状態確認・ダウンロード用の
+# URL を返す。作成したファイルはパラメータとデータバージョンをキーに保存しておき、
+# 締まった期間（給与計算の月次など）なら何度ダウンロードしても作り直さない。
+EXPORT_DIR = os.path.join(app.instance_path, 'exports')
+EXPORT_STREAM_MAX_ROWS = 5000 # これより多い場合はバックグラウンドで作成する
+EXPORT_CSV_CHUNK_ROWS = 500
+EXPORT_HEADER = ["ユーザーID", "ユーザー名", "日付", "入室", "退室", "滞在時間", "滞在秒数"]
+EXPORT_FORMATS = {
+    'csv': 'text/csv; charset=utf-8',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+}
+# 再起動するとデータバージョンが 0 からやり直しになるため、キーに起動ごとの値を含める
+# （複数ワーカーの場合は、どのプロセスでも同じキーになるようにサーバーの起動ごとの値）
+EXPORT_BOOT_ID = worker_state.token if worker_state else uuid.uuid4().hex
+
+export_jobs = ExportJobManager(EXPORT_DIR, shared=worker_state is not None)
+
+def parse_export_params(args):
+    """
+    クエリパラメータ（user_id, from, to, format）からエクスポートの条件を作ります。
+    user_id は複数指定（user_id=1&user_id=2 または user_id=1,2）でき、省略すると全員です。
+    from / to は日付（YYYY-MM-DD）で、to の日も含みます。不正な値は ValueError。
+    """
+    user_ids = set()
+    for value in args.getlist('user_id'):
+        for part in value.split(','):
+            if not part.strip():
+                continue
+            try:
+                user_ids.add(int(part))
+            except ValueError:
+                raise ValueError(f"不正なユーザーIDです: {part}")
+    filters = parse_history_filters({key: args.get(key) for key in ('from', 'to')})
+    start, end = filters.get('start'), filters.get('end')
+    if start is not None and end is not None and start >= end:
+        raise ValueError("期間の開始日が終了日より後になっています。")
+    export_format = args.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"不正な形式です: {export_format}（csv または xlsx）")
+    return {
+        'user_ids': tuple(sorted(user_ids)) or None,
+        'start': start,
+        'end': end,
+        'format': export_format,
+    }
+
+def export_filename(params):
+    start = params['start'].strftime('%Y%m%d') if params['start'] else 'all'
+    end = (params['end'] - timedelta(days=1)).strftime('%Y%m%d') if params['end'] else 'all'
+    return f"stays_{start}_{end}.{params['format']}"
+
+def export_artifact_id(params):
+    """
+    パラメータとデータバージョンから作成済みファイルのキーを作ります。
+    締まった期間はデータが変わらないため、最初に作成したときのバージョンを固定して使い、
+    その後のタップではキーが変わらないようにします（ユーザー名の変更などでは変わる）。
+    """
+    description = json.dumps(
+        [params['user_ids'], params['start'] and params['start'].isoformat(),
+         params['end'] and params['end'].isoformat(), params['format']])
+    closed = params['end'] is not None and is_closed_period(params['end'].date())
+    version = result_cache.get_or_compute(
+        ('export_version', description), lambda: result_cache.data_version, pin=closed)
+    return hashlib.sha1(f"{EXPORT_BOOT_ID}|{version}|{description}".encode('utf-8')).hexdigest()[:24]
+
+def estimate_export_rows(params):
+    """エクスポートの行数の見積もり（アーカイブした月は月のセッション数をそのまま足す）"""
+    query = db.session.query(db.func.count(StaySession.id))
+    if params['start'] is not None:
+        query = query.filter(StaySession.entry_ts >= params['start'])
+    if params['end'] is not None:
+        query = query.filter(StaySession.entry_ts < params['end'])
+    if params['user_ids'] is not None:
+        query = query.filter(StaySession.user_id.in_(params['user_ids']))
+    count = query.scalar()
+    archived = db.session.query(db.func.sum(ArchivedMonth.session_count))
+    if params['start'] is not None:
+        archived = archived.filter(ArchivedMonth.month >= params['start'].date().replace(day=1))
+    if params['end'] is not None:
+        archived = archived.filter(ArchivedMonth.month < params['end'].date())
+    return count + (archived.scalar() or 0)
+
+def iter_export_rows(params, now=None):
+    """エクスポートする行（ヘッダーを除く）をユーザー・入室時刻順に返します。"""
+    now = now or datetime.now()
+    user_names = load_user_names(params['user_ids'])
+    for stay in iter_all_session_tuples_by_user(params['start'], params['end'], params['user_ids']):
+        if stay.exit_ts is not None:
+            exit_text, seconds = stay.exit_ts.strftime('%Y-%m-%d %H:%M:%S'), stay.duration_seconds
+        else:
+            exit_text, seconds = "未退室", (now - stay.entry_ts).total_seconds()
+        yield [stay.user_id, display_user_name(stay.user_id, user_names.get(stay.user_id)),
+               stay.entry_ts.strftime('%Y-%m-%d'), stay.entry_ts.strftime('%Y-%m-%d %H:%M:%S'),
+               exit_text, _format_duration(seconds), round(seconds)]
+
+def iter_export_csv(rows):
+    """CSV を少しずつ文字列で返します（Excel で開けるように BOM を付ける）。"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    buffer.write('\ufeff')
+    writer.writerow(EXPORT_HEADER)
+    for count, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if count % EXPORT_CSV_CHUNK_ROWS == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+def write_export_file(params, path):
+    """エクスポートをファイルに書き出し、書いた行数を返します。"""
+    row_count = 0
+    def counted(rows):
+        nonlocal row_count
+        for row in rows:
+            row_count += 1
+            yield row
+
+    if params['format'] == 'csv':
+        with open(path, 'w', encoding='utf-8', newline='') as f:
+            for chunk in iter_export_csv(counted(iter_export_rows(params))):
+                f.write(chunk)
+    else:
+        workbook = Workbook(write_only=True)
+        sheet = workbook.create_sheet(title="滞在記録")
+        sheet.append(EXPORT_HEADER)
+        for row in counted(iter_export_rows(params)):
+            sheet.append(row)
+        workbook.save(path)
+    return row_count
+
+def _export_job_generate(params):
+    def generate(job, path):
+        report = report_pool.submit('export_file', params, path, timeout=EXPORT_REPORT_TIMEOUT)
+        job.on_cancel = lambda: report_pool.cancel(report.id)
+        if job.cancel_requested:
+            report_pool.cancel(report.id)
+        return report.wait(report.timeout + 5)
+    return generate
+
+def export_job_to_dict(job):
+    data = job.to_dict()
+    data['status_url'] = url_for('export_status_api', job_id=job.id)
+    data['download_url'] = url_for('export_download_api', job_id=job.id) if job.status == 'done' else None
+    return data
+
+@app.route('/api/export')
+def export_api():
+    """
+    滞在記録を CSV / XLSX でエクスポートする。
+    行数が少なければそのまま返し、多ければ 202 とジョブの状態確認用の URL を返す。
+    """
+    try:
+        params = parse_export_params(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    job_id = export_artifact_id(params)
+    job = export_jobs.get(job_id)
+    if job is not None and job.status == 'done':
+        EXPORT_REQUESTS_TOTAL.inc(mode='cached')
+        return send_file(job.path, mimetype=job.mimetype, as_attachment=True, download_name=job.filename)
+
+    filename = export_filename(params)
+    mimetype = EXPORT_FORMATS[params['format']]
+    if job is None and estimate_export_rows(params) <= EXPORT_STREAM_MAX_ROWS:
+        EXPORT_REQUESTS_TOTAL.inc(mode='direct')
+        headers = {'Content-Disposition': f'attachment; filename="{filename}"'}
+        if params['format'] == 'csv':
+            return Response(stream_with_context(iter_export_csv(iter_export_rows(params))),
+                            mimetype=mimetype, headers=headers)
+        buffer = io.BytesIO()
+        write_export_file(params, buffer)
+        return Response(buffer.getvalue(), mimetype=mimetype, headers=headers)
+
+    EXPORT_REQUESTS_TOTAL.inc(mode='background')
+    job = export_jobs.submit(job_id, filename, mimetype, _export_job_generate(params))
+    response = jsonify(export_job_to_dict(job))
+    response.status_code = 202
+    response.headers['Location'] = url_for('export_status_api', job_id=job.id)
+    return response
+
+@app.route('/api/exports/<job_id>')
+def export_status_api(job_id):
+    """バックグラウンドのエクスポートの状態を返す"""
+    job = export_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'エクスポートが見つかりません。'}), 404
+    return jsonify(export_job_to_dict(job))
+
+@app.route('/api/exports/<job_id>', methods=['DELETE'])
+def export_cancel_api(job_id):
+    """作成中のエクスポートを取り消す"""
+    job = export_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'エクスポートが見つかりません。'}), 404
+    if not export_jobs.cancel(job_id):
+        return jsonify(export_job_to_dict(job)), 409
+    return jsonify(export_job_to_dict(job))
+
+@app.route('/api/exports/<job_id>/download')
+def export_download_api(job_id):
+    """作成済みのエクスポートをダウンロードする"""
+    job = export_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'エクスポートが見つかりません。'}), 404
+    if job.status != 'done':
+        return jsonify(export_job_to_dict(job)), 409
+    return send_file(job.path, mimetype=job.mimetype, as_attachment=True, download_name=job.filename)
+
+
+# --- レポート作成のプロセスプール ---
+# Excel ログと期間指定のエクスポートは CPU を使う Python の処理なので、
+# 別プロセスで実行し、タップ処理や Web のスレッドと GIL を取り合わないようにする。
+# ランキングは daily_stay の集計クエリだけで軽く、プロセス間の受け渡しのほうが高くつくため、
+# このプロセスで計算する。
+# 環境変数 ACCESS_CONTROL_REPORT_WORKERS でワーカー数を変えられる（0 でこのプロセスで実行）。
+REPORT_POOL_WORKERS = int(os.environ.get('ACCESS_CONTROL_REPORT_WORKERS', '1'))
+REPORT_TIMEOUT = 5 * 60 # 秒
+EXPORT_REPORT_TIMEOUT = 10 * 60
+
+# ワーカープロセスで実行できるレポート（名前: 関数）
+REPORT_TASKS = {
+    'excel_log': write_excel_log,
+    'export_file': write_export_file,
+}
+
+def run_report_task(name, *args):
+    """ワーカープロセスで REPORT_TASKS の関数を app_context 内で実行します。"""
+    with app.app_context():
+        return REPORT_TASKS[name](*args)
+
+def _record_report_job(job, seconds):
+    REPORT_JOBS_TOTAL.inc(task=job.name, result=job.status)
+    REPORT_JOB_SECONDS.observe(seconds, task=job.name)
+
+report_pool = ReportPool(run_report_task, workers=REPORT_POOL_WORKERS,
+                         default_timeout=REPORT_TIMEOUT, on_finish=_record_report_job)
+
+REGISTRY.gauge('report_pool_queued', 'Report jobs waiting for a worker process.',
+               callback=report_pool.queued_count)
+
+@app.route('/stats/reports')
+def report_stats():
+    """レポート作成のプロセスプールの状態を JSON で返す"""
+    return jsonify(report_pool.stats())
 
 
 # --- 定期実行タスク ---
-last_auto_sign_out_date = None
+# 時刻指定のタスクが最後に実行された予定時刻（停止中に過ぎた実行を起動時に取り戻すため）
+SCHEDULER_STATE_PATH = os.path.join(app.instance_path, 'scheduler_state.json')
+EXCEL_LOG_INTERVAL = 60 # 秒
+
+def run_scheduled_job(job_name, func, *args):
+    """定期実行タスクを実行し、実行時間と結果をメトリクスに記録します。成功したら True を返します。"""
+    try:
+        with JOB_DURATION_SECONDS.time(job=job_name), app.app_context():
+            func(*args)
+        JOB_RUNS_TOTAL.inc(job=job_name, result='success')
+        return True
+    except Exception as e:
+        JOB_RUNS_TOTAL.inc(job=job_name, result='error')
+        print(f"定期実行タスク {job_name} でエラーが発生しました: {e}")
+        return False
+
+scheduler = Scheduler(run_scheduled_job, SCHEDULER_STATE_PATH)
+# 毎日23:59に自動退室処理を実行（停止中に過ぎた日の分も、その日の23:59の時刻で記録する）
+scheduler.daily('auto_sign_out', 23, 59, lambda scheduled_at: auto_sign_out(scheduled_at))
+# 毎月1日の3:00に古い月をアーカイブ（停止中に過ぎた場合は起動時に1回だけ実行する）
+scheduler.monthly('archive_old_months', 1, 3, 0, lambda scheduled_at: archive_old_months())
+# Excelログの更新
+scheduler.every('update_excel_log', EXCEL_LOG_INTERVAL, update_excel_log)
 
 def scheduled_system_notifications():
     """
-    Excelログの更新と自動退室処理を定期的に実行するスレッド
+    Excelログの更新と自動退室処理などの定期実行タスクを開始します。
+    タスクはそれぞれ専用のスレッドで実行されるため、互いに待たせることはありません。
     """
-    global last_auto_sign_out_date
-    while True:
-        now = datetime.now()
-        
-        # --- 毎日23:59に自動退室処理を実行 ---
-        if now.hour == 23 and now.minute == 59 and now.date() != last_auto_sign_out_date:
-            with app.app_context():
-                auto_sign_out()
-            last_auto_sign_out_date = now.date()
-
-        # --- Excelログの更新 ---
-        # この処理も app_context 内で行う
-        with app.app_context():
-            update_excel_log()
-            
-        # 1分待機
-        time.sleep(1 * 60)
-        
+    scheduler.start()
+
+@app.route('/stats/scheduler')
+def scheduler_stats():
+    """定期実行タスクの次回・前回の実行時刻を JSON で返す"""
+    return jsonify(scheduler.stats())
+
+def find_open_sessions(cutoff):
+    """cutoff より前に入室して、まだ退室していないセッションの (user_id, 入室時刻, 名前) を返します。"""
+    return db.session.query(StaySession.user_id, StaySession.entry_ts, User.name).join(
+        User, User.id == StaySession.user_id
+    ).filter(
+        StaySession.exit_ts.is_(None),
+        StaySession.entry_ts < cutoff
+    ).all()
 
-def auto_sign_out():
+def close_open_sessions(cutoff):
     """
-    退室忘れユーザーを自動的に退室させる関数
-    毎日 23:59 に実行することを想定
+    cutoff より前に入室したまま退室していないユーザー全員の退室を、cutoff の時刻で記録します。
+    退室ログの追加・セッションを閉じる・在室状態と日ごとの集計の更新を、人数によらず
+    まとめて1つのトランザクションで行います。閉じたセッションの (user_id, 入室時刻, 名前) を返します。
+    app_context 内で、ジャーナルを反映した後に呼び出すこと。
     """
-# --- auto_sign_out 関数を修正 ---
-def auto_sign_out():
+    open_sessions = find_open_sessions(cutoff)
+    if not open_sessions:
+        return []
+    params = {'cutoff': _sql_datetime(cutoff)}
+    try:
+        db.session.execute(db.text("""
+            INSERT INTO access_log (user_id, status, reader, timestamp)
+            SELECT user_id, '退室', NULL, :cutoff FROM sessions
+            WHERE exit_ts IS NULL AND entry_ts < :cutoff
+            ORDER BY user_id
+            """), params)
+        db.session.execute(db.text("""
+            INSERT INTO presence (user_id, status, since)
+            SELECT user_id, '退室', :cutoff FROM sessions
+            WHERE exit_ts IS NULL AND entry_ts < :cutoff
+            ON CONFLICT (user_id) DO UPDATE SET status = excluded.status, since = excluded.since
+            WHERE excluded.since >= presence.since
+            """), params)
+        db.session.execute(db.text(f"""
+            UPDATE sessions
+            SET exit_ts = :cutoff, auto_closed = 1,
+                duration_seconds = {_epoch_seconds_sql(':cutoff')} - {_epoch_seconds_sql('entry_ts')}
+            WHERE exit_ts IS NULL AND entry_ts < :cutoff
+            """), params)
+
+        daily = defaultdict(float)
+        presence = defaultdict(set)
+        for user_id, entry_ts, _ in open_sessions:
+            for day, seconds in split_stay_by_day(entry_ts, cutoff):
+                daily[(user_id, day)] += seconds
+                presence[day].add(user_id)
+        statement = sqlite_insert(DailyStay)
+        db.session.execute(statement.on_conflict_do_update(
+            index_elements=['user_id', 'date'],
+            set_={'seconds': DailyStay.seconds + statement.excluded.seconds,
+                  'session_count': DailyStay.session_count + statement.excluded.session_count}
+        ), [{'user_id': user_id, 'date': day, 'seconds': seconds, 'session_count': 1}
+            for (user_id, day), seconds in daily.items()])
+        mark_presence(presence)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    result_cache.bump()
+    publish_live_events([(user_id, '退室', cutoff, True) for user_id, _, _ in open_sessions],
+                        [(user_id, entry_ts, cutoff) for user_id, entry_ts, _ in open_sessions])
+    return open_sessions
+
+# 自動退室の通知1件に載せる人数（Discord のメッセージの長さの上限に収めるため）
+AUTO_SIGN_OUT_NOTIFY_CHUNK = 40
+
+def auto_sign_out(cutoff=None):
     """
     退室忘れユーザーを自動的に退室させる関数
-    毎日 23:59 に実行することを想定
+    毎日 23:59 に実行することを想定（cutoff はその予定時刻。省略すると現在時刻）
     """
     # この関数全体を `with app.app_context():` で囲む必要はない
     # なぜなら、呼び出し元で既に囲まれているから。
-    subquery = db.session.query(
-        AccessLog.user_id,
-        db.func.max(AccessLog.timestamp).label('last_timestamp')
-    ).group_by(AccessLog.user_id).subquery()
-
-    users_to_sign_out = db.session.query(User).join(AccessLog).filter(
-        AccessLog.user_id == subquery.c.user_id,
-        AccessLog.timestamp == subquery.c.last_timestamp,
-        AccessLog.status == '入室'
-    ).all()
-
+    cutoff = cutoff or datetime.now()
 
-    if users_to_sign_out:
-        now = datetime.now()
-        # 誰かがいた場合のみ通知
-        print(f"退室忘れのユーザーが{len(users_to_sign_out)}人いました。自動退室を記録します。")
+    # ジャーナルに残っているタップを先に反映してから判定する。
+    # 書き込みの間にタップが割り込まないよう、タップと同じロックを持って行う
+    with tap_write_lock:
+        tap_journal.flush()
+        signed_out = close_open_sessions(cutoff)
+        for user_id, _, _ in signed_out:
+            user_cache.set_status(user_id, '退室')
 
-        for user in users_to_sign_out:
-            print(f"ユーザー '{user.name}' の自動退室を記録中...")
-
-            # 新しい退室ログを作成
-            log_entry = AccessLog(user_id=user.id, status='退室', timestamp=now)
-            db.session.add(log_entry)
-            db.session.commit()
-            
-            # Discordに個別の通知を送信
-            send_discord_message(
-                DISCORD_SYSTEM_MONITOR_WEBHOOK_URL,
-                f"🚪 {user.name} さんの退室を、23:59に自動的に記録しました。",
-                username="自動退室Bot"
-            )
-        # すべての処理が完了した後に、まとめて完了通知を送ることもできます
-        # send_discord_message(
-        #     DISCORD_SYSTEM_MONITOR_WEBHOOK_URL,
-        #     f"✅ {len(users_to_sign_out)}人の自動退室処理が完了しました。",
-        #     username="自動退室Bot"
-        # )
-    else:
+    if not signed_out:
         # 退室忘れのユーザーがいなかった場合は何も通知しない
         print("退室忘れのユーザーはいませんでした。")
+        return 0
+
+    print(f"退室忘れのユーザーが{len(signed_out)}人いました。自動退室を記録しました。")
+    names = [name for _, _, name in signed_out]
+    when = cutoff.strftime('%H:%M') if cutoff.date() == date.today() else cutoff.strftime('%m/%d %H:%M')
+    # Discordに通知（人数が多い場合は何件かに分けて送る）
+    for i in range(0, len(names), AUTO_SIGN_OUT_NOTIFY_CHUNK):
+        chunk = names[i:i + AUTO_SIGN_OUT_NOTIFY_CHUNK]
+        send_discord_message(
+            DISCORD_SYSTEM_MONITOR_WEBHOOK_URL,
+            f"🚪 {when}に、次の{len(chunk)}人の退室を自動的に記録しました: " + "、".join(chunk),
+            username="自動退室Bot",
+            coalesce_key='auto_sign_out'
+        )
+    return len(signed_out)
+
+
+
+# --- リーダーの選出と停止 ---
+# python app.py では起動したプロセスがそのままリーダーになる。gunicorn.conf.py で起動した場合は
+# 各ワーカーの worker_sync_loop() がリーダーのロックを取り合い、取れた1つだけがカードリーダーと
+# 定期実行タスクを動かす。リーダーのプロセスが終了するとロックが外れ、ほかのワーカーが引き継ぐ。
+LEADER_RETRY_SECONDS = 5
+WORKER_SYNC_INTERVAL = 0.2 # 秒。共有カウンタを確認する間隔
+worker_sync_stop_event = threading.Event()
+reader_thread = None
+
+REGISTRY.gauge('worker_is_leader', 'Whether this process owns the card reader and scheduled jobs (1) or not (0).',
+               callback=lambda: 1 if leader_lock.held else 0)
+
+def add_initial_users():
+    """ユーザーが1人もいなければ最初のユーザーを登録します。app_context 内で呼び出すこと。"""
+    if not User.query.first():
+        print("Adding initial users...")
+        user1 = User(idm="F637CF05", name="Soma Taniguchi")
+        db.session.add(user1)
+        db.session.commit()
+        print("Initial users added.")
+
+def start_leader_services():
+    """カードリーダー・定期実行タスク・通知の送信を始めます。リーダーのロックを取ってから呼ぶこと。"""
+    global reader_thread, _user_cache_version
+    with app.app_context():
+        add_initial_users()
+    if worker_state is not None:
+        _user_cache_version = worker_state.get('users')
+    init_tap_pipeline()
+    notifier.forward_only = False
+    notifier.start()
+
+    reader_thread = threading.Thread(target=card_reading_loop, name="card-reader", daemon=True)
+    reader_thread.start()
 
+    scheduled_system_notifications()
+    print(f"このプロセス (PID {os.getpid()}) がカードリーダーと定期実行タスクを担当します。")
+
+def start_worker_services():
+    """
+    gunicorn のワーカーの起動時に呼ぶ（gunicorn.conf.py）。
+    ライブフィードの連番をほかのプロセスと揃え、リーダーの選出と共有カウンタの確認を始めます。
+    """
+    notifier.forward_only = True
+    notifier.on_spooled = lambda: worker_state.increment('notifications')
+    with app.app_context():
+        live_feed.start_at(db.session.query(db.func.max(LiveEventRecord.id)).scalar() or 0)
+    threading.Thread(target=worker_sync_loop, name="worker-sync", daemon=True).start()
 
+def worker_sync_loop():
+    """
+    複数ワーカーのときに各プロセスで動かすスレッド。
+    リーダーでなければ LEADER_RETRY_SECONDS ごとにロックを試し、取れたらリーダーの処理を始める。
+    リーダーはほかのプロセスからのジャーナルの書き込み依頼と通知を反映し、
+    リーダー以外はリーダーが流したライブフィードのイベントを自分の購読者へ流し、
+    ユーザーが変更されるたびにユーザーキャッシュを読み込み直す（名前の表示用。タップの判定には使わない）。
+    ほかのプロセスが tap_write_lock を持ったまま書き込みを待っていることがあるため、
+    このスレッドでは tap_write_lock を取らない（ユーザーの変更はタップのときに sync_user_cache() で反映する）。
+    """
+    seen_live_events = worker_state.get('live_events')
+    seen_notifications = worker_state.get('notifications')
+    seen_users = None
+    next_attempt = 0
+    while not worker_sync_stop_event.wait(WORKER_SYNC_INTERVAL):
+        try:
+            if not leader_lock.held:
+                if time.monotonic() >= next_attempt:
+                    next_attempt = time.monotonic() + LEADER_RETRY_SECONDS
+                    if leader_lock.try_acquire():
+                        # 前のリーダーが流したイベントを受け取ってから、自分で流し始める
+                        relay_live_events()
+                        start_leader_services()
+                        continue
+                live_events = worker_state.get('live_events')
+                if live_events != seen_live_events:
+                    seen_live_events = live_events
+                    relay_live_events()
+                users = worker_state.get('users')
+                if users != seen_users:
+                    seen_users = users
+                    with app.app_context():
+                        load_user_cache(verbose=False)
+                continue
+
+            requested = worker_state.get('flush_requested')
+            if requested > worker_state.get('flush_done'):
+                tap_journal.flush()
+                worker_state.raise_to('flush_done', requested)
+            notifications = worker_state.get('notifications')
+            if notifications != seen_notifications:
+                seen_notifications = notifications
+                notifier.reload_spool()
+        except Exception as e:
+            print(f"ワーカー間の連携でエラーが発生しました: {e}")
+
+def stop_background_services():
+    """
+    グレースフルシャットダウン。ライブフィードの接続を終わらせ、カードリーダーと定期実行タスクを
+    止めてから、未反映のタップをデータベースへ、未送信の通知を Discord へ送り切ります。
+    最後にリーダーのロックを外し、ほかのワーカーが引き継げるようにします。
+    """
+    worker_sync_stop_event.set()
+    live_feed.close()
+    if leader_lock.held:
+        card_reader_stop_event.set()
+        if reader_thread is not None:
+            reader_thread.join(timeout=10.0)
+        scheduler.stop()
+    report_pool.shutdown()
+    tap_journal.stop()
+    notifier.stop()
+    leader_lock.release()
+
+@app.route('/stats/worker')
+def worker_stats():
+    """このプロセスがリーダーかどうかと、リーダーのプロセスの PID を JSON で返す"""
+    return jsonify({
+        'pid': os.getpid(),
+        'mode': 'multi-worker' if worker_state is not None else 'single',
+        'leader': leader_lock.held,
+        'leader_pid': leader_lock.owner_pid(),
+    })
 
 # --- アプリケーション起動時の処理 ---
 if __name__ == '__main__':
     with app.app_context():
-        db.create_all()
+        migrate_schema()
 
-        if not User.query.first():
-            print("Adding initial users...")
-            user1 = User(idm="F637CF05", name="Soma Taniguchi")
-            db.session.add(user1)
-            db.session.commit()
-            print("Initial users added.")
-
-    reader_thread = threading.Thread(target=card_reading_loop, daemon=True)
-    reader_thread.start()
-    
-    excel_thread = threading.Thread(target=scheduled_system_notifications, daemon=True)
-    excel_thread.start()
+    if not leader_lock.try_acquire():
+        print(f"カードリーダーは別のプロセス (PID {leader_lock.owner_pid()}) が使用しています。")
+        sys.exit(1)
+    start_leader_services()
+    # systemd などからの SIGTERM でも finally のグレースフルシャットダウンを通るようにする
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
 
     try:
         app.run(host='0.0.0.0', port=5000, debug=False)
     except Exception as e:
         print(f"Flask App Error: {e}")
         sys.exit(1)
+    finally:
+        stop_background_services()
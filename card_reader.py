@@ -0,0 +1,267 @@
+import queue
+import threading
+import time
+
+from metrics import DEBOUNCED_TAPS_TOTAL, READ_ERRORS_TOTAL, TAP_STAGE_SECONDS
+
+try:
+    from smartcard.CardMonitoring import CardMonitor, CardObserver
+    from smartcard.System import readers as pcsc_readers
+except ImportError:  # pyscard がない開発機でもフェイクリーダーで動かせるようにする
+    CardMonitor = None
+    CardObserver = object
+    pcsc_readers = None
+
+
+# IDmを取得するPCSCコマンド (GET DATA)
+GET_IDM_APDU = [0xFF, 0xCA, 0x00, 0x00, 0x00]
+
+# リーダー名にこれらの文字列を含むものだけを使用する
+DEFAULT_READER_KEYWORDS = ('PaSoRi', 'FeliCa')
+
+
+def read_idm(connection):
+    """
+    接続済みのコネクションに GET DATA を送信してIDmを返します。
+    取得に失敗した場合は None を返します。
+    """
+    response, sw1, sw2 = connection.transmit(GET_IDM_APDU)
+    if sw1 == 0x90 and sw2 == 0x00:
+        return ''.join(f"{b:02X}" for b in response)
+    print(f"NFC Error: Failed to get IDm. SW: {hex(sw1)} {hex(sw2)}")
+    return None
+
+
+class IdmDebouncer:
+    """
+    IDmごとに一定時間内の連続読み取りを無視するためのクラス。
+    別のカードは待たされることなくすぐに受け付けます。
+    """
+
+    def __init__(self, window_seconds, clock=time.monotonic):
+        self.window_seconds = window_seconds
+        self._clock = clock
+        self._last_seen = {}  # {idm: 最後に受け付けた時刻}
+        self._lock = threading.Lock()
+
+    def accept(self, idm):
+        now = self._clock()
+        with self._lock:
+            last = self._last_seen.get(idm)
+            if last is not None and now - last < self.window_seconds:
+                return False
+            self._last_seen[idm] = now
+            # 古いエントリを掃除して辞書が増え続けないようにする
+            if len(self._last_seen) > 256:
+                self._last_seen = {k: t for k, t in self._last_seen.items()
+                                   if now - t < self.window_seconds}
+            return True
+
+
+class ReaderConfig:
+    """
+    リーダーごとの設定。
+    match: リーダー名に含まれる文字列（タプルの場合はいずれか）
+    door: ドア名（記録や通知に使われる。None の場合はリーダー名）
+    mode: 'toggle'（入室/退室を切り替え）、'入室' または '退室'（固定）
+    """
+    MODES = ('toggle', '入室', '退室')
+
+    def __init__(self, match=DEFAULT_READER_KEYWORDS, door=None, mode='toggle'):
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown reader mode: {mode}")
+        self.match = (match,) if isinstance(match, str) else tuple(match)
+        self.door = door
+        self.mode = mode
+
+    def matches(self, reader_name):
+        return any(keyword in reader_name for keyword in self.match)
+
+    def __repr__(self):
+        return f'<ReaderConfig {self.match} door={self.door} mode={self.mode}>'
+
+
+class ReaderInfo:
+    """実際に開いたリーダーと、それに適用された設定"""
+    __slots__ = ('name', 'door', 'mode')
+
+    def __init__(self, name, door, mode):
+        self.name = name
+        self.door = door
+        self.mode = mode
+
+    def __repr__(self):
+        return f'<ReaderInfo {self.name} door={self.door} mode={self.mode}>'
+
+
+class ReaderWorker(threading.Thread):
+    """
+    リーダー1台を担当するワーカースレッド。
+    CardMonitor から届いたカード挿入イベントをキューで受け取り、
+    IDmの読み取りと on_tap の呼び出しをこのスレッドで行います。
+    """
+
+    def __init__(self, info, connection, on_tap, debounce_seconds, clock=time.monotonic):
+        super().__init__(name=f"reader-{info.door}", daemon=True)
+        self.info = info
+        self.connection = connection
+        self.on_tap = on_tap
+        self.debouncer = IdmDebouncer(debounce_seconds, clock=clock)
+        self._events = queue.Queue()
+        self._stopped = threading.Event()
+
+    def card_inserted(self):
+        self._events.put(True)
+
+    def stop(self):
+        self._stopped.set()
+        self._events.put(None)
+
+    def run(self):
+        while not self._stopped.is_set():
+            event = self._events.get()
+            if event is None:
+                break
+            self.read_card()
+
+    def read_card(self):
+        """カードのIDmを読み取り on_tap に渡します。受け付けたIDmを返します。"""
+        try:
+            with TAP_STAGE_SECONDS.time(stage='card_read'):
+                self.connection.connect()
+                try:
+                    idm = read_idm(self.connection)
+                finally:
+                    self.connection.disconnect()
+        except Exception as e:
+            # カードがすぐに離された場合などもここにくる
+            print(f"NFC Read Exception ({self.info.name}): {e}")
+            READ_ERRORS_TOTAL.inc(reader=self.info.door)
+            return None
+
+        if not idm:
+            READ_ERRORS_TOTAL.inc(reader=self.info.door)
+            return None
+        if not self.debouncer.accept(idm):
+            DEBOUNCED_TAPS_TOTAL.inc()
+            return None
+
+        try:
+            self.on_tap(idm, self.info)
+        except Exception as e:
+            print(f"Tap handling error ({self.info.door}): {e}")
+        return idm
+
+
+class _CardEventObserver(CardObserver):
+    """CardMonitor からのカード挿入イベントを CardReaderService に渡すオブザーバー"""
+
+    def __init__(self, service):
+        self.service = service
+
+    def update(self, observable, actions):
+        added_cards, _removed_cards = actions
+        for card in added_cards:
+            self.service.card_inserted(str(card.reader))
+
+
+class CardReaderService:
+    """
+    イベント駆動のカードリーダーサブシステム。
+
+    リーダーの列挙とコネクションの作成は起動時（または新しいリーダーが
+    現れた時）に一度だけ行い、カードの検出は PC/SC のイベント
+    (pyscard の CardMonitor) に任せます。リーダーごとに ReaderWorker を
+    立てるので、複数のリーダーのタップは並行して処理されます。
+    `reader_source` と `monitor_factory` を差し替えればフェイクのリーダーで動かせます。
+
+    on_tap は (idm, ReaderInfo) を引数に呼び出されます。
+    """
+
+    def __init__(self, on_tap, reader_configs=None, debounce_seconds=5.0,
+                 reader_source=None, monitor_factory=None, clock=time.monotonic):
+        self.on_tap = on_tap
+        self.reader_configs = reader_configs or [ReaderConfig()]
+        self.debounce_seconds = debounce_seconds
+        self._clock = clock
+        self._reader_source = reader_source or pcsc_readers
+        self._monitor_factory = monitor_factory or CardMonitor
+        self._workers = {}  # {リーダー名: ReaderWorker}
+        self._workers_lock = threading.Lock()
+        self._monitor = None
+        self._observer = None
+
+    def config_for(self, reader_name):
+        return next((c for c in self.reader_configs if c.matches(reader_name)), None)
+
+    @property
+    def workers(self):
+        with self._workers_lock:
+            return dict(self._workers)
+
+    def open_readers(self):
+        """対象のリーダーを列挙し、リーダーごとにワーカーを起動します。"""
+        if self._reader_source is None:
+            print("NFC Error: pyscard is not installed.")
+            return []
+        with TAP_STAGE_SECONDS.time(stage='reader_open'):
+            available_readers = self._reader_source()
+        if not available_readers:
+            print("NFC Error: No smart card readers found. Is PaSoRi connected and pcscd running?")
+            return []
+
+        with self._workers_lock:
+            for reader in available_readers:
+                name = str(reader)
+                config = self.config_for(name)
+                if config is None or name in self._workers:
+                    continue
+                info = ReaderInfo(name, config.door or name, config.mode)
+                with TAP_STAGE_SECONDS.time(stage='reader_open'):
+                    connection = reader.createConnection()
+                worker = ReaderWorker(info, connection, self.on_tap,
+                                      self.debounce_seconds, clock=self._clock)
+                worker.start()
+                self._workers[name] = worker
+                print(f"NFC: Using reader {name} (door={info.door}, mode={info.mode})")
+            opened = list(self._workers)
+
+        if not opened:
+            print("NFC Error: PaSoRi reader not found. Please check its name or connection.")
+        return opened
+
+    def _worker_for(self, reader_name):
+        with self._workers_lock:
+            worker = self._workers.get(reader_name)
+        if worker is None and self.config_for(reader_name):
+            # 起動後に接続されたリーダーの場合のみ再列挙する
+            self.open_readers()
+            with self._workers_lock:
+                worker = self._workers.get(reader_name)
+        return worker
+
+    def start(self):
+        self.open_readers()
+        if self._monitor_factory is None:
+            print("NFC Error: pyscard is not installed. Card monitoring is disabled.")
+            return
+        self._monitor = self._monitor_factory()
+        self._observer = _CardEventObserver(self)
+        self._monitor.addObserver(self._observer)
+
+    def stop(self):
+        if self._monitor and self._observer:
+            self._monitor.deleteObserver(self._observer)
+        self._monitor = None
+        self._observer = None
+        with self._workers_lock:
+            workers = list(self._workers.values())
+            self._workers = {}
+        for worker in workers:
+            worker.stop()
+
+    def card_inserted(self, reader_name):
+        """カードがかざされた時に呼ばれます。読み取りは担当ワーカーで非同期に行います。"""
+        worker = self._worker_for(reader_name)
+        if worker is not None:
+            worker.card_inserted()
@@ -0,0 +1,135 @@
+"""
+Excel ログ書き出しのベンチマーク。
+
+一時ディレクトリのデータベースに合成した滞在セッションを入れ、履歴の長さ（月数）を
+段階的に伸ばしながら access_logs.xlsx を全体書き出しして、書き込んだ行数・
+1秒あたりの行数・Python のメモリ使用量のピーク (tracemalloc) を報告します。
+最後に、データが変わっていないときに書き出しを省略する場合の時間も測ります。
+本番のデータには触れません。
+
+使い方:
+    python excel_bench.py --users 50 --months 12,36,72
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+
+def synthetic_sessions(user_ids, start, end, sessions_per_day, rng):
+    """[start, end) の各日に、平均 sessions_per_day 件の閉じた滞在セッションを作ります。"""
+    day = start
+    while day < end:
+        for user_id in user_ids:
+            if rng.random() >= sessions_per_day:
+                continue
+            entry_ts = day + timedelta(hours=rng.uniform(7, 12))
+            exit_ts = entry_ts + timedelta(hours=rng.uniform(0.5, 10))
+            yield {'user_id': user_id, 'entry_ts': entry_ts, 'exit_ts': exit_ts,
+                   'duration_seconds': (exit_ts - entry_ts).total_seconds(), 'auto_closed': False}
+        day += timedelta(days=1)
+
+
+def month_offset(month_start, months):
+    index = month_start.year * 12 + month_start.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+def timed_export(access_app, trace):
+    """全体書き出しを1回行い、(秒数, 書き込んだ行数, メモリのピーク MB) を返します。"""
+    rows_before = access_app.EXCEL_ROWS_WRITTEN_TOTAL.value()
+    access_app.result_cache.bump()
+    if trace:
+        tracemalloc.start()
+    started = time.perf_counter()
+    access_app.update_excel_log()
+    elapsed = time.perf_counter() - started
+    peak_mb = None
+    if trace:
+        peak_mb = round(tracemalloc.get_traced_memory()[1] / 1024 / 1024, 2)
+        tracemalloc.stop()
+    return elapsed, access_app.EXCEL_ROWS_WRITTEN_TOTAL.value() - rows_before, peak_mb
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=50, help='ユーザー数')
+    parser.add_argument('--months', default='12,36,72', help='測定する履歴の長さ（月数、カンマ区切り）')
+    parser.add_argument('--sessions-per-day', type=float, default=0.6,
+                        help='1人・1日あたりの滞在セッション数の平均（1以下）')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help='結果を JSON で出力する')
+    args = parser.parse_args(argv)
+    months_list = sorted(int(value) for value in args.months.split(','))
+
+    workdir = tempfile.mkdtemp(prefix='excel_bench_')
+    os.environ['ACCESS_CONTROL_INSTANCE_PATH'] = workdir
+    os.chdir(workdir)
+
+    import app as access_app
+
+    rng = random.Random(args.seed)
+    output = io.StringIO()
+    with access_app.app.app_context(), contextlib.redirect_stdout(output):
+        access_app.migrate_schema()
+        access_app.db.session.bulk_insert_mappings(
+            access_app.User, [{'idm': f"{i:016X}", 'name': f"bench-{i}"} for i in range(1, args.users + 1)])
+        access_app.db.session.commit()
+        user_ids = [user_id for (user_id,) in access_app.db.session.query(access_app.User.id)]
+
+        # 直近の月から過去に向かって履歴を伸ばしていく
+        latest = datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        covered = 0
+        results = []
+        for months in months_list:
+            start = month_offset(latest, -months)
+            end = month_offset(latest, -covered) if covered else month_offset(latest, 1)
+            access_app.db.session.bulk_insert_mappings(
+                access_app.StaySession, list(synthetic_sessions(user_ids, start, end, args.sessions_per_day, rng)))
+            access_app.db.session.commit()
+            covered = months
+
+            elapsed, rows, _ = timed_export(access_app, trace=False)
+            _, _, peak_mb = timed_export(access_app, trace=True)
+            results.append({
+                'months': months,
+                'sessions': access_app.StaySession.query.count(),
+                'rows_written': rows,
+                'elapsed_seconds': round(elapsed, 3),
+                'rows_per_second': round(rows / elapsed, 1) if elapsed else None,
+                'peak_memory_mb': peak_mb,
+                'file_bytes': os.path.getsize(access_app.EXCEL_LOG_PATH),
+            })
+
+        # データが変わっていなければ書き出しを省略する
+        started = time.perf_counter()
+        skipped = not access_app.update_excel_log()
+        skip_elapsed = time.perf_counter() - started
+
+    report = {
+        'users': args.users,
+        'exports': results,
+        'unchanged_skipped': skipped,
+        'unchanged_elapsed_seconds': round(skip_elapsed, 6),
+    }
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False))
+    else:
+        print("--- Excel ログ書き出しベンチマーク ---")
+        print(f"{'月数':>6} {'セッション':>10} {'行数':>10} {'秒':>8} {'行/秒':>10} {'ピークMB':>9} {'ファイル':>10}")
+        for r in results:
+            print(f"{r['months']:>6} {r['sessions']:>10} {r['rows_written']:>10} {r['elapsed_seconds']:>8} "
+                  f"{r['rows_per_second']:>10} {r['peak_memory_mb']:>9} {r['file_bytes']:>10}")
+        print(f"変更なしの場合: {'省略' if skipped else '書き出し'} ({report['unchanged_elapsed_seconds']} 秒)")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
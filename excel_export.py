@@ -0,0 +1,56 @@
+import os
+import threading
+import time
+
+
+def month_marker(month_start):
+    """シート内の月の見出し行の文字列"""
+    return f"--- {month_start.strftime('%Y年%m月')} ---"
+
+
+class ExcelExportTracker:
+    """
+    Excel ログ（access_logs.xlsx）を書き出す必要があるかどうかを記録します。
+
+    前回書き出したときのデータバージョン（ResultCache.data_version）から変わっていなければ
+    書き出しを省略します。省略するのはファイル単位で、書き出す場合はブック全体を作り直します
+    （月やシートごとの差分更新はしません）。未退室の滞在は現在時刻までの滞在時間を表示するため、
+    未退室の滞在がある間は open_stay_refresh 秒ごとに書き出し直します。
+    """
+
+    def __init__(self, open_stay_refresh=300):
+        self.open_stay_refresh = open_stay_refresh
+        self._lock = threading.Lock()
+        self._exported_version = None
+        self._exported_at = None
+        self._has_open_stays = False
+
+    def needs_export(self, data_version, file_exists):
+        with self._lock:
+            if not file_exists or self._exported_version is None:
+                return True
+            if data_version != self._exported_version:
+                return True
+            return self._has_open_stays and (
+                time.monotonic() - self._exported_at >= self.open_stay_refresh)
+
+    def done(self, data_version, has_open_stays):
+        """書き出しが終わったことを記録します。data_version は書き出しを始める前に読んだ値を渡すこと。"""
+        with self._lock:
+            self._exported_version = data_version
+            self._exported_at = time.monotonic()
+            self._has_open_stays = has_open_stays
+
+
+def block_has_stays(rows):
+    """月のブロック（見出し行と各日の行）に入退室の記録がある日が含まれるか"""
+    return any(len(row) > 1 and row[1] for row in rows[1:])
+
+
+def save_workbook_atomically(workbook, path):
+    """一時ファイルに保存してから置き換え、読み手が書きかけのファイルを見ないようにします。"""
+    tmp_path = path + '.tmp'
+    workbook.save(tmp_path)
+    with open(tmp_path, 'rb') as f:
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
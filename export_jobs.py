@@ -0,0 +1,193 @@
+import json
+import os
+import queue
+import threading
+import time
+
+
+class ExportJob:
+    """バックグラウンドで作成するエクスポートファイル1つ分の状態"""
+
+    def __init__(self, job_id, filename, mimetype, path):
+        self.id = job_id
+        self.filename = filename
+        self.mimetype = mimetype
+        self.path = path
+        self.status = 'queued'  # queued → running → done / failed / cancelled
+        self.rows = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.cancel_requested = False
+        self.on_cancel = None  # 実行中に取り消すときに呼ぶ関数（generate の中で設定する）
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'status': self.status,
+            'filename': self.filename,
+            'rows': self.rows,
+            'error': self.error,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+        }
+
+
+class ExportJobManager:
+    """
+    大きなエクスポートをバックグラウンドのスレッドで作成し、できたファイルを保存しておきます。
+    （重い処理そのものは generate の中でレポートのプロセスプールに渡す）
+
+    ジョブの ID は呼び出し元がパラメータとデータバージョンから作るキーで、同じ ID の
+    2回目以降の依頼には、作成中のジョブや作成済みのファイルをそのまま返します。
+    作成済みのファイルは新しいものから max_artifacts 件まで残し、古いものは削除します。
+
+    shared=True の場合（複数のワーカープロセスで動かす場合）は、ジョブの状態を
+    「ID.json」にも書いておき、ほかのプロセスが登録したジョブも get() で返します。
+    同じ ID のジョブをほかのプロセスが作成中なら、新しく作らずにそのジョブを返します。
+    """
+
+    def __init__(self, directory, workers=1, max_artifacts=20, stale_seconds=24 * 60 * 60, shared=False,
+                 orphan_seconds=15 * 60):
+        self.directory = directory
+        self.workers = workers
+        self.max_artifacts = max_artifacts
+        self.stale_seconds = stale_seconds
+        self.shared = shared
+        # ほかのプロセスの作成待ち・作成中のジョブが、これより長く更新されていなければ
+        # そのプロセスは止まったものとみなす
+        self.orphan_seconds = orphan_seconds
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._queue = queue.Queue()
+        self._threads = []
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None and self.shared:
+            job = self._load_shared(job_id)
+        return job
+
+    def submit(self, job_id, filename, mimetype, generate):
+        """
+        generate(job, path) でファイルを作成するジョブを登録します（書いた行数を返すこと）。
+        同じ ID のジョブが失敗・取り消しになっていなければ、新しく作らずにそのジョブを返します。
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None and self.shared:
+                job = self._load_shared(job_id)
+            if job is not None and job.status not in ('failed', 'cancelled'):
+                return job
+            extension = os.path.splitext(filename)[1]
+            job = ExportJob(job_id, filename, mimetype, os.path.join(self.directory, job_id + extension))
+            self._jobs[job_id] = job
+            self._start_workers()
+        self._save_shared(job)
+        self._queue.put((job, generate))
+        return job
+
+    def cancel(self, job_id):
+        """
+        作成待ち・作成中のジョブを取り消します。取り消せた場合は True を返します。
+        （ほかのプロセスが作成しているジョブは取り消せない）
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None or job.status not in ('queued', 'running'):
+            return False
+        job.cancel_requested = True
+        if job.on_cancel is not None:
+            job.on_cancel()
+        return True
+
+    def _start_workers(self):
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._worker, name=f"export-worker-{len(self._threads)}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _worker(self):
+        while True:
+            job, generate = self._queue.get()
+            if job.cancel_requested:
+                job.status = 'cancelled'
+                job.finished_at = time.time()
+                continue
+            job.status = 'running'
+            job.started_at = time.time()
+            self._save_shared(job)
+            tmp_path = job.path + '.tmp'
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                job.rows = generate(job, tmp_path)
+                os.replace(tmp_path, job.path)
+                job.status = 'done'
+            except Exception as e:
+                job.error = str(e)
+                if job.cancel_requested:
+                    job.status = 'cancelled'
+                else:
+                    job.status = 'failed'
+                    print(f"エクスポート {job.id} の作成に失敗しました: {e}")
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+            finally:
+                job.finished_at = time.time()
+                self._save_shared(job)
+                self._prune()
+
+    def _meta_path(self, job_id):
+        return os.path.join(self.directory, job_id + '.json')
+
+    def _save_shared(self, job):
+        """ほかのプロセスから見えるように、ジョブの状態を ID.json に書きます。"""
+        if not self.shared:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        data = dict(job.to_dict(), path=job.path, mimetype=job.mimetype)
+        tmp_path = self._meta_path(job.id) + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, self._meta_path(job.id))
+
+    def _load_shared(self, job_id):
+        """ほかのプロセスが登録したジョブを ID.json から読み込みます（なければ None）。"""
+        if not job_id.isalnum():
+            return None
+        try:
+            with open(self._meta_path(job_id), encoding='utf-8') as f:
+                data = json.load(f)
+            updated_at = os.path.getmtime(self._meta_path(job_id))
+        except (OSError, ValueError):
+            return None
+        if data.get('status') in ('queued', 'running') and time.time() - updated_at > self.orphan_seconds:
+            return None
+        job = ExportJob(job_id, data['filename'], data['mimetype'], data['path'])
+        for key in ('status', 'rows', 'error', 'created_at', 'started_at', 'finished_at'):
+            setattr(job, key, data.get(key))
+        if job.status == 'done' and not os.path.exists(job.path):
+            return None
+        return job
+
+    def _prune(self):
+        """古い作成済みファイルと、前回の起動時などに残ったファイルを削除します。"""
+        with self._lock:
+            finished = sorted((job for job in self._jobs.values() if job.status in ('done', 'failed', 'cancelled')),
+                              key=lambda job: job.finished_at, reverse=True)
+            for job in finished[self.max_artifacts:]:
+                del self._jobs[job.id]
+                if job.status == 'done' and os.path.exists(job.path):
+                    os.remove(job.path)
+                if os.path.exists(self._meta_path(job.id)):
+                    os.remove(self._meta_path(job.id))
+            known = {os.path.basename(job.path) for job in self._jobs.values()}
+            known.update(os.path.basename(self._meta_path(job.id)) for job in self._jobs.values())
+        now = time.time()
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name not in known and not name.endswith('.tmp') and now - os.path.getmtime(path) > self.stale_seconds:
+                os.remove(path)
@@ -0,0 +1,65 @@
+"""
+本番環境用の起動設定（複数ワーカーの gunicorn）。
+
+    gunicorn -c gunicorn.conf.py
+
+- 起動時にマスタープロセスでスキーマを更新し、ワーカー間の共有カウンタのファイルを作り直す。
+- 各ワーカーは HTTP を処理し、リーダーのロック（instance/leader.lock）を取れた1つだけが
+  カードリーダー・タップジャーナル・定期実行タスク・通知の送信を受け持つ。
+  リーダーのワーカーが終了・再起動すると、ほかのワーカーが数秒以内に引き継ぐ。
+- 停止（SIGTERM）時は /api/live の接続を終わらせ、未反映のタップと未送信の通知を
+  書き込んでから終了する。
+
+環境変数 ACCESS_CONTROL_BIND / ACCESS_CONTROL_WORKERS / ACCESS_CONTROL_THREADS で
+待ち受けるアドレス・ワーカー数・ワーカーごとのスレッド数を変えられる。
+"""
+import os
+import signal
+import subprocess
+import sys
+
+from worker_sync import create_shared_state
+
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+INSTANCE_PATH = os.environ.get('ACCESS_CONTROL_INSTANCE_PATH') or os.path.join(BASE_DIR, 'instance')
+WORKER_STATE_PATH = os.path.join(INSTANCE_PATH, 'worker_state.bin')
+
+wsgi_app = 'app:app'
+chdir = BASE_DIR
+bind = os.environ.get('ACCESS_CONTROL_BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('ACCESS_CONTROL_WORKERS', os.cpu_count() or 1))
+# /api/live（Server-Sent Events）の接続はそれぞれスレッドを1本使い続けるため、スレッドのワーカーにする
+worker_class = 'gthread'
+threads = int(os.environ.get('ACCESS_CONTROL_THREADS', '16'))
+# 停止するときに、未反映のタップと未送信の通知を書き込み終えるまで待つ時間
+graceful_timeout = 30
+
+
+def on_starting(server):
+    """ワーカーを起動する前に、マスタープロセスで1回だけ行う準備"""
+    subprocess.run([sys.executable, '-m', 'flask', '--app', 'app', 'migrate-db'], cwd=BASE_DIR, check=True)
+    create_shared_state(WORKER_STATE_PATH)
+    os.environ['ACCESS_CONTROL_WORKER_STATE'] = WORKER_STATE_PATH
+    # ライブフィードの接続でスレッドが埋まって、ほかのリクエストを処理できなくならないようにする
+    os.environ['ACCESS_CONTROL_LIVE_FEED_SUBSCRIBERS'] = str(max(1, threads // 2))
+
+
+def post_worker_init(worker):
+    import app
+    app.start_worker_services()
+
+    # SIGTERM を受けたら、gunicorn が処理中のリクエストの終了を待ち始める前に
+    # /api/live の接続を終わらせる（終わらない接続を graceful_timeout まで待たないように）
+    handle_exit = worker.handle_exit
+
+    def close_live_feed_and_exit(sig, frame):
+        app.live_feed.close()
+        handle_exit(sig, frame)
+
+    signal.signal(signal.SIGTERM, close_live_feed_and_exit)
+
+
+def worker_exit(server, worker):
+    import app
+    app.stop_background_services()
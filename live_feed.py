@@ -0,0 +1,132 @@
+import json
+import threading
+import uuid
+from collections import deque, namedtuple
+
+
+LiveEvent = namedtuple('LiveEvent', ['id', 'type', 'data'])
+
+
+class LiveFeed:
+    """
+    ダッシュボードへ Server-Sent Events で流すイベントのリングバッファ。
+
+    publish() はイベントを1回だけ JSON にしてバッファに追加し、待っている購読者を起こします。
+    購読者は自分が最後に受け取った ID を持って wait() で待つだけなので、購読者ごとの
+    キューやデータベースのポーリングはなく、待機中の購読者のコストはほぼゼロです。
+    バッファから溢れた古いイベントを要求された場合（長く切断していたなど）や、
+    再起動前のイベント ID で再接続してきた場合は None を返し、購読者にページを読み込み直してもらいます。
+
+    複数のワーカープロセスで動かす場合は、全プロセスで同じ stream_id を使い、
+    イベントの連番も add() で外から与えて揃えます（どのプロセスに再接続しても続きから受け取れる）。
+    """
+
+    def __init__(self, max_events=500, max_subscribers=50, stream_id=None):
+        self.max_events = max_events
+        self.max_subscribers = max_subscribers
+        self._events = deque(maxlen=max_events)
+        self._condition = threading.Condition()
+        self._last_id = 0
+        self._subscribers = 0
+        self._closed = False
+        # SSE の id は「起動ごとの ID:連番」にして、再起動前の ID での再接続を見分ける
+        self.stream_id = stream_id or uuid.uuid4().hex[:8]
+
+    def event_id(self, event_or_number):
+        number = event_or_number.id if isinstance(event_or_number, LiveEvent) else event_or_number
+        return f"{self.stream_id}:{number}"
+
+    def parse_event_id(self, value):
+        """
+        SSE の Last-Event-ID を連番に戻します。値がなければ現在の最後の ID、
+        このプロセスのものでなければ -1（wait() が None を返す）を返します。
+        """
+        if not value:
+            return self.last_id
+        stream_id, _, number = value.partition(':')
+        if stream_id != self.stream_id or not number.isdigit():
+            return -1
+        return int(number)
+
+    @property
+    def last_id(self):
+        with self._condition:
+            return self._last_id
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def publish(self, event_type, payload):
+        with self._condition:
+            self._append(self._last_id + 1, event_type, self.serialize(payload))
+
+    @staticmethod
+    def serialize(payload):
+        return json.dumps(payload, ensure_ascii=False, separators=(',', ':'))
+
+    def add(self, event_id, event_type, data):
+        """
+        連番が決まっている（JSON にしてある）イベントを追加します。
+        すでに受け取った連番以下のイベントは無視します。
+        """
+        with self._condition:
+            if event_id > self._last_id:
+                self._append(event_id, event_type, data)
+
+    def start_at(self, last_id):
+        """まだイベントがないときに、連番を last_id から始めます。"""
+        with self._condition:
+            if not self._events:
+                self._last_id = max(self._last_id, last_id)
+
+    def close(self):
+        """停止するときに呼びます。待っている購読者はすぐに空のリストを受け取ります。"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def _append(self, event_id, event_type, data):
+        self._last_id = event_id
+        self._events.append(LiveEvent(event_id, event_type, data))
+        self._condition.notify_all()
+
+    def wait(self, after_id, timeout):
+        """
+        after_id より後のイベントを返します。なければ最大 timeout 秒待ち、それでもなければ空のリスト。
+        after_id より後のイベントがすでにバッファから消えている場合は None を返します。
+        （after_id がこのプロセスの最後の ID より先の場合は、他のワーカーから届くのを待つ）
+        """
+        with self._condition:
+            if after_id < 0:
+                return None
+            if self._last_id <= after_id:
+                self._condition.wait_for(lambda: self._last_id > after_id or self._closed, timeout)
+            if self._last_id <= after_id or self._closed:
+                return []
+            if not self._events or self._events[0].id > after_id + 1:
+                return None
+            # 新しいイベントは末尾にあるので、後ろから必要な分だけ取り出す
+            events = []
+            for event in reversed(self._events):
+                if event.id <= after_id:
+                    break
+                events.append(event)
+            events.reverse()
+            return events
+
+    def subscribe(self):
+        """購読者を1人増やします。上限に達していれば False を返します。"""
+        with self._condition:
+            if self._subscribers >= self.max_subscribers:
+                return False
+            self._subscribers += 1
+            return True
+
+    def unsubscribe(self):
+        with self._condition:
+            self._subscribers -= 1
+
+    def subscriber_count(self):
+        with self._condition:
+            return self._subscribers
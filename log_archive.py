@@ -0,0 +1,133 @@
+import gzip
+import json
+import os
+import stat
+from collections import namedtuple
+from datetime import date, datetime
+
+
+ARCHIVE_FORMAT_VERSION = 1
+
+ArchivedLog = namedtuple('ArchivedLog', ['id', 'user_id', 'timestamp', 'status', 'reader'])
+ArchivedSession = namedtuple(
+    'ArchivedSession', ['id', 'user_id', 'entry_ts', 'exit_ts', 'duration_seconds', 'auto_closed'])
+ArchivedDailyStay = namedtuple('ArchivedDailyStay', ['user_id', 'date', 'seconds', 'session_count'])
+
+
+class LogArchive:
+    """
+    締まった月の入退室ログと滞在セッションを、月ごとの圧縮ファイルに保存するアーカイブ。
+
+    ファイルは gzip で圧縮した JSON Lines で、1行目がヘッダー
+    （年月・件数・ユーザーごとの月間合計）、以降の行がログ ("L")・
+    セッション ("S")・日ごとの滞在時間 ("D") です。書き込みは一時ファイルから os.replace で行い、
+    書き込んだファイルは読み取り専用にします。
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path_for(self, year, month):
+        return os.path.join(self.directory, f"access_log_{year:04d}-{month:02d}.jsonl.gz")
+
+    def exists(self, year, month):
+        return os.path.exists(self.path_for(year, month))
+
+    def write_month(self, year, month, logs, sessions, daily_stays, replace=True):
+        """
+        1か月分のログ・セッション・日ごとの滞在時間を書き込みます。
+        セッションはユーザー・入室時刻順に渡すこと（Excel ログの書き出しで月をまたいで順に読むため）。
+        ヘッダーにはユーザーごとの月間合計 {user_id: [合計秒数, セッション数]} を入れます。
+        書き込んだファイルのパスを返します。
+        replace=False の場合は一時ファイルに書くだけで、DB をコミットした後に replace_staged()、
+        やめる場合は discard_staged() を呼ぶこと。
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path_for(year, month)
+        tmp_path = path + '.tmp'
+        logs = list(logs)
+        sessions = list(sessions)
+        daily_stays = list(daily_stays)
+        user_totals = {}
+        for user_id, _, seconds, session_count in daily_stays:
+            total = user_totals.setdefault(user_id, [0.0, 0])
+            total[0] += seconds
+            total[1] += session_count
+        header = {
+            'format': ARCHIVE_FORMAT_VERSION,
+            'year': year,
+            'month': month,
+            'created': datetime.now().isoformat(),
+            'log_count': len(logs),
+            'session_count': len(sessions),
+            'user_totals': {str(user_id): total for user_id, total in user_totals.items()},
+        }
+        with open(tmp_path, 'wb') as raw:
+            with gzip.GzipFile(fileobj=raw, mode='wb', mtime=0) as f:
+                f.write((json.dumps(header, ensure_ascii=False) + '\n').encode('utf-8'))
+                for log in logs:
+                    row = ['L', log[0], log[1], log[2].isoformat(), log[3], log[4]]
+                    f.write((json.dumps(row, ensure_ascii=False) + '\n').encode('utf-8'))
+                for s in sessions:
+                    row = ['S', s[0], s[1], s[2].isoformat(), s[3].isoformat(), s[4], bool(s[5])]
+                    f.write((json.dumps(row, ensure_ascii=False) + '\n').encode('utf-8'))
+                for d in daily_stays:
+                    row = ['D', d[0], d[1].isoformat(), d[2], d[3]]
+                    f.write((json.dumps(row, ensure_ascii=False) + '\n').encode('utf-8'))
+            raw.flush()
+            os.fsync(raw.fileno())
+        os.chmod(tmp_path, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+        if not replace:
+            return tmp_path
+        os.replace(tmp_path, path)
+        return path
+
+    def replace_staged(self, year, month):
+        """write_month(replace=False) で書いた一時ファイルでアーカイブを置き換えます。"""
+        path = self.path_for(year, month)
+        os.replace(path + '.tmp', path)
+
+    def discard_staged(self, year, month):
+        try:
+            os.remove(self.path_for(year, month) + '.tmp')
+        except FileNotFoundError:
+            pass
+
+    def _lines(self, year, month):
+        with gzip.open(self.path_for(year, month), 'rt', encoding='utf-8') as f:
+            for line in f:
+                yield json.loads(line)
+
+    def read_header(self, year, month):
+        for header in self._lines(year, month):
+            if header.get('format') != ARCHIVE_FORMAT_VERSION:
+                raise ValueError(f"未対応のアーカイブ形式です: {self.path_for(year, month)}")
+            return header
+        raise ValueError(f"空のアーカイブです: {self.path_for(year, month)}")
+
+    def iter_logs(self, year, month):
+        """アーカイブのログを ArchivedLog で返します（時刻順）。"""
+        for row in self._lines(year, month):
+            if isinstance(row, list) and row[0] == 'L':
+                yield ArchivedLog(row[1], row[2], datetime.fromisoformat(row[3]), row[4], row[5])
+
+    def iter_sessions(self, year, month):
+        """アーカイブのセッションを ArchivedSession で返します（ユーザー・入室時刻順）。"""
+        for row in self._lines(year, month):
+            if isinstance(row, list) and row[0] == 'S':
+                yield ArchivedSession(row[1], row[2], datetime.fromisoformat(row[3]),
+                                      datetime.fromisoformat(row[4]), row[5], row[6])
+
+    def iter_daily_stays(self, year, month):
+        """アーカイブした月の日ごとの滞在時間を ArchivedDailyStay で返します。"""
+        for row in self._lines(year, month):
+            if isinstance(row, list) and row[0] == 'D':
+                yield ArchivedDailyStay(row[1], date.fromisoformat(row[2]), row[3], row[4])
+
+    def remove(self, year, month):
+        path = self.path_for(year, month)
+        try:
+            os.chmod(path, stat.S_IRUSR | stat.S_IWUSR)
+            os.remove(path)
+        except FileNotFoundError:
+            pass
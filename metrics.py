@@ -0,0 +1,258 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+
+# レイテンシ計測用のデフォルトのバケット（秒）
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _format_labels(label_names, label_values, extra=None):
+    pairs = list(zip(label_names, label_values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    body = ','.join(f'{name}="{_escape(value)}"' for name, value in pairs)
+    return '{' + body + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    metric_type = ''
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(labels.get(name, '') for name in self.label_names)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}",
+                 f"# TYPE {self.name} {self.metric_type}"]
+        lines.extend(self._samples())
+        return lines
+
+
+class Counter(_Metric):
+    """単調増加するカウンター"""
+    metric_type = 'counter'
+
+    def __init__(self, name, documentation, label_names=()):
+        super().__init__(name, documentation, label_names)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def _samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        if not items and not self.label_names:
+            items = [((), 0)]
+        return [f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}"
+                for key, value in items]
+
+
+class Gauge(_Metric):
+    """
+    現在値を表すゲージ。
+    callback を渡した場合は出力のたびに callback() の値を使います。
+    """
+    metric_type = 'gauge'
+
+    def __init__(self, name, documentation, callback=None):
+        super().__init__(name, documentation)
+        self.callback = callback
+        self._value = 0
+
+    def set(self, value):
+        with self._lock:
+            self._value = value
+
+    def _samples(self):
+        if self.callback is not None:
+            try:
+                value = self.callback()
+            except Exception:
+                return []
+        else:
+            with self._lock:
+                value = self._value
+        return [f"{self.name} {_format_value(value)}"]
+
+
+class Histogram(_Metric):
+    """処理時間などの分布を記録するヒストグラム"""
+    metric_type = 'histogram'
+
+    def __init__(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}  # {ラベル: [バケットごとの件数, 合計, 件数]}
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """with ブロックの実行時間を記録します。"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels):
+        with self._lock:
+            series = self._series.get(self._key(labels))
+            return series[2] if series else 0
+
+    def _samples(self):
+        with self._lock:
+            items = sorted((key, ([*s[0]], s[1], s[2])) for key, s in self._series.items())
+        lines = []
+        for key, (bucket_counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.label_names, key, ('le', _format_value(float(bound))))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.label_names, key, ('le', '+Inf'))
+            lines.append(f"{self.name}_bucket{labels} {count}")
+            labels = _format_labels(self.label_names, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    """メトリクスを登録し、Prometheus のテキスト形式で出力します。"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, documentation, label_names=()):
+        return self._register(Counter(name, documentation, label_names))
+
+    def gauge(self, name, documentation, callback=None):
+        return self._register(Gauge(name, documentation, callback))
+
+    def histogram(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, label_names, buckets))
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+# プロセス全体で共有するレジストリ
+REGISTRY = MetricsRegistry()
+
+# --- タップ処理パイプラインのメトリクス ---
+TAP_STAGE_SECONDS = REGISTRY.histogram(
+    'tap_stage_seconds',
+    'Latency of each stage of the card tap pipeline.',
+    label_names=('stage',))
+TAPS_TOTAL = REGISTRY.counter(
+    'taps_total', 'Card taps recorded, by resulting status.', label_names=('status', 'door'))
+UNKNOWN_CARDS_TOTAL = REGISTRY.counter(
+    'tap_unknown_cards_total', 'Taps by cards that are not registered.')
+READ_ERRORS_TOTAL = REGISTRY.counter(
+    'tap_read_errors_total', 'Card reads that failed on the reader.', label_names=('reader',))
+DEBOUNCED_TAPS_TOTAL = REGISTRY.counter(
+    'tap_debounced_total', 'Repeated reads of the same card that were ignored.')
+DB_LOCK_WAITS_TOTAL = REGISTRY.counter(
+    'db_lock_waits_total', 'Database writes that failed because SQLite was locked.')
+TAP_BATCH_SIZE = REGISTRY.histogram(
+    'tap_journal_batch_size', 'Number of taps written per group commit.',
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500))
+
+# --- 通知のメトリクス ---
+NOTIFICATION_SEND_SECONDS = REGISTRY.histogram(
+    'notification_send_seconds', 'Latency of Discord webhook requests.')
+NOTIFICATIONS_TOTAL = REGISTRY.counter(
+    'notifications_total', 'Discord webhook requests, by result.', label_names=('result',))
+
+# --- 定期実行タスクのメトリクス ---
+JOB_DURATION_SECONDS = REGISTRY.histogram(
+    'scheduled_job_duration_seconds', 'Run duration of background scheduled jobs.',
+    label_names=('job',))
+JOB_RUNS_TOTAL = REGISTRY.counter(
+    'scheduled_job_runs_total', 'Background scheduled job runs, by result.',
+    label_names=('job', 'result'))
+
+# --- 集計結果キャッシュのメトリクス ---
+RESULT_CACHE_LOOKUPS_TOTAL = REGISTRY.counter(
+    'result_cache_lookups_total', 'Ranking and dashboard cache lookups, by kind and result.',
+    label_names=('kind', 'result'))
+
+# --- Excel ログのメトリクス ---
+EXCEL_EXPORTS_TOTAL = REGISTRY.counter(
+    'excel_exports_total', 'Excel log export runs, by result (written or skipped).',
+    label_names=('result',))
+EXCEL_ROWS_WRITTEN_TOTAL = REGISTRY.counter(
+    'excel_rows_written_total', 'Rows written to the Excel log.')
+EXPORT_REQUESTS_TOTAL = REGISTRY.counter(
+    'export_requests_total', 'Date-range export requests, by how they were served (direct, background, cached).',
+    label_names=('mode',))
+
+# --- レポート作成のプロセスプールのメトリクス ---
+REPORT_JOBS_TOTAL = REGISTRY.counter(
+    'report_jobs_total', 'Report jobs run in the worker process pool, by task and result.',
+    label_names=('task', 'result'))
+REPORT_JOB_SECONDS = REGISTRY.histogram(
+    'report_job_seconds', 'Time from start to finish of report jobs in the worker pool.',
+    label_names=('task',))
+
+# --- 条件付き GET と圧縮のメトリクス ---
+CONDITIONAL_GETS_TOTAL = REGISTRY.counter(
+    'http_conditional_gets_total', 'Page requests answered by the data-version ETag, by result (not_modified or full).',
+    label_names=('view', 'result'))
+COMPRESSED_RESPONSES_TOTAL = REGISTRY.counter(
+    'http_compressed_responses_total', 'Responses compressed before sending, by content encoding.',
+    label_names=('encoding',))
@@ -0,0 +1,217 @@
+"""
+データベース（instance/access_log.db）のスキーマのバージョン管理。
+
+スキーマのバージョンは SQLite の PRAGMA user_version に保存し、起動時に
+migrate() を呼ぶと、まだ適用していないマイグレーションを順番に適用して
+既存のデータベースをその場で最新の状態にします。
+新しいテーブルやカラム・インデックスが必要になったら、MIGRATIONS の末尾に
+追加すること（適用済みのものは書き換えない）。
+
+各マイグレーションは途中で失敗しても再実行できるように、
+IF NOT EXISTS やカラムの存在確認をしてから変更します。
+"""
+
+
+def _columns(conn, table):
+    return {row[1] for row in conn.exec_driver_sql(f"PRAGMA table_info({table})")}
+
+
+def _add_column(conn, table, column, column_type):
+    if column not in _columns(conn, table):
+        conn.exec_driver_sql(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+
+
+def _create_base_tables(conn):
+    """ユーザーと入退室ログ（最初のバージョンのスキーマ）"""
+    conn.exec_driver_sql("""
+        CREATE TABLE IF NOT EXISTS user (
+            id INTEGER NOT NULL,
+            idm VARCHAR(160) NOT NULL,
+            name VARCHAR(80) NOT NULL,
+            PRIMARY KEY (id),
+            UNIQUE (idm)
+        )""")
+    conn.exec_driver_sql("""
+        CREATE TABLE IF NOT EXISTS access_log (
+            id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            timestamp DATETIME,
+            status VARCHAR(20) NOT NULL,
+            PRIMARY KEY (id),
+            FOREIGN KEY(user_id) REFERENCES user (id)
+        )""")
+
+
+def _add_access_log_reader(conn):
+    """タップしたリーダー（場所）"""
+    _add_column(conn, 'access_log', 'reader', 'VARCHAR(80)')
+
+
+def _create_sessions(conn):
+    conn.exec_driver_sql("""
+        CREATE TABLE IF NOT EXISTS sessions (
+            id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            entry_ts DATETIME NOT NULL,
+            exit_ts DATETIME,
+            duration_seconds FLOAT,
+            auto_closed BOOLEAN NOT NULL,
+            PRIMARY KEY (id),
+            FOREIGN KEY(user_id) REFERENCES user (id)
+        )""")
+    conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_sessions_user_id ON sessions (user_id)")
+    conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_sessions_entry_ts ON sessions (entry_ts)")
+
+
+def _create_tap_journal_checkpoint(conn):
+    conn.exec_driver_sql("""
+        CREATE TABLE IF NOT EXISTS tap_journal_checkpoint (
+            id INTEGER NOT NULL,
+            last_seq INTEGER NOT NULL,
+            PRIMARY KEY (id)
+        )""")
+
+
+def _create_daily_stay(conn):
+    conn.exec_driver_sql("""
+        CREATE TABLE IF NOT EXISTS daily_stay (
+            user_id INTEGER NOT NULL,
+            date DATE NOT NULL,
+            seconds FLOAT NOT NULL,
+            session_count INTEGER NOT NULL,
+            PRIMARY KEY (user_id, date),
+            FOREIGN KEY(user_id) REFERENCES user (id)
+        )""")
+    conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_daily_stay_date ON daily_stay (date)")
+
+
+def _create_daily_presence(conn):
+    conn.exec_driver_sql("""
+        CREATE TABLE IF NOT EXISTS daily_presence (
+            date DATE NOT NULL,
+            user_bitmap BLOB NOT NULL,
+            PRIMARY KEY (date)
+        )""")
+
+
+def _add_access_log_indexes(conn):
+    """
+    ユーザーごとの最新ログ・ユーザーごとの時系列（滞在時間の集計）と、
+    期間の範囲検索・最新順の一覧に使うインデックス
+    """
+    conn.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_access_log_user_id_timestamp ON access_log (user_id, timestamp)")
+    conn.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_access_log_timestamp ON access_log (timestamp)")
+    conn.exec_driver_sql("ANALYZE access_log")
+
+
+def _create_archive_tables(conn):
+    """アーカイブした月と、その月のユーザーごとの滞在時間の合計"""
+    conn.exec_driver_sql("""
+        CREATE TABLE IF NOT EXISTS archived_month (
+            month DATE NOT NULL,
+            file_name VARCHAR(120) NOT NULL,
+            log_count INTEGER NOT NULL,
+            session_count INTEGER NOT NULL,
+            archived_at DATETIME NOT NULL,
+            PRIMARY KEY (month)
+        )""")
+    conn.exec_driver_sql("""
+        CREATE TABLE IF NOT EXISTS archived_monthly_stay (
+            user_id INTEGER NOT NULL,
+            month DATE NOT NULL,
+            seconds FLOAT NOT NULL,
+            session_count INTEGER NOT NULL,
+            PRIMARY KEY (user_id, month),
+            FOREIGN KEY(user_id) REFERENCES user (id)
+        )""")
+
+
+def _add_open_sessions_index(conn):
+    """未退室のセッションだけを対象にした部分インデックス（自動退室でまとめて閉じる際に使う）"""
+    conn.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_sessions_open ON sessions (entry_ts) WHERE exit_ts IS NULL")
+
+
+def _create_presence(conn):
+    """ユーザーごとの現在の在室状態。既存のログから、ユーザーごとの最後のログで初期化する"""
+    conn.exec_driver_sql("""
+        CREATE TABLE IF NOT EXISTS presence (
+            user_id INTEGER NOT NULL,
+            status VARCHAR(20) NOT NULL,
+            since DATETIME NOT NULL,
+            PRIMARY KEY (user_id),
+            FOREIGN KEY(user_id) REFERENCES user (id)
+        )""")
+    conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_presence_status ON presence (status)")
+    conn.exec_driver_sql("""
+        INSERT OR REPLACE INTO presence (user_id, status, since)
+        SELECT user_id, status, timestamp FROM (
+            SELECT user_id, status, timestamp,
+                   ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY timestamp DESC, id DESC) AS rn
+            FROM access_log
+        ) WHERE rn = 1""")
+
+
+def _create_live_events(conn):
+    """複数のワーカープロセスで動かすときに、ライブフィードのイベントを受け渡すテーブル"""
+    conn.exec_driver_sql("""
+        CREATE TABLE IF NOT EXISTS live_events (
+            id INTEGER NOT NULL,
+            type VARCHAR(20) NOT NULL,
+            data TEXT NOT NULL,
+            PRIMARY KEY (id)
+        )""")
+
+
+# (バージョン, 説明, 適用する関数)。バージョンは 1 から連番にすること。
+MIGRATIONS = [
+    (1, 'ユーザーと入退室ログのテーブル', _create_base_tables),
+    (2, 'access_log.reader カラム', _add_access_log_reader),
+    (3, '滞在セッションのテーブル', _create_sessions),
+    (4, 'タップジャーナルのチェックポイント', _create_tap_journal_checkpoint),
+    (5, '日ごとの滞在時間のテーブル', _create_daily_stay),
+    (6, '日ごとの在室者のテーブル', _create_daily_presence),
+    (7, 'access_log のインデックス', _add_access_log_indexes),
+    (8, 'アーカイブのテーブル', _create_archive_tables),
+    (9, '未退室のセッションのインデックス', _add_open_sessions_index),
+    (10, '現在の在室状態のテーブル', _create_presence),
+    (11, 'ライブフィードのイベントのテーブル', _create_live_events),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def current_version(conn):
+    return conn.exec_driver_sql("PRAGMA user_version").scalar()
+
+
+def migrate(engine, target=None):
+    """
+    未適用のマイグレーションを順番に適用します。適用したマイグレーションの数を返します。
+    マイグレーションごとに1つのトランザクションで適用し、同じトランザクションで
+    user_version を更新します。
+    """
+    target = LATEST_VERSION if target is None else target
+    applied = 0
+    with engine.connect() as conn:
+        version = current_version(conn)
+        if version > LATEST_VERSION:
+            raise RuntimeError(
+                f"データベースのスキーマ (バージョン {version}) がこのプログラム "
+                f"(バージョン {LATEST_VERSION}) より新しいため、起動できません。")
+        for number, description, upgrade in MIGRATIONS:
+            if number <= version or number > target:
+                continue
+            conn.exec_driver_sql("BEGIN")
+            try:
+                upgrade(conn)
+                conn.exec_driver_sql(f"PRAGMA user_version = {number}")
+                conn.exec_driver_sql("COMMIT")
+            except Exception:
+                conn.exec_driver_sql("ROLLBACK")
+                raise
+            print(f"スキーマを更新しました: バージョン {number} ({description})")
+            applied += 1
+    return applied
@@ -0,0 +1,379 @@
+import copy
+import json
+import os
+import queue
+import random
+import threading
+import time
+import uuid
+
+import requests
+
+from metrics import NOTIFICATION_SEND_SECONDS, NOTIFICATIONS_TOTAL
+
+
+# Discord の embed の description の上限（4096文字）より少し余裕を持たせる
+MAX_DESCRIPTION_LENGTH = 4000
+# スプールに1回でまとめて書き込む（fsync する）通知の数の上限
+SPOOL_BATCH_SIZE = 100
+
+
+def coalesce_payloads(payloads):
+    """
+    同じ種類の複数の通知を1つの embed にまとめたペイロードを返します。
+    （例: 23:59 の自動退室が20人分あっても1件の通知にする）
+    """
+    if len(payloads) == 1:
+        return payloads[0]
+
+    merged = copy.deepcopy(payloads[0])
+    embeds = [p['embeds'][0] for p in payloads if p.get('embeds')]
+    if embeds:
+        lines = [e.get('description', '') for e in embeds]
+        description = ''
+        for i, line in enumerate(lines):
+            rest = f"\n…ほか{len(lines) - i}件"
+            if len(description) + len(line) + 1 + len(rest) > MAX_DESCRIPTION_LENGTH:
+                description += rest
+                break
+            description += ('\n' if description else '') + line
+        embed = merged['embeds'][0]
+        embed['title'] = f"{embed.get('title', '')} ({len(payloads)}件)"
+        embed['description'] = description
+        embed.pop('fields', None)
+        merged['embeds'] = [embed]
+    else:
+        merged['content'] = '\n'.join(p.get('content', '') for p in payloads)[:2000]
+    return merged
+
+
+class DiscordNotifier:
+    """
+    Discord ウェブフックへの通知をバックグラウンドで送信するディスパッチャ。
+
+    - notify() は通知をメモリ上のキューに入れてすぐに戻ります。ディスク上のスプールへの
+      書き込み（fsync）はスプール用のスレッドが複数件まとめて行うため、タップ処理や
+      Web のレスポンスが Discord の遅延にもディスクの書き込みにも引きずられません。
+    - 送信は1本のワーカースレッドが keep-alive の requests.Session で行い、
+      タイムアウト・指数バックオフ付きの再送・レート制限 (429 / X-RateLimit-*) に対応します。
+    - 送信に成功するまでスプールのファイルは残るため、オフライン中や再起動を
+      またいでも通知は失われません（起動時にスプールから読み込み直します）。
+    - coalesce_key が同じ通知は coalesce_window 秒の間まとめて1件の embed にします。
+    - 複数のワーカープロセスで動かす場合、送信は1つのプロセスだけが行います。
+      ほかのプロセスは forward_only にしておくと、スプールに書いて on_spooled() を呼ぶだけになり、
+      送信するプロセスが reload_spool() で読み込んで送ります。
+    """
+
+    def __init__(self, webhook_url, spool_dir, max_queue_size=256, timeout=5.0,
+                 max_retries=5, backoff_base=1.0, backoff_max=60.0,
+                 coalesce_window=2.0, session=None):
+        self.webhook_url = webhook_url
+        self.spool_dir = spool_dir
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.coalesce_window = coalesce_window
+        self.session = session or requests.Session()
+        self._incoming = queue.Queue()  # スプールに書き込む前の通知
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._queued = set()  # キューに入っているスプールファイルのパス
+        self._queued_lock = threading.Lock()
+        self._spool_backlog = False  # キューが溢れてスプールにだけ残っている通知がある
+        self._rate_limit_until = 0.0  # time.monotonic() 基準
+        self._stopped = threading.Event()
+        self._idle = threading.Event()
+        self._idle.set()
+        self._thread = None
+        self._spooler = None
+        self._start_lock = threading.Lock()
+        self.forward_only = False
+        self.on_spooled = None
+        os.makedirs(self.spool_dir, exist_ok=True)
+
+    # --- 公開API ---
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is not None:
+                return
+            self._stopped.clear()
+            self._load_spool()
+            self._thread = threading.Thread(target=self._run, name="discord-notifier", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=10.0):
+        """キューに残っている通知の送信を最大 timeout 秒待ってから停止します。"""
+        self.flush(timeout)
+        self._stopped.set()
+        thread = self._thread
+        if thread is not None:
+            thread.join(timeout=1.0)
+        self._thread = None
+
+    def flush(self, timeout=10.0):
+        """スプールへの書き込みと送信キューが空になるまで待ちます。空になれば True を返します。"""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self._incoming.unfinished_tasks == 0 and self._queue.empty() and self._idle.is_set():
+                return True
+            time.sleep(0.05)
+        return False
+
+    def notify(self, payload, coalesce_key=None, webhook_url=None):
+        """
+        通知をメモリ上のキューに入れてすぐに戻ります（ファイルの書き込みも待ちません）。
+        スプール用のスレッドがスプールに書き込んでから送信キューに入れます。
+        """
+        url = webhook_url or self.webhook_url
+        if not url:
+            print("Discord ウェブフックURLが設定されていません。通知はスキップされます。")
+            return
+        record = {
+            'id': uuid.uuid4().hex,
+            'created': time.time(),
+            'url': url,
+            'coalesce_key': coalesce_key,
+            'payload': payload,
+        }
+        self._incoming.put(record)
+        if self._spooler is None:
+            with self._start_lock:
+                if self._spooler is None:
+                    self._spooler = threading.Thread(
+                        target=self._spool_incoming, name="discord-notifier-spool", daemon=True)
+                    self._spooler.start()
+
+    def reload_spool(self):
+        """ほかのプロセスがスプールに書いた通知を送信キューに入れます。"""
+        self._load_spool(verbose=False)
+
+    def pending_count(self):
+        spooled = len([n for n in os.listdir(self.spool_dir) if n.endswith('.json')])
+        return spooled + self._incoming.unfinished_tasks
+
+    # --- スプール ---
+
+    def _spool_incoming(self):
+        """notify() で受け取った通知を、溜まっている分まとめてスプールに書き込むスレッド"""
+        while True:
+            records = [self._incoming.get()]
+            while len(records) < SPOOL_BATCH_SIZE:
+                try:
+                    records.append(self._incoming.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                paths = self._write_spool(records)
+                if self.forward_only:
+                    if self.on_spooled is not None:
+                        self.on_spooled()
+                else:
+                    for path in paths:
+                        self._enqueue(path)
+                    if self._thread is None:
+                        self.start()
+            except Exception as e:
+                print(f"通知のスプールへの書き込みに失敗しました: {e}")
+            finally:
+                for _ in records:
+                    self._incoming.task_done()
+
+    def _write_spool(self, records):
+        """
+        通知をスプールのファイルに書き込み、パスのリストを返します。
+        先にすべてのファイルを書いてから fsync し、ディレクトリの fsync は最後に1回だけ行います。
+        """
+        files = []
+        try:
+            for record in records:
+                name = f"{int(record['created'] * 1000):015d}-{record['id']}.json"
+                path = os.path.join(self.spool_dir, name)
+                f = open(path + '.tmp', 'w', encoding='utf-8')
+                files.append((f, path))
+                json.dump(record, f, ensure_ascii=False)
+                f.flush()
+            for f, _ in files:
+                os.fsync(f.fileno())
+        finally:
+            for f, _ in files:
+                f.close()
+        paths = []
+        for _, path in files:
+            os.replace(path + '.tmp', path)
+            paths.append(path)
+        dir_fd = os.open(self.spool_dir, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+        return paths
+
+    def _read_spool(self, path):
+        try:
+            with open(path, encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"通知スプールの読み込みに失敗しました ({path}): {e}")
+            self._remove_spool(path)
+            return None
+
+    def _remove_spool(self, path):
+        with self._queued_lock:
+            self._queued.discard(path)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def _enqueue(self, path):
+        with self._queued_lock:
+            if path in self._queued:
+                return False
+            try:
+                self._queue.put_nowait(path)
+            except queue.Full:
+                # スプールには残っているので、キューが空いたら読み込み直す
+                self._spool_backlog = True
+                return False
+            self._queued.add(path)
+            return True
+
+    def _load_spool(self, verbose=True):
+        """スプールに残っている未送信の通知を古い順にキューへ入れます。"""
+        self._spool_backlog = False
+        names = sorted(n for n in os.listdir(self.spool_dir) if n.endswith('.json'))
+        loaded = sum(1 for name in names if self._enqueue(os.path.join(self.spool_dir, name)))
+        if loaded and verbose:
+            print(f"未送信の通知 {loaded} 件をスプールから読み込みました。")
+
+    # --- 送信ワーカー ---
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                first = self._queue.get(timeout=1.0)
+            except queue.Empty:
+                if self._spool_backlog:
+                    self._load_spool()
+                continue
+
+            self._idle.clear()
+            try:
+                batch = self._collect_batch(first)
+                self._dispatch(batch)
+            except Exception as e:
+                print(f"Discord 通知の送信処理でエラーが発生しました: {e}")
+            finally:
+                self._idle.set()
+
+    def _collect_batch(self, first_path):
+        """キューに溜まっている通知をまとめて取り出します。"""
+        batch = []
+        first = self._read_spool(first_path)
+        if first:
+            batch.append((first, first_path))
+        # まとめられる通知なら、後続の通知が届くまで少し待つ
+        deadline = time.monotonic() + (self.coalesce_window if first and first.get('coalesce_key') else 0)
+        while True:
+            remaining = deadline - time.monotonic()
+            try:
+                path = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            record = self._read_spool(path)
+            if record:
+                batch.append((record, path))
+        return batch
+
+    def _dispatch(self, batch):
+        # coalesce_key ごとにまとめ、それ以外は順番通りに1件ずつ送る
+        groups = []
+        group_index = {}
+        for record, path in batch:
+            key = record.get('coalesce_key')
+            if key:
+                group_key = (record['url'], key)
+                if group_key in group_index:
+                    groups[group_index[group_key]].append((record, path))
+                    continue
+                group_index[group_key] = len(groups)
+            groups.append([(record, path)])
+
+        for i, group in enumerate(groups):
+            url = group[0][0]['url']
+            payload = coalesce_payloads([record['payload'] for record, _ in group])
+            if self._send(url, payload):
+                for _, path in group:
+                    self._remove_spool(path)
+                continue
+
+            # 送信できなかった通知（と後続の通知）はスプールに残し、しばらく待ってから再送する
+            with self._queued_lock:
+                for remaining_group in groups[i:]:
+                    for _, path in remaining_group:
+                        self._queued.discard(path)
+            self._spool_backlog = True
+            self._rate_limit_until = max(self._rate_limit_until,
+                                         time.monotonic() + self.backoff_max)
+            break
+
+    def _wait_for_rate_limit(self):
+        wait = self._rate_limit_until - time.monotonic()
+        if wait > 0:
+            self._stopped.wait(wait)
+
+    def _update_rate_limit(self, response):
+        remaining = response.headers.get('X-RateLimit-Remaining')
+        reset_after = response.headers.get('X-RateLimit-Reset-After')
+        if remaining == '0' and reset_after:
+            try:
+                self._rate_limit_until = time.monotonic() + float(reset_after)
+            except ValueError:
+                pass
+
+    def _retry_after(self, response):
+        try:
+            return float(response.json().get('retry_after'))
+        except (ValueError, TypeError, AttributeError):
+            pass
+        try:
+            return float(response.headers.get('Retry-After', 1))
+        except ValueError:
+            return 1.0
+
+    def _send(self, url, payload):
+        """通知を1件送信します。送信できた（または再送しても無駄な）場合は True。"""
+        attempt = 0
+        while not self._stopped.is_set():
+            self._wait_for_rate_limit()
+            try:
+                with NOTIFICATION_SEND_SECONDS.time():
+                    response = self.session.post(url, json=payload, timeout=self.timeout)
+            except requests.exceptions.RequestException as e:
+                print(f"Discord 通知の送信中にエラーが発生しました: {e}")
+                NOTIFICATIONS_TOTAL.inc(result='error')
+            else:
+                self._update_rate_limit(response)
+                NOTIFICATIONS_TOTAL.inc(result=str(response.status_code))
+                if response.status_code == 429:
+                    retry_after = self._retry_after(response)
+                    print(f"Discord のレート制限に達しました。{retry_after:.1f}秒後に再送します。")
+                    self._rate_limit_until = time.monotonic() + retry_after
+                    continue
+                if response.ok:
+                    title = payload.get('embeds', [{}])[0].get('title', '') if payload.get('embeds') else ''
+                    print(f"Discord 通知を送信しました: {title}")
+                    return True
+                if 400 <= response.status_code < 500:
+                    # ペイロードの誤りなど、再送しても成功しないもの
+                    print(f"Discord 通知が拒否されました ({response.status_code}): {response.text[:200]}")
+                    return True
+                print(f"Discord 通知の送信に失敗しました ({response.status_code})。")
+
+            attempt += 1
+            if attempt > self.max_retries:
+                return False
+            backoff = min(self.backoff_max, self.backoff_base * (2 ** (attempt - 1)))
+            self._stopped.wait(backoff * (0.5 + random.random() / 2))
+        return False
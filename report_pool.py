@@ -0,0 +1,276 @@
+import itertools
+import multiprocessing
+import queue
+import threading
+import time
+
+
+class ReportPoolError(Exception):
+    """レポートの作成に失敗した（ワーカー側の例外・ワーカーの異常終了など）"""
+
+
+class ReportTimeout(ReportPoolError):
+    pass
+
+
+class ReportCancelled(ReportPoolError):
+    pass
+
+
+class ReportJob:
+    """プロセスプールで実行するレポート作成1件分の状態"""
+
+    def __init__(self, job_id, name, args, timeout):
+        self.id = job_id
+        self.name = name
+        self.args = args
+        self.timeout = timeout
+        self.status = 'queued'  # queued → running → done / failed / timeout / cancelled
+        self.result = None
+        self.error = None
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.cancel_requested = False
+        self._done = threading.Event()
+
+    def wait(self, timeout=None):
+        """終わるまで待ち、結果を返します。失敗した場合は ReportPoolError とその派生クラス。"""
+        if not self._done.wait(timeout):
+            raise ReportTimeout(f"レポート {self.name} の結果を待つ時間が過ぎました。")
+        if self.status == 'done':
+            return self.result
+        if self.status == 'timeout':
+            raise ReportTimeout(self.error)
+        if self.status == 'cancelled':
+            raise ReportCancelled(self.error)
+        raise ReportPoolError(self.error)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'status': self.status,
+            'error': self.error,
+            'submitted_at': self.submitted_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+        }
+
+    def _finish(self, status, result=None, error=None):
+        self.status = status
+        self.result = result
+        self.error = error
+        self.finished_at = time.time()
+        self._done.set()
+
+
+def _worker_main(conn, target):
+    """ワーカープロセスの本体。(名前, 引数) を受け取って target(名前, *引数) の結果を送り返す。"""
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            return
+        if message is None:
+            return
+        name, args = message
+        try:
+            conn.send(('ok', target(name, *args)))
+        except BaseException as e:
+            conn.send(('error', f"{type(e).__name__}: {e}"))
+
+
+class ReportPool:
+    """
+    Excel ログやエクスポートなど、重いレポートの作成を別プロセスで実行するプール。
+
+    タップ処理や Web のスレッドと GIL を取り合わないように、workers 個のワーカープロセスで
+    target(名前, *引数) を実行し、結果を呼び出し元のプロセスに返します（引数と結果は pickle
+    できること）。ジョブはキューに入り、同時に実行するのは workers 件までです。
+    タイムアウトしたジョブや実行中に取り消したジョブは、ワーカープロセスを止めて
+    次のジョブのために起動し直します。ワーカーは最初のジョブが来たときに起動します。
+    workers=0 の場合は呼び出し元のスレッドでそのまま実行します（検証用）。
+    """
+
+    def __init__(self, target, workers=1, default_timeout=300, on_finish=None, mp_context='spawn'):
+        self.target = target
+        self.workers = workers
+        self.default_timeout = default_timeout
+        self.on_finish = on_finish  # on_finish(ジョブ, 秒数) をジョブの終了時に呼ぶ
+        self._context = multiprocessing.get_context(mp_context)
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._jobs = {}
+        self._ids = itertools.count(1)
+        self._slots = []
+        self._processes = {}  # {スロット番号: (プロセス, パイプ)}
+        self._stopping = False
+
+    def submit(self, name, *args, timeout=None):
+        """ジョブをキューに入れ、ReportJob を返します。"""
+        job = ReportJob(next(self._ids), name, args, timeout or self.default_timeout)
+        with self._lock:
+            if self._stopping:
+                raise ReportPoolError("レポートのプールは停止しています。")
+            self._jobs[job.id] = job
+            if self.workers > 0:
+                self._start_slots()
+        if self.workers == 0:
+            self._run_inline(job)
+        else:
+            self._queue.put(job)
+        return job
+
+    def run(self, name, *args, timeout=None):
+        """ジョブを実行して結果を返します。タイムアウトや失敗は ReportPoolError の派生クラス。"""
+        job = self.submit(name, *args, timeout=timeout)
+        return job.wait(job.timeout + 5)
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id):
+        """ジョブを取り消します。キューにあれば実行せず、実行中ならワーカーを止めます。"""
+        job = self.get(job_id)
+        if job is None or job.status not in ('queued', 'running'):
+            return False
+        job.cancel_requested = True
+        return True
+
+    def stats(self):
+        with self._lock:
+            jobs = list(self._jobs.values())
+            alive = sum(1 for process, _ in self._processes.values() if process.is_alive())
+        counts = {}
+        for job in jobs:
+            counts[job.status] = counts.get(job.status, 0) + 1
+        return {'workers': self.workers, 'processes': alive, 'jobs': counts}
+
+    def queued_count(self):
+        return self._queue.qsize()
+
+    def shutdown(self, timeout=5.0):
+        """ワーカープロセスを止めます。キューに残ったジョブは取り消します。"""
+        with self._lock:
+            self._stopping = True
+            slots = list(self._slots)
+        for _ in slots:
+            self._queue.put(None)
+        for thread in slots:
+            thread.join(timeout)
+        while True:
+            try:
+                job = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if job is not None:
+                job._finish('cancelled', error="プールを停止したため取り消しました。")
+        for index in list(self._processes):
+            self._stop_process(index)
+
+    def _start_slots(self):
+        while len(self._slots) < self.workers:
+            thread = threading.Thread(target=self._slot_loop, args=(len(self._slots),),
+                                      name=f"report-slot-{len(self._slots)}", daemon=True)
+            thread.start()
+            self._slots.append(thread)
+
+    def _run_inline(self, job):
+        job.status = 'running'
+        job.started_at = time.time()
+        try:
+            job._finish('done', result=self.target(job.name, *job.args))
+        except Exception as e:
+            job._finish('failed', error=f"{type(e).__name__}: {e}")
+        self._finished(job)
+
+    def _ensure_process(self, index):
+        entry = self._processes.get(index)
+        if entry is not None and entry[0].is_alive():
+            return entry
+        parent_conn, child_conn = self._context.Pipe()
+        process = self._context.Process(target=_worker_main, args=(child_conn, self.target),
+                                        name=f"report-worker-{index}", daemon=True)
+        process.start()
+        child_conn.close()
+        self._processes[index] = (process, parent_conn)
+        return process, parent_conn
+
+    def _stop_process(self, index):
+        entry = self._processes.pop(index, None)
+        if entry is None:
+            return
+        process, conn = entry
+        try:
+            conn.send(None)
+        except (OSError, BrokenPipeError):
+            pass
+        process.join(1.0)
+        if process.is_alive():
+            process.terminate()
+            process.join(1.0)
+        conn.close()
+
+    def _slot_loop(self, index):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            if job.cancel_requested:
+                job._finish('cancelled', error="実行前に取り消されました。")
+                self._finished(job)
+                continue
+            self._run_in_process(index, job)
+            self._finished(job)
+
+    def _run_in_process(self, index, job):
+        process, conn = self._ensure_process(index)
+        job.status = 'running'
+        job.started_at = time.time()
+        deadline = time.monotonic() + job.timeout
+        try:
+            conn.send((job.name, job.args))
+            while True:
+                if conn.poll(0.1):
+                    status, value = conn.recv()
+                    if status == 'ok':
+                        job._finish('done', result=value)
+                    else:
+                        job._finish('failed', error=value)
+                    return
+                if job.cancel_requested:
+                    self._kill_process(index)
+                    job._finish('cancelled', error="実行中に取り消されました。")
+                    return
+                if time.monotonic() >= deadline:
+                    self._kill_process(index)
+                    job._finish('timeout', error=f"{job.timeout}秒以内に終わらなかったため中止しました。")
+                    return
+                if not process.is_alive():
+                    raise EOFError
+        except (EOFError, OSError, BrokenPipeError):
+            self._kill_process(index)
+            job._finish('failed', error="ワーカープロセスが異常終了しました。")
+
+    def _kill_process(self, index):
+        entry = self._processes.pop(index, None)
+        if entry is None:
+            return
+        process, conn = entry
+        process.terminate()
+        process.join(1.0)
+        if process.is_alive():
+            process.kill()
+            process.join()
+        conn.close()
+
+    def _finished(self, job):
+        with self._lock:
+            # 終わったジョブは新しいものから100件だけ残す
+            finished = [j for j in self._jobs.values() if j.finished_at is not None]
+            for old in sorted(finished, key=lambda j: j.finished_at)[:-100]:
+                del self._jobs[old.id]
+        if self.on_finish is not None:
+            self.on_finish(job, (job.finished_at or time.time()) - (job.started_at or job.submitted_at))
@@ -0,0 +1,124 @@
+import threading
+
+from metrics import RESULT_CACHE_LOOKUPS_TOTAL
+
+
+class ResultCache:
+    """
+    ランキングやカレンダーなどの集計結果のキャッシュ。
+
+    データが変わるたび（タップの書き込み、ユーザーの編集、ログの削除、自動退室）に
+    bump() でデータバージョンを上げると、それより前に計算した結果は使われなくなります。
+    締まった過去の月のように今後変わらない結果は pin=True で固定しておくと、
+    バージョンが上がっても再計算しません。固定した結果も捨てたい場合
+    （ユーザー名の変更やログの削除など）は invalidate_all() を呼びます。
+    キーはタプルで、先頭の要素を種類としてヒット/ミスの統計を取ります。
+
+    shared に worker_sync.SharedCounters（'data_version' と 'pin_epoch' のカウンタ）を渡すと、
+    データバージョンを複数のワーカープロセスで共有し、どのプロセスで bump() しても
+    すべてのプロセスの古い結果が使われなくなります。
+
+    固定する結果は max_pinned 件までで、超えた場合は古いものから捨てます。
+    """
+
+    def __init__(self, shared=None, max_pinned=256):
+        self._lock = threading.Lock()
+        self._shared = shared
+        self._max_pinned = max_pinned
+        self._version = 0
+        self._pin_epoch = shared.get('pin_epoch') if shared else 0
+        self._entries = {}  # {キー: (計算したときのデータバージョン, 結果)}
+        self._pinned = {}   # {キー: 結果}
+        self._stats = {}    # {種類: [ヒット数, ミス数]}
+
+    @property
+    def data_version(self):
+        with self._lock:
+            return self._current_version()
+
+    def bump(self):
+        """データバージョンを上げ、固定していない結果を捨てます。新しいバージョンを返します。"""
+        with self._lock:
+            if self._shared is not None:
+                self._version = self._shared.increment('data_version')
+            else:
+                self._version += 1
+            self._entries.clear()
+            return self._version
+
+    def invalidate_all(self):
+        """固定した結果も含めてすべて捨てます。新しいバージョンを返します。"""
+        with self._lock:
+            if self._shared is not None:
+                self._pin_epoch = self._shared.increment('pin_epoch')
+                self._version = self._shared.increment('data_version')
+            else:
+                self._version += 1
+            self._entries.clear()
+            self._pinned.clear()
+            return self._version
+
+    def _current_version(self):
+        """今のデータバージョン（共有している場合は、他のプロセスの invalidate_all() も反映する）"""
+        if self._shared is None:
+            return self._version
+        pin_epoch = self._shared.get('pin_epoch')
+        if pin_epoch != self._pin_epoch:
+            self._pin_epoch = pin_epoch
+            self._pinned.clear()
+        self._version = self._shared.get('data_version')
+        return self._version
+
+    def get_or_compute(self, key, compute, pin=False):
+        """
+        キャッシュされた結果を返します。ない場合や古い場合は compute() で計算します。
+        pin は真偽値か、計算結果を受け取って固定するかどうかを返す関数。
+        """
+        kind = key[0]
+        with self._lock:
+            version = self._current_version()
+            if key in self._pinned:
+                self._record(kind, hit=True)
+                return self._pinned[key]
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version:
+                self._record(kind, hit=True)
+                return entry[1]
+            self._record(kind, hit=False)
+
+        value = compute()
+        should_pin = pin(value) if callable(pin) else pin
+
+        with self._lock:
+            # 計算中にデータが変わった場合は、古い結果を保存しない
+            if self._current_version() == version:
+                if should_pin:
+                    self._pinned[key] = value
+                    while len(self._pinned) > self._max_pinned:
+                        del self._pinned[next(iter(self._pinned))]
+                else:
+                    self._entries[key] = (version, value)
+        return value
+
+    def stats(self):
+        """種類ごとのヒット/ミス数とキャッシュの状態を返します。"""
+        with self._lock:
+            kinds = {}
+            for kind, (hits, misses) in sorted(self._stats.items()):
+                total = hits + misses
+                kinds[kind] = {
+                    'hits': hits,
+                    'misses': misses,
+                    'hit_ratio': round(hits / total, 3) if total else None,
+                }
+            return {
+                'data_version': self._current_version(),
+                'entries': len(self._entries),
+                'pinned': len(self._pinned),
+                'kinds': kinds,
+            }
+
+    def _record(self, kind, hit):
+        counts = self._stats.setdefault(kind, [0, 0])
+        counts[0 if hit else 1] += 1
+        RESULT_CACHE_LOOKUPS_TOTAL.inc(kind=kind, result='hit' if hit else 'miss')
@@ -0,0 +1,203 @@
+import calendar
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+
+def daily_at(hour, minute):
+    """毎日 hour:minute。after より後の最初の実行時刻を返す関数を返します。"""
+    def next_after(after):
+        candidate = after.replace(hour=hour, minute=minute, second=0, microsecond=0)
+        if candidate <= after:
+            candidate += timedelta(days=1)
+        return candidate
+    return next_after
+
+
+def monthly_at(day, hour, minute):
+    """毎月 day 日の hour:minute（その月に day 日がなければ月末）。"""
+    def occurrence(year, month):
+        last_day = calendar.monthrange(year, month)[1]
+        return datetime(year, month, min(day, last_day), hour, minute)
+
+    def next_after(after):
+        candidate = occurrence(after.year, after.month)
+        if candidate <= after:
+            year, month = (after.year + 1, 1) if after.month == 12 else (after.year, after.month + 1)
+            candidate = occurrence(year, month)
+        return candidate
+    return next_after
+
+
+class _TimedJob:
+    def __init__(self, name, func, next_after, catch_up):
+        self.name = name
+        self.func = func
+        self.next_after = next_after
+        self.catch_up = catch_up  # 'all': 止まっていた間の実行をすべて行う / 'latest': 最後の1回だけ
+        self.done_through = None  # この時刻までの予定は実行済み（state_path に保存する）
+        self.next_run = None
+        self.last_run = None
+
+
+class _IntervalJob:
+    def __init__(self, name, func, interval):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.next_run = None  # time.monotonic() 基準の締め切り
+        self.last_run = None
+
+
+class Scheduler:
+    """
+    定期実行タスクのスケジューラ。
+
+    - タスクごとに専用のスレッドで実行するため、時間のかかるタスク（Excel ログの更新など）が
+      他のタスク（23:59 の自動退室など）を遅らせることはありません。
+    - 時刻指定のタスクは「その分に起きていたか」ではなく次の実行時刻（締め切り）で判定し、
+      締め切りを過ぎていれば実行します。待機は最大 max_sleep 秒ずつ行い、時計の変更にも追従します。
+    - 時刻指定のタスクをどの予定時刻まで実行したかを state_path に保存し、停止中に過ぎた
+      実行は起動時に取り戻します。タスクの関数には予定時刻が渡されます。
+    - 失敗した実行は retry_seconds 秒後に同じ予定時刻でやり直します。
+    - 一定間隔のタスクは time.monotonic() の締め切りで実行し、遅れても間隔がずれていきません
+      （実行が間隔より長引いた場合は、溜まった分をまとめて実行せずに次の締め切りから再開します）。
+
+    runner(名前, 関数, *引数) がタスクを実行し、成功したかどうかを返します。
+    """
+
+    def __init__(self, runner, state_path, max_sleep=30.0, retry_seconds=60.0):
+        self.runner = runner
+        self.state_path = state_path
+        self.max_sleep = max_sleep
+        self.retry_seconds = retry_seconds
+        self._jobs = []
+        self._threads = []
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._running = set()
+
+    def daily(self, name, hour, minute, func, catch_up='all'):
+        self._jobs.append(_TimedJob(name, func, daily_at(hour, minute), catch_up))
+
+    def monthly(self, name, day, hour, minute, func, catch_up='latest'):
+        self._jobs.append(_TimedJob(name, func, monthly_at(day, hour, minute), catch_up))
+
+    def every(self, name, seconds, func):
+        self._jobs.append(_IntervalJob(name, func, seconds))
+
+    def start(self, now=None):
+        if self._threads:
+            return
+        now = now or datetime.now()
+        state = self._load_state()
+        self._stopped.clear()
+        for job in self._jobs:
+            if isinstance(job, _TimedJob):
+                done_through = state.get(job.name)
+                # 初めて動かすタスクは、過去の分を実行せずに次の予定時刻から始める
+                job.done_through = datetime.fromisoformat(done_through) if done_through else now
+                job.next_run = self._catch_up(job, job.next_after(job.done_through), now)
+                target = self._run_timed
+            else:
+                job.next_run = time.monotonic()
+                target = self._run_interval
+            thread = threading.Thread(target=target, args=(job,), name=f"scheduler-{job.name}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        self._save_state()
+
+    def stop(self, timeout=10.0):
+        """スケジューラを止めます。実行中のタスクは終わるまで最大 timeout 秒待ちます。"""
+        self._stopped.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def stats(self):
+        jobs = {}
+        with self._lock:
+            running = set(self._running)
+        for job in self._jobs:
+            if job.next_run is None:
+                next_run = None
+            elif isinstance(job, _TimedJob):
+                next_run = job.next_run.isoformat()
+            else:
+                next_run = (datetime.now() + timedelta(seconds=job.next_run - time.monotonic())).isoformat()
+            jobs[job.name] = {
+                'next_run': next_run,
+                'done_through': job.done_through.isoformat() if getattr(job, 'done_through', None) else None,
+                'last_run': job.last_run.isoformat() if job.last_run else None,
+                'running': job.name in running,
+            }
+        return jobs
+
+    def _catch_up(self, job, next_run, now):
+        """'latest' のタスクは、過ぎてしまった予定時刻のうち最後のものまで飛ばします。"""
+        if job.catch_up != 'latest':
+            return next_run
+        while True:
+            following = job.next_after(next_run)
+            if following > now:
+                return next_run
+            next_run = following
+
+    def _run_timed(self, job):
+        while not self._stopped.is_set():
+            wait = (job.next_run - datetime.now()).total_seconds()
+            if wait > 0:
+                self._stopped.wait(min(wait, self.max_sleep))
+                continue
+            if not self._run(job, job.next_run):
+                self._stopped.wait(self.retry_seconds)
+                continue
+            job.last_run = datetime.now()
+            job.done_through = job.next_run
+            self._save_state()
+            job.next_run = self._catch_up(job, job.next_after(job.next_run), datetime.now())
+
+    def _run_interval(self, job):
+        while not self._stopped.is_set():
+            wait = job.next_run - time.monotonic()
+            if wait > 0:
+                self._stopped.wait(min(wait, self.max_sleep))
+                continue
+            self._run(job)
+            job.last_run = datetime.now()
+            job.next_run += job.interval
+            if job.next_run <= time.monotonic():
+                job.next_run = time.monotonic() + job.interval
+
+    def _run(self, job, *args):
+        with self._lock:
+            self._running.add(job.name)
+        try:
+            return self.runner(job.name, job.func, *args)
+        finally:
+            with self._lock:
+                self._running.discard(job.name)
+
+    def _load_state(self):
+        try:
+            with open(self.state_path, encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            print(f"スケジューラの状態を読み込めませんでした ({self.state_path}): {e}")
+            return {}
+
+    def _save_state(self):
+        """時刻指定のタスクをどの予定時刻まで実行したかを保存します。"""
+        with self._lock:
+            state = {job.name: job.done_through.isoformat() for job in self._jobs
+                     if isinstance(job, _TimedJob) and job.done_through}
+            tmp_path = self.state_path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(state, f, ensure_ascii=False)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.state_path)
@@ -0,0 +1,442 @@
+"""
+タップ処理パイプラインの負荷試験・リプレイ用ハーネス。
+
+本物のリーダーと Discord の代わりにフェイクのリーダーとローカルの
+HTTP スタブを使い、合成した（または記録済みの）IDm の列を
+handle_card_tap に流して、スループット・レイテンシ (p50/p99)・
+入室/退室の切り替えが正しく記録されたかを報告します。
+データベースなどは一時ディレクトリに作られるため、本番のデータには触れません。
+
+使い方:
+    python tap_bench.py --users 2000 --taps 10000 --readers 4
+    python tap_bench.py --replay taps.csv   # 各行: 経過秒,IDm[,リーダー番号]
+    python tap_bench.py --report-load 24    # 24か月分の履歴の Excel ログを作りながら測る
+    python tap_bench.py --self-check        # リーダーと通知の差し替え口が動くかだけを確認する
+
+--report-load を付けると、合成した過去の滞在履歴の Excel ログ書き出しを
+タップ処理の間ずっと繰り返し、レポート作成がタップのレイテンシに与える影響を測ります。
+ACCESS_CONTROL_REPORT_WORKERS=0 で実行すると、書き出しを同じプロセスで行った場合と比べられます。
+"""
+import argparse
+import contextlib
+import csv
+import io
+import json
+import os
+import queue
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class _WebhookStub(BaseHTTPRequestHandler):
+    """Discord ウェブフックの代わりに 204 を返すだけのスタブ"""
+    received = 0
+    lock = threading.Lock()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        with _WebhookStub.lock:
+            _WebhookStub.received += 1
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeConnection:
+    """pyscard のコネクションの代わり。次に返す IDm を set_card() で指定する"""
+
+    def __init__(self):
+        self._idm = None
+
+    def set_card(self, idm):
+        self._idm = idm
+
+    def connect(self):
+        if self._idm is None:
+            raise RuntimeError("no card")
+
+    def disconnect(self):
+        pass
+
+    def transmit(self, apdu):
+        return list(bytes.fromhex(self._idm)), 0x90, 0x00
+
+
+class FakeReader:
+    def __init__(self, name):
+        self.name = name
+
+    def __str__(self):
+        return self.name
+
+    def createConnection(self):
+        return FakeConnection()
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def synthetic_stream(idms, taps, readers, burst_size, seed):
+    """
+    シフト交代のようなバースト的な到着を模した (経過秒, IDm, リーダー番号) の列を作ります。
+    バーストの中では同じ人が続けてかざすことはありません。
+    """
+    rng = random.Random(seed)
+    stream = []
+    offset = 0.0
+    while len(stream) < taps:
+        burst = rng.sample(idms, min(burst_size, len(idms), taps - len(stream)))
+        for idm in burst:
+            offset += rng.expovariate(200.0)  # バースト内は平均 5ms 間隔
+            stream.append((offset, idm, rng.randrange(readers)))
+        offset += rng.uniform(0.5, 2.0)  # バーストの間の静かな時間
+    return stream
+
+
+def load_replay(path, readers):
+    stream = []
+    with open(path, newline='', encoding='utf-8') as f:
+        for row in csv.reader(f):
+            if not row or row[0].startswith('#'):
+                continue
+            reader_index = int(row[2]) % readers if len(row) > 2 and row[2] else 0
+            stream.append((float(row[0]), row[1].strip(), reader_index))
+    stream.sort(key=lambda item: item[0])
+    return stream
+
+
+def past_sessions(access_app, months, rng):
+    """登録ユーザーの、先月までの months か月分の閉じた滞在セッションを作ります。"""
+    user_ids = [user_id for (user_id,) in access_app.db.session.query(access_app.User.id)]
+    end = datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    day = end - timedelta(days=months * 30)
+    while day < end:
+        for user_id in user_ids:
+            if rng.random() < 0.3:
+                entry_ts = day + timedelta(hours=rng.uniform(7, 12))
+                exit_ts = entry_ts + timedelta(hours=rng.uniform(0.5, 10))
+                yield {'user_id': user_id, 'entry_ts': entry_ts, 'exit_ts': exit_ts,
+                       'duration_seconds': (exit_ts - entry_ts).total_seconds(), 'auto_closed': False}
+        day += timedelta(days=1)
+
+
+def check_reader_taps(access_app, idm):
+    """
+    フェイクのリーダーにかざしたカードが CardReaderService から handle_card_tap まで届き、
+    入室 → 退室 → 未登録カードの順に正しく記録されるかを確認します。
+    失敗した項目のメッセージのリストを返します。
+    """
+    from card_reader import CardReaderService, ReaderConfig
+
+    taps = queue.Queue()
+    reader = FakeReader("Fake PaSoRi self-check")
+    service = CardReaderService(
+        on_tap=lambda tapped_idm, reader_info: taps.put(access_app.handle_card_tap(tapped_idm, reader_info)),
+        reader_configs=[ReaderConfig(match='Fake PaSoRi', mode='toggle')],
+        debounce_seconds=0,
+        reader_source=lambda: [reader],
+        monitor_factory=lambda: None)
+
+    failures = []
+    service.open_readers()
+    try:
+        for card, expected in ((idm, '入室'), (idm, '退室'), ('FFFF000000000000', None)):
+            service.workers[reader.name].connection.set_card(card)
+            service.card_inserted(reader.name)
+            try:
+                result = taps.get(timeout=5.0)
+            except queue.Empty:
+                failures.append(f"{card}: handle_card_tap が呼ばれませんでした")
+                continue
+            status = result[1] if result else None
+            if status != expected:
+                failures.append(f"{card}: {expected} のはずが {status} でした")
+    finally:
+        service.stop()
+
+    access_app.tap_journal.flush()
+    with access_app.app.app_context():
+        recorded = [status for (status,) in access_app.db.session.query(access_app.AccessLog.status).join(
+            access_app.User, access_app.User.id == access_app.AccessLog.user_id
+        ).filter(access_app.User.idm == idm).order_by(access_app.AccessLog.id)]
+    if recorded != ['入室', '退室']:
+        failures.append(f"データベースの記録が {recorded} でした（['入室', '退室'] のはず）")
+    return failures
+
+
+class _StubResponse:
+    def __init__(self, status_code, body=None, headers=None):
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.headers = headers or {}
+        self._body = body
+        self.text = json.dumps(body) if body is not None else ''
+
+    def json(self):
+        if self._body is None:
+            raise ValueError("no body")
+        return self._body
+
+
+class _StubSession:
+    """requests.Session の代わりに、決めておいたレスポンスを順に返す"""
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.posted_at = []
+
+    def post(self, url, json=None, timeout=None):
+        self.posted_at.append(time.monotonic())
+        return self.responses.pop(0) if self.responses else _StubResponse(204)
+
+
+def check_notifier_retries(workdir):
+    """
+    スタブのセッションで DiscordNotifier の再送を確認します。500 の後は再送し、
+    429 の後は retry_after 秒待ってから再送し、送信できたらスプールを消すこと。
+    失敗した項目のメッセージのリストを返します。
+    """
+    from notifier import DiscordNotifier
+
+    retry_after = 0.3
+    session = _StubSession([
+        _StubResponse(500),
+        _StubResponse(429, body={'retry_after': retry_after}),
+        _StubResponse(204),
+    ])
+    spool_dir = os.path.join(workdir, 'self_check_spool')
+    notifier = DiscordNotifier('http://webhook.invalid/self-check', spool_dir,
+                               backoff_base=0.05, backoff_max=1.0, session=session)
+    notifier.notify({'content': 'self-check'})
+    notifier.stop(timeout=5.0)
+
+    failures = []
+    if len(session.posted_at) != 3:
+        failures.append(f"送信が {len(session.posted_at)} 回でした（500 → 429 → 204 の3回のはず）")
+    elif session.posted_at[2] - session.posted_at[1] < retry_after:
+        failures.append(f"429 の後 {session.posted_at[2] - session.posted_at[1]:.2f}秒で再送しました"
+                        f"（{retry_after}秒待つはず）")
+    if notifier.pending_count():
+        failures.append(f"送信後もスプールに {notifier.pending_count()} 件残っています")
+    return failures
+
+
+def run_self_check(access_app, idms, output):
+    """差し替え口ごとの確認を順に実行して結果を表示し、終了コードを返します。"""
+    checks = [
+        ('フェイクのリーダー → handle_card_tap', lambda: check_reader_taps(access_app, idms[0])),
+        ('スタブのセッション → 通知の再送と 429', lambda: check_notifier_retries(access_app.app.instance_path)),
+    ]
+    with contextlib.redirect_stdout(output):
+        access_app.init_tap_pipeline()
+    failed = 0
+    for name, check in checks:
+        with contextlib.redirect_stdout(output):
+            failures = check()
+        print(f"{'OK ' if not failures else 'NG '} {name}")
+        for failure in failures:
+            print(f"    {failure}")
+        failed += bool(failures)
+    with contextlib.redirect_stdout(output):
+        access_app.tap_journal.stop()
+        access_app.notifier.stop(timeout=5)
+    return 1 if failed else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=2000, help='登録ユーザー数')
+    parser.add_argument('--taps', type=int, default=10000, help='合成するタップ数')
+    parser.add_argument('--readers', type=int, default=2, help='フェイクのリーダー台数')
+    parser.add_argument('--burst', type=int, default=200, help='1回のバーストでかざす人数')
+    parser.add_argument('--unknown-ratio', type=float, default=0.01, help='未登録カードの割合')
+    parser.add_argument('--replay', help='記録済みのタップ列 (CSV: 経過秒,IDm[,リーダー番号])')
+    parser.add_argument('--realtime', action='store_true', help='経過秒どおりの間隔でタップを流す')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help='結果を JSON で出力する')
+    parser.add_argument('--verbose', action='store_true', help='タップごとのログを表示する')
+    parser.add_argument('--report-load', type=int, default=0, metavar='MONTHS',
+                        help='この月数分の履歴の Excel ログ書き出しを、タップ処理と並行して繰り返す')
+    parser.add_argument('--self-check', action='store_true',
+                        help='フェイクのリーダーと通知のスタブで差し替え口が動くかを確認して終了する')
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix='tap_bench_')
+    os.environ['ACCESS_CONTROL_INSTANCE_PATH'] = workdir
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _WebhookStub)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    import app as access_app
+    from card_reader import CardReaderService, ReaderConfig
+
+    access_app.notifier.webhook_url = f"http://127.0.0.1:{server.server_port}/webhook"
+
+    rng = random.Random(args.seed)
+    if args.replay:
+        # 記録済みのタップ列に出てくる IDm をすべて登録ユーザーにする
+        stream = load_replay(args.replay, args.readers)
+        idms = sorted({idm for _, idm, _ in stream})
+    else:
+        idms = [f"{i:016X}" for i in range(1, args.users + 1)]
+        stream = synthetic_stream(idms, args.taps, args.readers, args.burst, args.seed)
+        unknown = int(len(stream) * args.unknown_ratio)
+        for i in rng.sample(range(len(stream)), unknown):
+            offset, _, reader_index = stream[i]
+            stream[i] = (offset, f"FFFF{i:012X}", reader_index)
+
+    output = sys.stdout if args.verbose else io.StringIO()
+
+    with access_app.app.app_context(), contextlib.redirect_stdout(output):
+        access_app.migrate_schema()
+        access_app.db.session.bulk_insert_mappings(
+            access_app.User, [{'idm': idm, 'name': f"bench-{idm}"} for idm in idms])
+        access_app.db.session.commit()
+        if args.report_load:
+            access_app.db.session.bulk_insert_mappings(
+                access_app.StaySession, list(past_sessions(access_app, args.report_load, rng)))
+            access_app.db.session.commit()
+
+    if args.self_check:
+        status = run_self_check(access_app, idms, output)
+        server.shutdown()
+        return status
+
+    latencies = []
+    latencies_lock = threading.Lock()
+    results = []  # (IDm, 記録された状態)
+    done = threading.Semaphore(0)
+    fake_readers = [FakeReader(f"Fake PaSoRi {i:02d}") for i in range(args.readers)]
+    inserted_at = {}  # {リーダー名: カードを置いた時刻}
+    # 同じリーダーへの次のカードは、前のカードの処理が終わってから置く
+    reader_busy = {reader.name: threading.Semaphore(1) for reader in fake_readers}
+
+    def on_tap(idm, reader):
+        try:
+            result = access_app.handle_card_tap(idm, reader)
+            finished = time.perf_counter()
+            with latencies_lock:
+                latencies.append(finished - inserted_at[reader.name])
+                results.append((idm, result[1] if result else None))
+        finally:
+            reader_busy[reader.name].release()
+            done.release()
+
+    service = CardReaderService(
+        on_tap=on_tap,
+        reader_configs=[ReaderConfig(match='Fake PaSoRi', mode='toggle')],
+        debounce_seconds=0,
+        reader_source=lambda: fake_readers,
+        monitor_factory=lambda: None)
+
+    report_stop = threading.Event()
+    report_runs = []
+
+    def report_load():
+        # 1回分の書き出しが終わるたびに、すぐ次の書き出しを始める
+        path = os.path.join(workdir, 'bench_access_logs.xlsx')
+        while not report_stop.is_set():
+            report_runs.append(access_app.report_pool.run('excel_log', datetime.now(), path)[0])
+
+    with contextlib.redirect_stdout(output):
+        access_app.init_tap_pipeline()
+        service.open_readers()
+        workers = service.workers
+        if args.report_load:
+            # ワーカープロセスの起動を済ませてから測定を始める
+            report_runs.append(access_app.report_pool.run(
+                'excel_log', datetime.now(), os.path.join(workdir, 'bench_access_logs.xlsx'))[0])
+            report_thread = threading.Thread(target=report_load, daemon=True)
+            report_thread.start()
+
+        started = time.perf_counter()
+        for offset, idm, reader_index in stream:
+            if args.realtime:
+                delay = started + offset - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            reader = fake_readers[reader_index]
+            reader_busy[reader.name].acquire()
+            workers[reader.name].connection.set_card(idm)
+            inserted_at[reader.name] = time.perf_counter()
+            service.card_inserted(reader.name)
+        for _ in stream:
+            done.acquire()
+        elapsed = time.perf_counter() - started
+        if args.report_load:
+            report_stop.set()
+            report_thread.join()
+            access_app.report_pool.shutdown()
+
+        flush_started = time.perf_counter()
+        access_app.tap_journal.stop()
+        flush_elapsed = time.perf_counter() - flush_started
+        access_app.notifier.stop(timeout=30)
+        service.stop()
+
+    # --- 入室/退室の切り替えが正しいか検証する ---
+    with access_app.app.app_context():
+        rows = access_app.db.session.query(
+            access_app.AccessLog.user_id, access_app.AccessLog.status
+        ).order_by(access_app.AccessLog.id).all()
+        user_ids = dict(access_app.db.session.query(access_app.User.idm, access_app.User.id).all())
+
+    recorded = defaultdict(list)
+    for user_id, status in rows:
+        recorded[user_id].append(status)
+    expected = defaultdict(list)
+    for idm, status in results:
+        if status is not None:
+            expected[user_ids[idm]].append(status)
+
+    toggle_errors = 0
+    for user_id, statuses in recorded.items():
+        for i, status in enumerate(statuses):
+            if status != ('入室' if i % 2 == 0 else '退室'):
+                toggle_errors += 1
+        if statuses != expected[user_id]:
+            toggle_errors += 1
+
+    latencies.sort()
+    report = {
+        'taps': len(stream),
+        'recorded': len(rows),
+        'unknown': sum(1 for _, status in results if status is None),
+        'readers': args.readers,
+        'elapsed_seconds': round(elapsed, 3),
+        'throughput_taps_per_second': round(len(stream) / elapsed, 1) if elapsed else None,
+        'latency_p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'latency_p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        'latency_max_ms': round(latencies[-1] * 1000, 3) if latencies else 0,
+        'final_flush_seconds': round(flush_elapsed, 3),
+        'webhook_requests': _WebhookStub.received,
+        'toggle_errors': toggle_errors,
+        'report_workers': access_app.report_pool.workers if args.report_load else None,
+        'report_exports': len(report_runs) - 1 if args.report_load else None,
+        'correct': toggle_errors == 0 and len(rows) == len(stream) - sum(1 for _, s in results if s is None),
+    }
+    server.shutdown()
+
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False))
+    else:
+        print("--- タップ処理ベンチマーク ---")
+        for key, value in report.items():
+            print(f"{key:>28}: {value}")
+    return 0 if report['correct'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,140 @@
+import json
+import os
+import threading
+
+
+class TapJournal:
+    """
+    タップを記録する追記専用のジャーナル。
+
+    タップは JSON Lines 形式でジャーナルファイルに追記された時点で確定とし、
+    データベースへの書き込みはフラッシャースレッドが複数件まとめて
+    1つのトランザクションで行います（グループコミット）。
+    write_batch はエントリのリストを受け取り、ログの挿入と
+    チェックポイント（書き込み済みの最大 seq）の更新を同じトランザクションで
+    行う関数であること。起動時に open() を呼ぶと、チェックポイントより
+    新しいエントリが再びキューに積まれるため、タップが失われることはありません。
+    """
+
+    def __init__(self, path, write_batch, flush_interval=0.5, max_batch_size=500, fsync=True):
+        self.path = path
+        self.write_batch = write_batch
+        self.flush_interval = flush_interval
+        self.max_batch_size = max_batch_size
+        self.fsync = fsync
+        self._pending = []  # データベース未反映のエントリ（seq 順）
+        self._next_seq = 1
+        self._file = None
+        self._lock = threading.Lock()         # ファイルと _pending を守る
+        self._flush_lock = threading.Lock()   # フラッシュを同時に1つだけ実行する
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @property
+    def is_open(self):
+        return self._file is not None
+
+    def open(self, last_committed_seq):
+        """
+        ジャーナルファイルを開き、last_committed_seq より新しいエントリを
+        未反映のエントリとして読み込みます。読み込んだ件数を返します。
+        """
+        with self._lock:
+            if self._file is not None:
+                return len(self._pending)
+            pending = []
+            max_seq = last_committed_seq or 0
+            if os.path.exists(self.path):
+                with open(self.path, encoding='utf-8') as f:
+                    for line in f:
+                        try:
+                            entry = json.loads(line)
+                        except ValueError:
+                            # 書き込み途中で電源が落ちた行などは無視する
+                            continue
+                        max_seq = max(max_seq, entry['seq'])
+                        if entry['seq'] > (last_committed_seq or 0):
+                            pending.append(entry)
+            self._pending = pending
+            self._next_seq = max_seq + 1
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self._file = open(self.path, 'a', encoding='utf-8')
+            if pending:
+                print(f"タップジャーナルから未反映のタップ {len(pending)} 件を読み込みました。")
+            return len(pending)
+
+    def append(self, entry):
+        """
+        エントリをジャーナルに追記して seq を返します。
+        この関数が戻った時点でタップは確定しています。
+        """
+        with self._lock:
+            if self._file is None:
+                raise RuntimeError("Tap journal is not open.")
+            entry = dict(entry, seq=self._next_seq)
+            self._file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+            self._next_seq += 1
+            self._pending.append(entry)
+            if len(self._pending) >= self.max_batch_size:
+                self._wakeup.set()
+            return entry['seq']
+
+    def pending_count(self):
+        with self._lock:
+            return len(self._pending)
+
+    def flush(self):
+        """
+        未反映のエントリをデータベースに書き込みます。
+        書き込んだ件数を返します。失敗した場合は例外をそのまま送出し、
+        エントリは次回のフラッシュで再度書き込まれます。
+        """
+        with self._flush_lock:
+            written = 0
+            while True:
+                with self._lock:
+                    batch = self._pending[:self.max_batch_size]
+                if not batch:
+                    return written
+
+                self.write_batch(batch)
+
+                with self._lock:
+                    del self._pending[:len(batch)]
+                    if not self._pending:
+                        # すべて反映済みになったらジャーナルを空にする
+                        self._file.truncate(0)
+                        self._file.seek(0)
+                written += len(batch)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="tap-journal-flusher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """フラッシャーを止め、残っているエントリを書き込みます。"""
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=10.0)
+            self._thread = None
+        try:
+            self.flush()
+        except Exception as e:
+            print(f"タップジャーナルの書き込みに失敗しました（次回起動時に再試行します）: {e}")
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"タップジャーナルの書き込みに失敗しました（再試行します）: {e}")
@@ -0,0 +1,106 @@
+import threading
+
+
+class CachedUser:
+    """キャッシュに保持するユーザー情報と現在の入退室状態"""
+    __slots__ = ('user_id', 'idm', 'name', 'status')
+
+    def __init__(self, user_id, idm, name, status=None):
+        self.user_id = user_id
+        self.idm = idm
+        self.name = name
+        self.status = status  # '入室' / '退室' / None (ログなし)
+
+    def copy(self):
+        return CachedUser(self.user_id, self.idm, self.name, self.status)
+
+    def __repr__(self):
+        return f'<CachedUser {self.name} ({self.idm}) {self.status}>'
+
+
+class UserPresenceCache:
+    """
+    IDm → (user_id, 名前, 現在の状態) をプロセス全体で保持するキャッシュ。
+    起動時に一度だけデータベースから読み込み、以降はユーザー管理の各ルートや
+    自動退室処理から更新されます。カードをかざした時の入退室判定は
+    このキャッシュだけで完結し、データベースの読み込みは発生しません。
+    """
+
+    def __init__(self):
+        self._by_idm = {}  # {idm: CachedUser}
+        self._by_id = {}   # {user_id: CachedUser}
+        self._lock = threading.RLock()
+        self.loaded = False
+
+    def load(self, users, last_statuses):
+        """
+        users: (user_id, idm, name) のイテラブル
+        last_statuses: {user_id: 最後のログのステータス}
+        """
+        by_idm = {}
+        by_id = {}
+        for user_id, idm, name in users:
+            entry = CachedUser(user_id, idm, name, last_statuses.get(user_id))
+            by_idm[idm] = entry
+            by_id[user_id] = entry
+        with self._lock:
+            self._by_idm = by_idm
+            self._by_id = by_id
+            self.loaded = True
+
+    def get(self, idm):
+        with self._lock:
+            entry = self._by_idm.get(idm)
+            return entry.copy() if entry else None
+
+    def get_by_id(self, user_id):
+        with self._lock:
+            entry = self._by_id.get(user_id)
+            return entry.copy() if entry else None
+
+    def put_user(self, user_id, idm, name):
+        """ユーザーの追加・更新。既存ユーザーの入退室状態は引き継ぎます。"""
+        with self._lock:
+            old = self._by_id.get(user_id)
+            status = old.status if old else None
+            if old and old.idm != idm:
+                self._by_idm.pop(old.idm, None)
+            entry = CachedUser(user_id, idm, name, status)
+            self._by_idm[idm] = entry
+            self._by_id[user_id] = entry
+
+    def remove_user(self, user_id):
+        with self._lock:
+            entry = self._by_id.pop(user_id, None)
+            if entry:
+                self._by_idm.pop(entry.idm, None)
+
+    def set_status(self, user_id, status):
+        with self._lock:
+            entry = self._by_id.get(user_id)
+            if entry:
+                entry.status = status
+
+    def decide(self, idm, forced_status=None):
+        """
+        IDmに対応するユーザーの新しい状態を決めてキャッシュに反映します。
+        forced_status が None の場合は入室⇔退室で切り替え、
+        それ以外（'入室' / '退室' 固定のリーダー）はその状態にします。
+        未登録のIDmの場合は None を、それ以外は
+        (ユーザー情報のコピー, 新しい状態, 直前の状態) を返します。
+        """
+        with self._lock:
+            entry = self._by_idm.get(idm)
+            if entry is None:
+                return None
+            previous_status = entry.status
+            if forced_status:
+                new_status = forced_status
+            else:
+                new_status = '退室' if previous_status == '入室' else '入室'
+            entry.status = new_status
+            return entry.copy(), new_status, previous_status
+
+    def present_user_ids(self):
+        with self._lock:
+            return [user_id for user_id, entry in self._by_id.items() if entry.status == '入室']
@@ -0,0 +1,142 @@
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import uuid
+
+
+TOKEN_SIZE = 16
+MAX_COUNTERS = 16
+STATE_SIZE = TOKEN_SIZE + 8 * MAX_COUNTERS
+
+
+def create_shared_state(path):
+    """
+    新しいトークンとゼロのカウンタで共有状態のファイルを作り直します。
+    サーバーの起動時に、ワーカーを起動する前のマスタープロセスで呼ぶこと。
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(uuid.uuid4().bytes + bytes(STATE_SIZE - TOKEN_SIZE))
+    os.replace(tmp_path, path)
+
+
+class SharedCounters:
+    """
+    複数のワーカープロセスで共有するカウンタ（mmap したファイル）。
+
+    ファイルの先頭にサーバーの起動ごとのトークン、その後に 64bit のカウンタを names の順に置きます。
+    読み取りはロックを取らずにメモリを読むだけなので、リクエストやタップのたびに読んでも
+    負担になりません。加算はファイルロック（fcntl.flock）で排他します。
+    """
+
+    def __init__(self, path, names):
+        if len(names) > MAX_COUNTERS:
+            raise ValueError(f"カウンタは {MAX_COUNTERS} 個までです。")
+        self.path = path
+        self._offsets = {name: TOKEN_SIZE + 8 * i for i, name in enumerate(names)}
+        if not os.path.exists(path):
+            create_shared_state(path)
+        self._fd = os.open(path, os.O_RDWR)
+        self._map = mmap.mmap(self._fd, STATE_SIZE)
+        self.token = bytes(self._map[:TOKEN_SIZE]).hex()
+
+    def get(self, name):
+        return struct.unpack_from('<Q', self._map, self._offsets[name])[0]
+
+    def increment(self, name):
+        """カウンタを1つ増やし、新しい値を返します。"""
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            value = self.get(name) + 1
+            struct.pack_into('<Q', self._map, self._offsets[name], value)
+            return value
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def raise_to(self, name, value):
+        """カウンタが value より小さければ value にします。"""
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            if self.get(name) < value:
+                struct.pack_into('<Q', self._map, self._offsets[name], value)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+
+class ProcessLock:
+    """
+    同じプロセスのスレッド同士と、ほかのプロセスとの両方で排他するロック
+    （threading.Lock と fcntl.flock）。with 文で使います。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._fd = None
+
+    def __enter__(self):
+        self._lock.acquire()
+        try:
+            if self._fd is None:
+                os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+                self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+        except BaseException:
+            self._lock.release()
+            raise
+        return self
+
+    def __exit__(self, *exc_info):
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._lock.release()
+
+
+class LeaderLock:
+    """
+    カードリーダーと定期実行タスクを受け持つプロセスを1つに決めるためのロック（fcntl.flock）。
+
+    ロックはプロセスが終了すると（異常終了でも）OS が解放するので、
+    他のプロセスが try_acquire() を繰り返していればすぐに引き継げます。
+    ロックファイルには持っているプロセスの PID を書いておきます（確認用）。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+
+    @property
+    def held(self):
+        return self._fd is not None
+
+    def try_acquire(self):
+        """ロックを取れれば True。ほかのプロセスが持っていれば待たずに False を返します。"""
+        if self._fd is not None:
+            return True
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        os.ftruncate(fd, 0)
+        os.write(fd, f"{os.getpid()}\n".encode('ascii'))
+        self._fd = fd
+        return True
+
+    def release(self):
+        if self._fd is None:
+            return
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+        os.close(self._fd)
+        self._fd = None
+
+    def owner_pid(self):
+        try:
+            with open(self.path, encoding='ascii') as f:
+                return int(f.read().strip() or 0) or None
+        except (OSError, ValueError):
+            return None